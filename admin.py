@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import faulthandler
+import io
+import pstats
+import signal
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Optional, TextIO
+
+from aiohttp import web
+
+from utility_functions import create_logger
+
+admin_logger = create_logger(logger_name="basedcount_bot")
+
+LOGS_DIR = Path("logs")
+MAX_PROFILE_SECONDS = 300
+
+# Only one profiler can run at a time, cProfile and the sampler would measure each other
+_profile_lock = asyncio.Lock()
+_last_snapshot: Optional[tracemalloc.Snapshot] = None
+# Snapshots run in a thread, two at once would diff against the same previous snapshot
+_snapshot_lock = asyncio.Lock()
+# Kept open for faulthandler, which writes to the file descriptor from the signal handler
+_thread_dump_file: Optional[TextIO] = None
+
+
+def _output_path(kind: str, suffix: str) -> Path:
+    """Timestamped file in the logs directory.
+
+    :returns: path of the new file
+
+    """
+    LOGS_DIR.mkdir(exist_ok=True)
+    return LOGS_DIR / f"{kind}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}{suffix}"
+
+
+def format_tasks() -> str:
+    """Formats every pending asyncio task with the stack it is suspended at, including the fire and forget background tasks.
+
+    :returns: the dump as text
+
+    """
+    current = asyncio.current_task()
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    output = io.StringIO()
+    output.write(f"{len(tasks)} pending tasks at {datetime.now(timezone.utc).isoformat(timespec='seconds')}\n")
+    for task in tasks:
+        coro = task.get_coro()
+        coro_name = getattr(coro, "__qualname__", repr(coro))
+        output.write(f"\n--- {task.get_name()} {coro_name}{' (this dump)' if task is current else ''}\n")
+        task.print_stack(file=output)
+    return output.getvalue()
+
+
+def dump_tasks() -> Path:
+    """Writes the pending asyncio tasks to the logs directory.
+
+    :returns: path of the dump
+
+    """
+    path = _output_path("tasks", ".txt")
+    path.write_text(format_tasks(), encoding="utf-8")
+    admin_logger.info("Dumped asyncio tasks to %s", path)
+    return path
+
+
+async def profile_cpu(seconds: float) -> tuple[Path, str]:
+    """Runs cProfile on the event loop thread for the given time, while the bot keeps running.
+
+    Writes the raw profile (for snakeviz or pstats) and a text summary sorted by cumulative time, in a thread since both take a while for a
+    long profile.
+
+    :param seconds: how long to profile
+
+    :returns: path of the profile and the top of the summary
+
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    return await asyncio.to_thread(_write_cprofile, profiler)
+
+
+def _write_cprofile(profiler: cProfile.Profile) -> tuple[Path, str]:
+    path = _output_path("cprofile", ".prof")
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(40)
+    path.with_suffix(".txt").write_text(summary.getvalue(), encoding="utf-8")
+    admin_logger.info("Wrote cProfile results to %s", path)
+    return path, summary.getvalue()
+
+
+def _sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter[str]:
+    """Samples the stack of a thread from another thread.
+
+    :returns: count of every stack, in the collapsed format flame graph tools read
+
+    """
+    samples: Counter[str] = Counter()
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f"{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        if stack:
+            samples[";".join(reversed(stack))] += 1
+        sleep(interval)
+    return samples
+
+
+async def profile_sampling(seconds: float, interval: float = 0.005) -> tuple[Path, str]:
+    """Samples the event loop thread's stack from a background thread. Unlike cProfile it barely slows the bot down.
+
+    Writes the stacks in the collapsed format (flamegraph.pl, speedscope) and returns the functions seen most often.
+
+    :param seconds: how long to sample
+    :param interval: seconds between samples
+
+    :returns: path of the collapsed stacks and a summary of the hottest frames
+
+    """
+    samples = await asyncio.to_thread(_sample_stacks, threading.get_ident(), seconds, interval)
+
+    path = _output_path("samples", ".folded")
+    path.write_text("".join(f"{stack} {count}\n" for stack, count in samples.most_common()), encoding="utf-8")
+
+    total = sum(samples.values()) or 1
+    self_counts: Counter[str] = Counter()
+    for stack, count in samples.items():
+        self_counts[stack.rsplit(";", 1)[-1]] += count
+    summary = f"{total} samples, frames on top of the stack:\n" + "".join(f"{count / total:>7.1%}  {frame}\n" for frame, count in self_counts.most_common(30))
+    admin_logger.info("Wrote stack samples to %s", path)
+    return path, summary
+
+
+def tracemalloc_snapshot(top: int = 40) -> tuple[Path, str]:
+    """Takes a tracemalloc snapshot and writes the allocations that grew the most since the previous one.
+
+    Tracing is started on the first call, that call only records the starting point. Snapshots of a large heap take seconds, call it in a
+    thread.
+
+    :param top: number of lines to report
+
+    :returns: path of the report and its content
+
+    """
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(25)
+        _last_snapshot = None
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory: {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB"]
+    if _last_snapshot is None:
+        lines.append("First snapshot, take another one to see what grew")
+        lines.extend(str(statistic) for statistic in snapshot.statistics("lineno")[:top])
+    else:
+        lines.extend(str(statistic) for statistic in snapshot.compare_to(_last_snapshot, "lineno")[:top])
+    _last_snapshot = snapshot
+
+    report = "\n".join(lines) + "\n"
+    path = _output_path("tracemalloc", ".txt")
+    path.write_text(report, encoding="utf-8")
+    admin_logger.info("Wrote tracemalloc report to %s", path)
+    return path, report
+
+
+def stop_tracemalloc() -> None:
+    """Stops tracing allocations, tracing slows every allocation down."""
+    global _last_snapshot
+    tracemalloc.stop()
+    _last_snapshot = None
+
+
+def install_signal_handlers(loop: asyncio.AbstractEventLoop) -> None:
+    """SIGUSR1 dumps the asyncio tasks. SIGUSR2 dumps the stacks of every thread through faulthandler, which works even when the event loop is blocked.
+
+    :param loop: running event loop
+
+    :returns: None
+
+    """
+    global _thread_dump_file
+    loop.add_signal_handler(signal.SIGUSR1, dump_tasks)
+    if _thread_dump_file is None:
+        LOGS_DIR.mkdir(exist_ok=True)
+        _thread_dump_file = (LOGS_DIR / "thread_stacks.txt").open("a", encoding="utf-8")
+        faulthandler.register(signal.SIGUSR2, file=_thread_dump_file, all_threads=True)
+
+
+def _seconds(request: web.Request, default: float) -> float:
+    """Reads the seconds query parameter, capped at MAX_PROFILE_SECONDS.
+
+    :returns: seconds
+
+    :raises web.HTTPBadRequest: If it isn't a positive number
+
+    """
+    try:
+        seconds = float(request.query.get("seconds", default))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise web.HTTPBadRequest(text=f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+    return seconds
+
+
+async def handle_tasks(_: web.Request) -> web.Response:
+    path = dump_tasks()
+    return web.Response(text=f"Written to {path}\n\n{path.read_text(encoding='utf-8')}")
+
+
+async def handle_profile(request: web.Request) -> web.Response:
+    mode = request.query.get("mode", "sample")
+    if mode not in ("sample", "cprofile"):
+        raise web.HTTPBadRequest(text="mode must be sample or cprofile")
+    seconds = _seconds(request, 30)
+    if _profile_lock.locked():
+        raise web.HTTPConflict(text="A profile is already running")
+
+    async with _profile_lock:
+        path, summary = await (profile_sampling(seconds) if mode == "sample" else profile_cpu(seconds))
+    return web.Response(text=f"Written to {path}\n\n{summary}")
+
+
+async def handle_tracemalloc(request: web.Request) -> web.Response:
+    if request.query.get("action", "snapshot") == "stop":
+        stop_tracemalloc()
+        return web.Response(text="Stopped tracemalloc\n")
+    async with _snapshot_lock:
+        path, report = await asyncio.to_thread(tracemalloc_snapshot)
+    return web.Response(text=f"Written to {path}\n\n{report}")
+
+
+def add_admin_routes(app: web.Application) -> None:
+    """Adds the admin endpoints to the metrics app, which only listens on localhost.
+
+    GET  /admin/tasks                                  dump the asyncio tasks
+    POST /admin/profile?mode=sample|cprofile&seconds=N profile the event loop for N seconds
+    POST /admin/tracemalloc?action=snapshot|stop       diff against the previous snapshot, or stop tracing
+
+    Every result is also written to the logs directory.
+
+    :param app: application served by start_metrics_server
+
+    :returns: None
+
+    """
+    app.add_routes(
+        [
+            web.get("/admin/tasks", handle_tasks),
+            web.post("/admin/profile", handle_profile),
+            web.post("/admin/tracemalloc", handle_tracemalloc),
+        ]
+    )
@@ -1,10 +1,12 @@
 import asyncio
 import random
+from datetime import datetime
 from typing import Any, AsyncIterator, Self
 
 from cachetools import Cache
 
 from async_lemmy_py.models.comment import Comment
+from async_lemmy_py.models.private_message import PrivateMessage
 from async_lemmy_py.request_builder import RequestBuilder
 from logging import getLogger
 
@@ -33,6 +35,8 @@ class AsyncLemmyPy:
         """
         self._async_lemmy_logger = getLogger("async_lemmy")
         self.request_builder = RequestBuilder(base_url, username, password)
+        # Seconds stream_comments is sleeping for before the next poll, 0 while new comments keep coming
+        self.poll_interval: float = 0
 
     async def __aenter__(self) -> Self:
         """Enter the asynchronous context.
@@ -79,9 +83,90 @@ class AsyncLemmyPy:
             if found:
                 self._async_lemmy_logger.debug("New comment found resetting the counter.")
                 exponential_counter.reset()
+                self.poll_interval = 0
             else:
                 sleep_time = exponential_counter.counter()
-                self._async_lemmy_logger.debug(f"No new comments, sleeping for {sleep_time} seconds.")
+                self.poll_interval = sleep_time
+                self._async_lemmy_logger.debug("No new comments, sleeping for %s seconds.", sleep_time)
+                await asyncio.sleep(sleep_time)
+
+    async def community_id(self, actor_id: str) -> int:
+        """Look up the id of a community on this instance, ids differ between instances so they shouldn't be hardcoded.
+
+        :param str actor_id: The actor id of the community, e.g. https://lemmy.basedcount.com/c/pcm
+
+        :returns: The id of the community.
+        :rtype: int
+
+        :raises LookupError: If the community with that name has another actor id, e.g. a local one with the name of a remote community.
+
+        """
+        name = actor_id.rstrip("/").rsplit("/", 1)[-1]
+        response = await self.request_builder.get("community", params={"name": name})
+        community = response["community_view"]["community"]
+        if community["actor_id"] != actor_id:
+            raise LookupError(f"The community named {name} is {community['actor_id']}, not {actor_id}")
+        return int(community["id"])
+
+    async def stream_inbox(self, *, limit: int = 50) -> AsyncIterator[Comment | PrivateMessage]:
+        """Asynchronously stream the unread mentions, comment replies and private messages of the logged in user, oldest first.
+
+        The unread flag is the cursor, so items that arrived while the bot was down are still streamed. Every item is marked as read after it
+        was yielded, the marks of one poll are sent together once all of its items were yielded. Items whose mark failed stay unread on the server but
+        are remembered here, so they aren't yielded twice.
+
+        :param limit: The number of unread items fetched per kind and poll.
+
+        :yields: A Comment for mentions and replies, a PrivateMessage for private messages.
+
+        """
+        exponential_counter = ExponentialCounter(max_counter=16)
+        yielded: Cache[tuple[str, int], None] = Cache(maxsize=limit * 12)
+        params = {"sort": "New", "unread_only": "true", "page": 1, "limit": limit}
+
+        while True:
+            mentions, replies, private_messages = await asyncio.gather(
+                self.request_builder.get("user/mention", params=params),
+                self.request_builder.get("user/replies", params=params),
+                self.request_builder.get("private_message/list", params={"unread_only": "true", "page": 1, "limit": limit}),
+            )
+            items: list[tuple[datetime, Comment | PrivateMessage]] = []
+            marks: list[tuple[str, dict[str, Any]]] = []
+
+            for views, record_key, mark_endpoint, mark_key in (
+                (mentions.get("mentions", []), "person_mention", "user/mention/mark_as_read", "person_mention_id"),
+                (replies.get("replies", []), "comment_reply", "comment/mark_as_read", "comment_reply_id"),
+            ):
+                for view in views:
+                    record_id = view[record_key]["id"]
+                    if (record_key, record_id) in yielded:
+                        continue
+                    yielded.update({(record_key, record_id): None})
+                    comment = Comment.from_dict(comment_view=view, request_builder=self.request_builder)
+                    items.append((comment.published, comment))
+                    marks.append((mark_endpoint, {mark_key: record_id, "read": True}))
+
+            for view in private_messages.get("private_messages", []):
+                private_message = PrivateMessage.from_dict(private_message_view=view, request_builder=self.request_builder)
+                key = ("private_message", private_message.private_message_id)
+                # The list also holds the messages sent by this user
+                if key in yielded or (private_message.user.name == self.request_builder.username and private_message.user.local):
+                    continue
+                yielded.update({key: None})
+                items.append((private_message.published, private_message))
+                marks.append(("private_message/mark_as_read", {"private_message_id": private_message.private_message_id, "read": True}))
+
+            for _, item in sorted(items, key=lambda published_item: published_item[0]):
+                yield item
+
+            if marks:
+                results = await asyncio.gather(*(self.request_builder.post(endpoint, json=payload) for endpoint, payload in marks), return_exceptions=True)
+                if failed := sum(isinstance(result, Exception) for result in results):
+                    self._async_lemmy_logger.warning("Could not mark %s of %s inbox items as read", failed, len(marks))
+                exponential_counter.reset()
+            else:
+                sleep_time = exponential_counter.counter()
+                self._async_lemmy_logger.debug("Inbox empty, sleeping for %s seconds.", sleep_time)
                 await asyncio.sleep(sleep_time)
 
 
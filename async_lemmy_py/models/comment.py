@@ -19,6 +19,7 @@ class Comment:
         comment_dict: dict[str, Any],
     ) -> None:
         self.request_builder = request_builder
+        self._comment_view = {"comment": comment_dict, "post": post, "community": community, "creator": user}
         self.post: Post = Post.from_dict(post_view={"post": post, "community": community, "creator": user}, request_builder=request_builder)
         self.community: Community = Community.from_dict(community)
         self.user: User = User.from_dict(user)
@@ -54,6 +55,15 @@ class Comment:
             comment_dict=comment_dict,
         )
 
+    def to_dict(self) -> dict[str, Any]:
+        """Returns the comment view this comment was built from, e.g. to rebuild it in another process with from_dict.
+
+        :returns: comment view with the comment, post, community and creator
+        :rtype: dict[str, Any]
+
+        """
+        return self._comment_view
+
     async def parent(self) -> Self | Post:
         parent_ids = self.path.split(".")
         parent_id = int(parent_ids[-2])
@@ -0,0 +1,47 @@
+from datetime import datetime
+from typing import Any, Self
+
+from async_lemmy_py.models.user import User
+from async_lemmy_py.request_builder import RequestBuilder
+
+
+class PrivateMessage:
+    """Represents a private message."""
+
+    def __init__(self, request_builder: RequestBuilder, creator: dict[str, Any], recipient: dict[str, Any], private_message_dict: dict[str, Any]) -> None:
+        self.request_builder = request_builder
+        self.user: User = User.from_dict(creator)
+        self.recipient: User = User.from_dict(recipient)
+
+        self.ap_id: str = private_message_dict.get("ap_id", "")
+        self.content: str = private_message_dict.get("content", "")
+        self.creator_id: int = private_message_dict.get("creator_id", -1)
+        self.deleted: bool = private_message_dict.get("deleted", False)
+        self.local: bool = private_message_dict.get("local", False)
+        self.private_message_id: int = private_message_dict.get("id", -1)
+        self.published: datetime = datetime.fromisoformat(private_message_dict.get("published", "1970-01-01T00:00:00Z"))
+        self.read: bool = private_message_dict.get("read", False)
+        self.recipient_id: int = private_message_dict.get("recipient_id", -1)
+        self.updated: datetime = datetime.fromisoformat(private_message_dict.get("updated", "1970-01-01T00:00:00Z"))
+
+    @classmethod
+    def from_dict(cls, *, private_message_view: dict[str, Any], request_builder: RequestBuilder) -> Self:
+        """Create a PrivateMessage instance from a private message view.
+
+        :param dict private_message_view: The dictionary containing the message, its creator and its recipient.
+        :param RequestBuilder request_builder: An instance of the RequestBuilder.
+
+        :returns: An instance of the PrivateMessage class.
+        :rtype: PrivateMessage
+
+        """
+        return cls(
+            request_builder=request_builder,
+            creator=private_message_view["creator"],
+            recipient=private_message_view["recipient"],
+            private_message_dict=private_message_view["private_message"],
+        )
+
+    async def reply(self, response: str) -> None:
+        """Answers with a new private message to the creator, private messages have no threads."""
+        await self.request_builder.post("private_message", json={"content": response, "recipient_id": self.creator_id})
@@ -4,6 +4,8 @@ from typing import Optional, Self, Any
 
 from aiohttp import ClientSession
 
+from async_lemmy_py.single_flight import SingleFlight
+
 
 @define
 class UserFlair:
@@ -14,6 +16,10 @@ class UserFlair:
     path: str
 
 
+# The flairs of the users being looked up right now, several based replies to the same user fetch it at the same moment
+flair_requests: SingleFlight[Optional[UserFlair]] = SingleFlight()
+
+
 class User:
     def __init__(self, user: dict[str, Any]):
         self.actor_id = user.get("actor_id", "")
@@ -47,6 +53,9 @@ class User:
         :rtype: Awaitable[Optional[UserFlair]]
 
         """
+        return await flair_requests.do(self.actor_id.lower(), self._fetch_flair)
+
+    async def _fetch_flair(self) -> Optional[UserFlair]:
         async with ClientSession() as session:
             params = {"community_actor_id": "https://lemmy.basedcount.com/c/pcm", "user_actor_id": self.actor_id}
             async with session.get("https://lemmy.basedcount.com/flair/api/v1/user", params=params) as resp:
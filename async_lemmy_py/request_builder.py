@@ -1,7 +1,13 @@
-from typing import Optional, Any
+from time import perf_counter
+from typing import Optional, Any, Callable
 
 from aiohttp import ClientResponse, ClientResponseError, ClientSession
 
+from async_lemmy_py.single_flight import SingleFlight
+
+# Called with the HTTP method, endpoint, response status (0 if there was no response) and duration in seconds of every request
+RequestObserver = Callable[[str, str, int, float], None]
+
 
 class RequestBuilder:
     def __init__(self, base_url: str, username: str, password: str) -> None:
@@ -16,6 +22,9 @@ class RequestBuilder:
         self.username: str = username
         self.password: str = password
         self.jwt_token: Optional[str] = None
+        self.request_observers: list[RequestObserver] = []
+        # Identical GETs made while one is in flight share its response, only callers running at the same time can share one
+        self.in_flight_gets: SingleFlight[dict[Any, Any]] = SingleFlight()
 
         # Initialize aiohttp ClientSession with default headers
         self.client_session: ClientSession = ClientSession(headers={"accept": "application/json", "content-type": "application/json"})
@@ -36,26 +45,35 @@ class RequestBuilder:
         await self.client_session.close()
 
     async def get(self, endpoint: str, params: Optional[dict[Any, Any]] = None) -> dict[Any, Any]:
-        """Perform an HTTP GET request.
+        """Perform an HTTP GET request, or wait for the identical one already in flight and share its response.
 
         If jwt_token is None, it will first call get_jwt_token to obtain the token.
 
         :param endpoint: The API endpoint to send the GET request to.
         :param params: Optional query parameters.
 
-        :returns: JSON response from the server.
+        :returns: JSON response from the server, shared with the other callers of the same request so it must not be modified.
 
         :raises: If the HTTP response status code indicates an error (not in the 2xx range).
 
         """
+        key = (endpoint, tuple(sorted((params or {}).items())))
+        return await self.in_flight_gets.do(key, lambda: self._get(endpoint, params))
+
+    async def _get(self, endpoint: str, params: Optional[dict[Any, Any]]) -> dict[Any, Any]:
         if self.jwt_token is None:
             await self.get_jwt_token()
 
         url: str = f"{self.base_url}/api/v3/{endpoint}"
         headers = {"Authorization": f"Bearer {self.jwt_token}"}
 
-        async with self.client_session.get(url, headers=headers, params=params) as resp:
-            return await self._handle_response(resp)
+        started, status = perf_counter(), 0
+        try:
+            async with self.client_session.get(url, headers=headers, params=params) as resp:
+                status = resp.status
+                return await self._handle_response(resp)
+        finally:
+            self._notify_observers("GET", endpoint, status, perf_counter() - started)
 
     async def post(
         self, endpoint: str, params: Optional[dict[Any, Any]] = None, data: Optional[dict[Any, Any]] = None, json: Optional[dict[Any, Any]] = None
@@ -75,8 +93,25 @@ class RequestBuilder:
         url: str = f"{self.base_url}/api/v3/{endpoint}"
         headers = {"Authorization": f"Bearer {self.jwt_token}"}
 
-        async with self.client_session.post(url, headers=headers, params=params, data=data, json=json) as resp:
-            return await self._handle_response(resp)
+        started, status = perf_counter(), 0
+        try:
+            async with self.client_session.post(url, headers=headers, params=params, data=data, json=json) as resp:
+                status = resp.status
+                return await self._handle_response(resp)
+        finally:
+            self._notify_observers("POST", endpoint, status, perf_counter() - started)
+
+    def _notify_observers(self, method: str, endpoint: str, status: int, seconds: float) -> None:
+        """Passes the outcome of a request to every registered request observer.
+
+        :param method: The HTTP method.
+        :param endpoint: The API endpoint of the request.
+        :param status: The response status, 0 if no response was received.
+        :param seconds: How long the request took.
+
+        """
+        for observer in self.request_observers:
+            observer(method, endpoint, status, seconds)
 
     async def _handle_response(self, resp: ClientResponse) -> dict[Any, Any]:
         """Handle the response from the server.
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Coalesces identical concurrent calls: while a call for a key is in flight, the same key waits for it instead of starting another one.
+
+    The call runs in its own task, so a caller being cancelled doesn't cancel it for the others, it is only cancelled once every caller waiting
+    for it was. Every caller gets the same result, which must therefore not be modified, or the same exception.
+
+    :var int saved: The number of calls that were served by a call already in flight.
+
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future[T]] = {}
+        self._waiters: dict[Hashable, int] = {}
+        self.saved = 0
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        """Run the function, or wait for the call of the same key already in flight.
+
+        :param key: Identifies identical calls.
+        :param function: Starts the call, only called when no call of the key is in flight.
+
+        :returns: The result of the call.
+
+        :raises: Whatever the call raised.
+
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.saved += 1
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters[key] == 1:
+                task.cancel()
+            raise
+        finally:
+            if self._calls.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _finished(self, key: Hashable, task: asyncio.Future[T]) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+        # Retrieve the exception so a call whose callers were all cancelled isn't reported as never retrieved
+        if not task.cancelled():
+            task.exception()
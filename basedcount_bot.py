@@ -3,38 +3,101 @@ from __future__ import annotations
 
 import asyncio
 import re
-from os import getenv
-from time import sleep
-from traceback import format_exc
-from typing import Awaitable, Callable, NamedTuple, Optional
-
-import aiofiles
-from aiohttp import ClientResponseError
+import signal
+from multiprocessing import Queue
+from os import getenv, sysconf
+from pathlib import Path
+from time import monotonic, time
+from typing import Any, Callable, Coroutine, NamedTuple, Optional
+
+from aiohttp import ClientError, ClientResponseError, web
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from yaml import safe_load
 
+from admin import add_admin_routes, install_signal_handlers
 from async_lemmy_py import AsyncLemmyPy
 from async_lemmy_py.models.comment import Comment
 from async_lemmy_py.models.post import Post
-from async_lemmy_py.models.user import UserFlair
-from bot_commands import get_based_count, most_based, based_and_pilled, my_compass, remove_pill, add_to_based_history, set_subscription, check_unsubscribed
+from async_lemmy_py.models.private_message import PrivateMessage
+from async_lemmy_py.models.user import UserFlair, flair_requests
+from bot_commands import (
+    get_based_count,
+    most_based,
+    based_and_pilled,
+    my_compass,
+    remove_pill,
+    add_to_based_history,
+    report_cheating,
+    set_subscription,
+    check_unsubscribed,
+    load_unsubscribed_users,
+    sync_unsubscribed_users,
+)
+from cheating_detector import cheating_detector
+from config_store import config_store, watch_config
+from database_indexes import ensure_indexes, verify_query_plans
+from error_reporter import error_reporter
+from leaderboard import maintain_leaderboard, persist_leaderboard, seed_leaderboard
+from loop_watchdog import loop_watchdog, sd_notify
+from metrics import (
+    BACKGROUND_TASKS,
+    BACKOFF_SECONDS,
+    BASES_AWARDED,
+    COMMANDS,
+    COMMENTS_SEEN,
+    INBOX_ITEMS,
+    END_TO_END_SECONDS,
+    ERRORS,
+    FLAIR_SECONDS,
+    PARENT_INFO_SECONDS,
+    REPLY_SECONDS,
+    REQUESTS_COALESCED,
+    STARTUP_SECONDS,
+    observe_lemmy_request,
+    start_metrics_server,
+)
+from models.replies import bot_replies
+from mongo_profile import mongo_profile
+from partitions import partition_manager
+from pg_ingest import pg_comment_source
+from reply_cache import reply_cache
+from scheduler import Priority, scheduler
+from throttle import Verdict, command_throttle
+from tracing import span, start_trace, tracer
 from utility_functions import (
     create_logger,
     get_databased,
-    send_traceback_to_discord,
+    setup_logging,
 )
+from workers import WorkItem, WorkerPool
 
 load_dotenv()
 
-
-def exception_wrapper(func: Callable[[AsyncLemmyPy, AsyncIOMotorDatabase], Awaitable[None]]) -> Callable[[AsyncLemmyPy, AsyncIOMotorDatabase], Awaitable[None]]:
+MODULE_LOADED_AT = monotonic()
+cool_down_timer = 0
+main_logger = create_logger(logger_name="basedcount_bot", set_format=True)
+background_tasks: set[asyncio.Task[None]] = set()
+# Set in the ingest process when BOT_WORKERS > 0, comments are then handled by the worker processes
+worker_pool: Optional[WorkerPool] = None
+# Set in the worker processes, the ingest process feeds the cheating detector for them
+in_worker_process = False
+# Based comments whose parent the ingest process resolves at the same time before routing them to a worker
+dispatch_slots = asyncio.Semaphore(int(getenv("DISPATCH_CONCURRENCY", "8")))
+# Concurrent pings at startup, each one opens a pooled connection so the first comments don't wait for the TLS handshakes
+MONGO_WARM_CONNECTIONS = int(getenv("MONGO_WARM_CONNECTIONS", "4"))
+# Seconds a stop has to finish the queued comments and pending writes, keep it below the service's TimeoutStopSec
+SHUTDOWN_DEADLINE = float(getenv("SHUTDOWN_DEADLINE_SECONDS", "20"))
+
+
+def exception_wrapper(
+    func: Callable[[AsyncLemmyPy, AsyncIOMotorDatabase], Coroutine[Any, Any, None]],
+) -> Callable[[AsyncLemmyPy, AsyncIOMotorDatabase], Coroutine[Any, Any, None]]:
     """Decorator to handle the exceptions and to ensure the code doesn't exit unexpectedly.
 
     :param func: function that needs to be called
 
     :returns: wrapper function
-    :rtype: Callable[[Reddit, AsyncIOMotorDatabase], Awaitable[None]]
+    :rtype: Callable[[Reddit, AsyncIOMotorDatabase], Coroutine[Any, Any, None]]
 
     """
 
@@ -46,25 +109,51 @@ def exception_wrapper(func: Callable[[AsyncLemmyPy, AsyncIOMotorDatabase], Await
                 await func(lemmy_instance, databased)
             except ClientResponseError as response_err_exc:
                 main_logger.exception("AsyncLemmyPyExpection", exc_info=True)
-                await send_traceback_to_discord(
-                    exception_name=type(response_err_exc).__name__, exception_message=str(response_err_exc), exception_body=format_exc()
-                )
+                error_reporter.report(response_err_exc)
 
-                sleep(cool_down_timer)
+                await asyncio.sleep(cool_down_timer)
                 cool_down_timer = (cool_down_timer + 30) % 360
-                main_logger.info(f"Cooldown: {cool_down_timer} seconds")
+                main_logger.info("Cooldown: %s seconds", cool_down_timer)
             except Exception as general_exc:
                 main_logger.critical("Serious Exception", exc_info=True)
-                await send_traceback_to_discord(exception_name=type(general_exc).__name__, exception_message=str(general_exc), exception_body=format_exc())
+                error_reporter.report(general_exc)
 
-                sleep(cool_down_timer)
+                await asyncio.sleep(cool_down_timer)
                 cool_down_timer = (cool_down_timer + 30) % 360
-                main_logger.info(f"Cooldown: {cool_down_timer} seconds")
+                main_logger.info("Cooldown: %s seconds", cool_down_timer)
 
     return wrapper
 
 
-async def bot_commands(command: Comment, command_body_lower: str, databased: AsyncIOMotorDatabase) -> None:
+PCM_ACTOR_ID = "https://lemmy.basedcount.com/c/pcm"
+BOT_COMMANDS = ("/info", "/mybasedcount", "/basedcount", "/mostbased", "/removepill", "/mycompass", "/unsubscribe", "/subscribe")
+COMMAND_PRIORITIES = {
+    "/info": Priority.INFORMATIONAL,
+    "/mybasedcount": Priority.READ_ONLY,
+    "/basedcount": Priority.READ_ONLY,
+    "/mostbased": Priority.READ_ONLY,
+    "/removepill": Priority.COUNT_CHANGING,
+    "/mycompass": Priority.COUNT_CHANGING,
+    "/unsubscribe": Priority.COUNT_CHANGING,
+    "/subscribe": Priority.COUNT_CHANGING,
+}
+
+
+async def reply(comment: Comment | PrivateMessage, message: str) -> None:
+    """Replies to the comment and records the reply latency and how long after the comment was published the reply went out.
+
+    :param comment: Comment being replied to
+    :param message: Body of the reply
+
+    :returns: None
+
+    """
+    with REPLY_SECONDS.time(), span("reply"):
+        await comment.reply(message)
+    END_TO_END_SECONDS.observe(time() - comment.published.timestamp())
+
+
+async def bot_commands(command: Comment | PrivateMessage, command_body_lower: str, databased: AsyncIOMotorDatabase) -> None:
     """Responsible for the basic based count bot commands
 
     :param command: Lemmy post that triggered the command, could be a message or comment
@@ -76,40 +165,41 @@ async def bot_commands(command: Comment, command_body_lower: str, databased: Asy
     """
 
     if command_body_lower.startswith("/"):
-        main_logger.info(f"Received {type(command).__name__} from {command.user.actor_id}, {command_body_lower!r}")
+        main_logger.info("Received %s from %s, %.200r", type(command).__name__, command.user.actor_id, command_body_lower)
+        if (command_name := match_command(command_body_lower)) is not None:
+            COMMANDS.inc(command=command_name)
 
     if command_body_lower.startswith("/info"):
-        async with aiofiles.open("data_dictionaries/bot_replies.yaml", "r") as fp:
-            replies = safe_load(await fp.read())
-            await command.reply(replies.get("info_message"))
+        await reply(command, bot_replies().info_message)
 
     elif command_body_lower.startswith("/mybasedcount"):
         my_based_count = await get_based_count(user_actor_id=command.user.actor_id, is_me=True, databased=databased)
-        await command.reply(my_based_count)
+        await reply(command, my_based_count)
 
     elif command_body_lower.startswith("/basedcount"):
         user_name = command_body_lower.split(" ", maxsplit=2)[1]
         user_based_count = await get_based_count(user_actor_id=user_name, is_me=False, databased=databased)
-        await command.reply(user_based_count)
+        await reply(command, user_based_count)
 
     elif command_body_lower.startswith("/mostbased"):
-        await command.reply(await most_based())
+        flair = command_body_lower.splitlines()[0].removeprefix("/mostbased").strip() or None
+        await reply(command, await most_based(flair=flair))
 
     elif command_body_lower.startswith("/removepill"):
         response = await remove_pill(user_actor_id=command.user.actor_id, pill=command_body_lower.replace("/removepill ", ""), databased=databased)
-        await command.reply(response)
+        await reply(command, response)
 
     elif command_body_lower.startswith("/mycompass"):
         response = await my_compass(user_actor_id=command.user.actor_id, compass=command_body_lower.replace("/mycompass ", ""), databased=databased)
-        await command.reply(response)
+        await reply(command, response)
 
     elif command_body_lower.startswith("/unsubscribe"):
         response = await set_subscription(subscribe=False, user_actor_id=command.user.actor_id, databased=databased)
-        await command.reply(response)
+        await reply(command, response)
 
     elif command_body_lower.startswith("/subscribe"):
         response = await set_subscription(subscribe=True, user_actor_id=command.user.actor_id, databased=databased)
-        await command.reply(response)
+        await reply(command, response)
 
 
 BASED_VARIATION = (
@@ -150,6 +240,33 @@ BASED_VARIATION = (
 
 BASED_REGEX = re.compile(f"({'|'.join(BASED_VARIATION)})\\b(?!\\s*(on|off))", re.IGNORECASE)
 PILL_REGEX = re.compile("(?<=(and|but))(.+)pilled", re.IGNORECASE)
+BOT_ACTOR_ID = "https://lemmy.basedcount.com/u/basedcount_bot"
+
+
+def is_self_based(author_actor_id: str, parent_actor_id: str) -> bool:
+    """Whether the based goes to its own author or to the bot, neither counts."""
+    return parent_actor_id.lower() in [author_actor_id.lower(), BOT_ACTOR_ID]
+
+
+def is_low_effort_parent(parent_body_lower: str) -> bool:
+    """Whether the parent is itself a short based, people giving each other low effort based doesn't count."""
+    return parent_body_lower.startswith(BASED_VARIATION) and len(parent_body_lower) < 50
+
+
+def extract_pill(comment_body_lower: str) -> Optional[str]:
+    """Pill name of a based comment, from "based and x pilled" on its first non-empty line.
+
+    :param comment_body_lower: lowercased body of the based comment
+
+    :returns: the pill name, None when the comment names no pill or one that is too long
+
+    """
+    first_non_empty_line = next(line for line in comment_body_lower.splitlines() if line)
+    if pill_match := re.search(PILL_REGEX, first_non_empty_line):
+        clean_pill = pill_match.group(2).strip(" -")  # strips both space and - character
+        if 70 > len(clean_pill) > 0:
+            return clean_pill
+    return None
 
 
 async def is_valid_comment(comment: Comment, parent_info: ParentInfo, databased: AsyncIOMotorDatabase) -> bool:
@@ -162,8 +279,10 @@ async def is_valid_comment(comment: Comment, parent_info: ParentInfo, databased:
     :returns: True if checks passed and False if checks failed
 
     """
-    main_logger.info(f"Based Comment: {comment.content!r} from: {comment.user.actor_id} to: {parent_info.parent_actor_id} <{parent_info.parent_flair}>")
-    if parent_info.parent_actor_id.lower() in [comment.user.actor_id.lower(), "https://lemmy.basedcount.com/u/basedcount_bot"]:
+    main_logger.info(
+        "Based Comment: %.200r from: %s to: %s <%s>", comment.content, comment.user.actor_id, parent_info.parent_actor_id, parent_info.parent_flair
+    )
+    if is_self_based(comment.user.actor_id, parent_info.parent_actor_id):
         main_logger.info("Checks failed, self based or giving basedcount_bot based.")
         return False
 
@@ -173,19 +292,39 @@ async def is_valid_comment(comment: Comment, parent_info: ParentInfo, databased:
         return True
 
     # Check if people aren't just giving each other low effort based
-    if parent_info.parent_body.startswith(BASED_VARIATION) and len(parent_info.parent_body) < 50:
+    if is_low_effort_parent(parent_info.parent_body):
         main_logger.info("Checks failed, parent comment starts with based and is less than 50 chars long")
         return False
 
     # fire and forget background tasks
     task = asyncio.create_task(
-        add_to_based_history(user_actor_id=comment.user.actor_id, parent_author_actor_id=parent_info.parent_actor_id, databased=databased)
+        add_to_based_history(user_actor_id=comment.user.actor_id, parent_author_actor_id=parent_info.parent_actor_id, databased=databased),
+        name=f"add_to_based_history {comment.ap_id}",
     )
     background_tasks.add(task)
     task.add_done_callback(background_tasks.discard)
+
+    if not in_worker_process:
+        watch_for_cheating(comment, parent_info, databased)
     return True
 
 
+def watch_for_cheating(comment: Comment, parent_info: ParentInfo, databased: AsyncIOMotorDatabase) -> None:
+    """Feeds a based that passed the checks to the cheating detector and files its reports in the background.
+
+    :param comment: the based comment
+    :param parent_info: The parent comment/post info.
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    if cheating_reports := cheating_detector.observe(comment.user.actor_id, parent_info.parent_actor_id):
+        task = asyncio.create_task(report_cheating(cheating_reports, databased=databased), name=f"report_cheating {comment.ap_id}")
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
 class ParentInfo(NamedTuple):
     parent_actor_id: str
     parent_body: str
@@ -201,11 +340,18 @@ async def get_parent_info(comment: Comment | Post) -> ParentInfo:
     :returns: dict with all the information such as author name and content
 
     """
-    parent_post = await comment.parent()
-    parent_actor_id = parent_post.user.actor_id
-    parent_body = "submission" if isinstance(parent_post, Post) else parent_post.content.lower()
-    parent_flair = await parent_post.user.get_flair()
-    link = parent_post.ap_id
+    with PARENT_INFO_SECONDS.time():
+        with span("parent"):
+            parent_post = await comment.parent()
+        parent_actor_id = parent_post.user.actor_id
+        parent_body = "submission" if isinstance(parent_post, Post) else parent_post.content.lower()
+        try:
+            with FLAIR_SECONDS.time(), span("get_flair"):
+                parent_flair = await parent_post.user.get_flair()
+        except ClientError:
+            ERRORS.inc(dependency="flair")
+            raise
+        link = parent_post.ap_id
     return ParentInfo(
         parent_actor_id=parent_actor_id,
         parent_body=parent_body,
@@ -224,62 +370,546 @@ async def read_comments(lemmy_instance: AsyncLemmyPy, databased: AsyncIOMotorDat
     :returns: Nothing is returned
 
     """
-    main_logger.info(f"Logged into {lemmy_instance.request_builder.username} Account.")
-    async for comment in lemmy_instance.stream_comments(skip_existing=True):  # Comment
+    main_logger.info("Logged into %s Account.", lemmy_instance.request_builder.username)
+    # Next to the instance comments are pushed by its database, polling stays as the fallback
+    comment_stream = pg_comment_source.stream(lemmy_instance) if pg_comment_source.enabled else lemmy_instance.stream_comments(skip_existing=True)
+    async for comment in comment_stream:  # Comment
         # Skips its own comments
-        if comment.user.actor_id == "https://lemmy.basedcount.com/u/basedcount_bot":
+        if comment.user.actor_id == BOT_ACTOR_ID:
+            continue
+        COMMENTS_SEEN.inc()
+        # Most comments are neither based nor commands, they aren't claimed, deferred or scheduled
+        if comment_priority(comment.content.lower()) is None:
+            continue
+        # With replicas, comments of the shards another replica owns are only kept in case it dies before handling them
+        if not partition_manager.owns(comment.comment_id):
+            partition_manager.defer(comment)
             continue
+        if not await partition_manager.claim(comment, databased):
+            continue
+        if worker_pool is not None:
+            await start_dispatch(comment, worker_pool, databased)
+            continue
+        await scheduler.wait_for_room()
+        schedule_comment(comment, databased)
+
+
+async def start_dispatch(comment: Comment, pool: WorkerPool, databased: AsyncIOMotorDatabase) -> None:
+    """Dispatches a comment in the background so the parents of several based comments are resolved at the same time.
+
+    Waits while DISPATCH_CONCURRENCY comments are being dispatched, which holds the stream back instead of piling up parent lookups.
+
+    :param comment: Comment from the pcm stream
+    :param pool: running worker processes
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
 
-        comment_body_lower = comment.content.lower()
-        if re.match(BASED_REGEX, comment_body_lower.replace("\n", "")):
+    """
+    await dispatch_slots.acquire()
+
+    async def dispatch() -> None:
+        try:
+            await dispatch_comment(comment, pool, databased)
+        except Exception as exc:
+            main_logger.exception("Dispatching %s failed", comment.ap_id)
+            error_reporter.report(exc)
+        finally:
+            dispatch_slots.release()
+
+    task = asyncio.create_task(dispatch(), name=f"dispatch {comment.ap_id}")
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def dispatch_comment(comment: Comment, pool: WorkerPool, databased: AsyncIOMotorDatabase) -> None:
+    """Sends a comment to a worker process. Based comments go to the worker of the user receiving the based, everything else to the author's.
+
+    The parent is resolved here since the worker is picked by the parent's author, the worker reuses it. A worker only sees the bases of its own
+    users, so the cheating detector, which needs both directions of a pair and every edge of a ring, is fed here instead. Commands go through
+    the throttle here, the workers only see the ones admitted.
+
+    :param comment: Comment from the pcm stream
+    :param pool: running worker processes
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    parent_info = None
+    route_actor_id = comment.user.actor_id
+    comment_body_lower = comment.content.lower()
+    if is_based_comment(comment_body_lower):
+        try:
+            parent_info = await get_parent_info(comment)
+        except ClientResponseError:
+            main_logger.warning("Parent Removed or Deleted")
+            return
+        route_actor_id = parent_info.parent_actor_id
+        # The checks is_valid_comment runs before feeding the detector, the unflaired are let through without it
+        if (
+            not is_self_based(comment.user.actor_id, parent_info.parent_actor_id)
+            and parent_info.parent_flair is not None
+            and not is_low_effort_parent(parent_info.parent_body)
+        ):
+            watch_for_cheating(comment, parent_info, databased)
+    elif command_priority(comment_body_lower) is None or not admit_command(comment):
+        return
+    await pool.submit(route_actor_id, WorkItem(comment_view=comment.to_dict(), parent_info=parent_info))
+
+
+@exception_wrapper
+async def replay_taken_over_comments(lemmy_instance: AsyncLemmyPy, databased: AsyncIOMotorDatabase) -> None:
+    """Handles the recent comments of shards this replica took over, the ones the previous owner already claimed are skipped.
+
+    :param lemmy_instance: The AsyncLemmyPy Instance. Used to make API calls.
+    :param databased: MongoDB database used to get the collections
+
+    :returns: Nothing is returned
+
+    """
+    while True:
+        comment = await partition_manager.replay_queue.get()
+        if comment_priority(comment.content.lower()) is not None and await partition_manager.claim(comment, databased):
+            main_logger.info("Handling %s from a shard taken over from another replica", comment.ap_id)
+            if worker_pool is not None:
+                await start_dispatch(comment, worker_pool, databased)
+                continue
+            await scheduler.wait_for_room()
+            schedule_comment(comment, databased, replayed=True)
+
+
+async def process_work_items(lemmy_instance: AsyncLemmyPy, databased: AsyncIOMotorDatabase, comment_queue: Queue[Optional[WorkItem]]) -> None:
+    """Worker process loop, schedules the comments the ingest process routed to this worker until it sends None.
+
+    :param lemmy_instance: The worker's AsyncLemmyPy Instance, replies go through its session
+    :param databased: The worker's MongoDB database
+    :param comment_queue: queue filled by the ingest process
+
+    :returns: None
+
+    """
+    while True:
+        # Waiting for room before taking the next item lets the queue fill up, which holds the ingest process back
+        await scheduler.wait_for_room()
+        if (item := await asyncio.to_thread(comment_queue.get)) is None:
+            return
+        comment = Comment.from_dict(comment_view=item.comment_view, request_builder=lemmy_instance.request_builder)
+        schedule_comment(comment, databased, item.parent_info, admitted=True)
+
+
+def is_based_comment(comment_body_lower: str) -> bool:
+    return re.match(BASED_REGEX, comment_body_lower.replace("\n", "")) is not None
+
+
+def comment_priority(comment_body_lower: str) -> Optional[Priority]:
+    """Priority class of a comment, based comments and commands that change counts go first.
+
+    :param comment_body_lower: lowercased body of the comment
+
+    :returns: the class, None when the bot has nothing to do with the comment
+
+    """
+    if is_based_comment(comment_body_lower):
+        return Priority.COUNT_CHANGING
+    return command_priority(comment_body_lower)
+
+
+def command_priority(command_body_lower: str) -> Optional[Priority]:
+    """Priority class of a bot command.
+
+    :param command_body_lower: lowercased body of the comment or private message
+
+    :returns: the class, None when it isn't one of BOT_COMMANDS, e.g. /s or /r/...
+
+    """
+    command_name = match_command(command_body_lower)
+    return None if command_name is None else COMMAND_PRIORITIES[command_name]
+
+
+def match_command(command_body_lower: str) -> Optional[str]:
+    """The command a comment or message starts with, matched by prefix like bot_commands does, so /info. or /mostbasedcentrist count too.
+
+    :param command_body_lower: lowercased body of the comment or private message
+
+    :returns: one of BOT_COMMANDS, None when it starts with none of them
+
+    """
+    return next((command for command in BOT_COMMANDS if command_body_lower.startswith(command)), None)
+
+
+def schedule_comment(
+    comment: Comment, databased: AsyncIOMotorDatabase, parent_info: Optional[ParentInfo] = None, admitted: bool = False, **trace_attributes: Any
+) -> None:
+    """Queues the handling of a comment in the scheduler by its priority class, comments that aren't commands or based are dropped here.
+
+    :param comment: Comment from the pcm stream
+    :param databased: MongoDB database used to get the collections
+    :param parent_info: parent of a based comment when it was already fetched
+    :param admitted: the command already went through admit_command, in the ingest process
+    :param trace_attributes: extra attributes of the comment's trace
+
+    :returns: None
+
+    """
+    comment_body_lower = comment.content.lower()
+    if (priority := comment_priority(comment_body_lower)) is None:
+        return
+    if not admitted and not is_based_comment(comment_body_lower) and not admit_command(comment):
+        return
+
+    submitted_at = monotonic()
+
+    async def job() -> None:
+        # Time spent in the scheduler queue, the trace only starts when a consumer picks the job up
+        queue_wait_seconds = round(monotonic() - submitted_at, 4)
+        with start_trace("comment", comment_id=comment.comment_id, author=comment.user.actor_id, queue_wait_seconds=queue_wait_seconds, **trace_attributes):
+            await handle_comment(comment, databased, parent_info)
+        await partition_manager.complete(comment.ap_id, databased)
+
+    scheduler.submit(priority, job, comment.ap_id)
+
+
+def admit_command(command: Comment | PrivateMessage) -> bool:
+    """Applies the per user and per post command limits, and queues the slow down reply for the first command of a user over the limit.
+
+    Runs in the ingest process, with workers too, so the comment and inbox commands of a user and the commands of a post share the limits.
+
+    :param command: comment or private message holding a command
+
+    :returns: True when the command may run
+
+    """
+    verdict = command_throttle.check(command.user.actor_id, command.post_id if isinstance(command, Comment) else None)
+    if verdict is Verdict.NOTIFY and not check_unsubscribed(command.user.actor_id):
+
+        async def slow_down() -> None:
+            await reply(command, bot_replies().slow_down_reply)
+
+        scheduler.submit(Priority.INFORMATIONAL, slow_down, f"slow down {command.ap_id}")
+    return verdict is Verdict.ALLOW
+
+
+async def handle_comment(comment: Comment, databased: AsyncIOMotorDatabase, parent_info: Optional[ParentInfo] = None) -> None:
+    """Awards based and pills or runs the bot command for a single comment.
+
+    :param comment: Comment from the pcm stream
+    :param databased: MongoDB database used to get the collections
+    :param parent_info: parent of a based comment when it was already fetched, it is fetched here when None
+
+    :returns: None
+
+    """
+    comment_body_lower = comment.content.lower()
+    if is_based_comment(comment_body_lower):
+        if parent_info is None:
             try:
-                parent_info = await get_parent_info(comment)
+                with span("get_parent_info"):
+                    parent_info = await get_parent_info(comment)
             except ClientResponseError:
-                main_logger.warn("Parent Removed or Deleted")
-                continue
-            # Skip Unflaired scums and low effort based
+                main_logger.warning("Parent Removed or Deleted")
+                return
+        # Skip Unflaired scums and low effort based
+        with span("is_valid_comment"):
             if not await is_valid_comment(comment, parent_info, databased=databased):
-                continue
-            main_logger.info("Checks passed")
-
-            pill = None
-            first_non_empty_line = next(line for line in comment_body_lower.splitlines() if line)
-            if pill_match := re.search(PILL_REGEX, first_non_empty_line):
-                clean_pill = pill_match.group(2).strip(" -")  # strips both space and - character
-                if 70 > len(clean_pill) > 0:
-                    pill = {
-                        "name": clean_pill,
-                        "commentID": comment.ap_id,
-                        "fromUser": comment.user.actor_id,
-                        "date": int(comment.published.timestamp()),
-                        "amount": 1,
-                    }
-
-            if parent_info.parent_flair is None:
-                parent_flair = "Unflaired"
-            else:
-                parent_flair = parent_info.parent_flair.display_name
-            reply_message = await based_and_pilled(parent_info.parent_actor_id, parent_flair, pill, databased=databased)
-            if reply_message is not None:
-                if await check_unsubscribed(parent_info.parent_actor_id, databased):
-                    continue
-                await comment.reply(reply_message)
+                return
+        main_logger.info("Checks passed")
+
+        pill = None
+        if (clean_pill := extract_pill(comment_body_lower)) is not None:
+            pill = {
+                "name": clean_pill,
+                "commentID": comment.ap_id,
+                "fromUser": comment.user.actor_id,
+                "date": int(comment.published.timestamp()),
+                "amount": 1,
+            }
+
+        if parent_info.parent_flair is None:
+            parent_flair = "Unflaired"
         else:
+            parent_flair = parent_info.parent_flair.display_name
+        with span("based_and_pilled", pilled=pill is not None):
+            reply_message = await based_and_pilled(parent_info.parent_actor_id, parent_flair, pill, databased=databased)
+        BASES_AWARDED.inc()
+        if reply_message is not None:
+            if check_unsubscribed(parent_info.parent_actor_id):
+                return
+            await reply(comment, reply_message)
+    else:
+        with span("bot_commands"):
             await bot_commands(comment, comment_body_lower, databased=databased)
 
 
+@exception_wrapper
+async def read_inbox(lemmy_instance: AsyncLemmyPy, databased: AsyncIOMotorDatabase) -> None:
+    """Runs the commands sent to the bot from anywhere on the instance, as mentions, replies to its comments or private messages.
+
+    Comments in pcm are skipped, the community stream already sees them.
+
+    :param lemmy_instance: The AsyncLemmyPy Instance. Used to make API calls.
+    :param databased: MongoDB database used to get the collections
+
+    :returns: Nothing is returned
+
+    """
+    async for item in lemmy_instance.stream_inbox():
+        if item.user.actor_id == BOT_ACTOR_ID:
+            continue
+        if isinstance(item, Comment) and item.community.actor_id == PCM_ACTOR_ID:
+            continue
+        INBOX_ITEMS.inc(kind=type(item).__name__)
+        command_body_lower = item.content.lower()
+        if (priority := command_priority(command_body_lower)) is None or not await partition_manager.claim(item, databased):
+            continue
+        if not admit_command(item):
+            continue
+        await scheduler.wait_for_room()
+
+        async def job(command: Comment | PrivateMessage = item, body_lower: str = command_body_lower, submitted_at: float = monotonic()) -> None:
+            queue_wait_seconds = round(monotonic() - submitted_at, 4)
+            with start_trace("inbox_command", ap_id=command.ap_id, author=command.user.actor_id, queue_wait_seconds=queue_wait_seconds):
+                await bot_commands(command, body_lower, databased=databased)
+            await partition_manager.complete(command.ap_id, databased)
+
+        scheduler.submit(priority, job, item.ap_id)
+
+
+def lemmy_client() -> AsyncLemmyPy:
+    return AsyncLemmyPy(base_url="https://lemmy.basedcount.com", username=getenv("LEMMY_USERNAME", "username"), password=getenv("LEMMY_PASSWORD", "pas"))
+
+
+def register_client_metrics(lemmy: AsyncLemmyPy) -> None:
+    """Exports the requests the client coalesced.
+
+    Lookups are only coalesced when they overlap: parents of based comments are resolved at the same time by the ingest process with
+    BOT_WORKERS, up to DISPATCH_CONCURRENCY at once, or by the scheduler with SCHEDULER_CONCURRENCY above 1. A single process with the default
+    SCHEDULER_CONCURRENCY of 1 resolves one parent at a time and coalesces next to nothing.
+
+    :param lemmy: client whose in-flight GETs are counted
+
+    :returns: None
+
+    """
+    REQUESTS_COALESCED.set_function(lambda: lemmy.request_builder.in_flight_gets.saved, kind="lemmy_get")
+    REQUESTS_COALESCED.set_function(lambda: flair_requests.saved, kind="flair")
+
+
+def configure_from_env() -> None:
+    """Settings shared by the ingest and the worker processes."""
+    scheduler.concurrency = int(getenv("SCHEDULER_CONCURRENCY", "1"))
+    tracer.configure(sample_rate=float(getenv("TRACE_SAMPLE_RATE", "0")), otlp_endpoint=getenv("TRACE_OTLP_ENDPOINT"))
+    error_reporter.digest_interval = int(getenv("ERROR_DIGEST_MINUTES", "15")) * 60
+    reply_cache.configure(
+        ttl=float(getenv("REPLY_CACHE_TTL_SECONDS", "60")),
+        maxsize=int(getenv("REPLY_CACHE_SIZE", "1024")),
+        # get_databased configured the profile, replies read from a secondary that missed a write must not be cached
+        settle_seconds=max(2, mongo_profile.max_staleness_seconds),
+    )
+    command_throttle.configure(
+        per_actor_limit=int(getenv("COMMANDS_PER_USER", "5")),
+        per_post_limit=int(getenv("COMMANDS_PER_POST", "20")),
+        window=float(getenv("COMMAND_WINDOW_SECONDS", "60")),
+    )
+
+
+def process_age() -> float:
+    """Seconds since the process started, the interpreter startup and the imports included.
+
+    :returns: seconds
+
+    """
+    try:
+        # Field 22 of /proc/self/stat is the start time in clock ticks since boot, the fields after the command name start at field 3
+        start_ticks = int(Path("/proc/self/stat").read_text().rsplit(")", 1)[1].split()[19])
+        uptime = float(Path("/proc/uptime").read_text().split()[0])
+    except (OSError, IndexError, ValueError):
+        # Not on Linux, count from the import of this module
+        return monotonic() - MODULE_LOADED_AT
+    return uptime - start_ticks / sysconf("SC_CLK_TCK")
+
+
+async def warm_up(lemmy: AsyncLemmyPy, databased: AsyncIOMotorDatabase, check_indexes: bool) -> None:
+    """Does the startup work concurrently before the stream starts, instead of one after another on the first comments.
+
+    Logs into Lemmy, opens MONGO_WARM_CONNECTIONS Mongo connections, checks the indexes, and loads the config files, the unsubscribed users
+    and the leaderboard. The config files are parsed in a thread, yaml is imported there too.
+
+    :param lemmy: client to log in with
+    :param databased: MongoDB database used to get the collections
+    :param check_indexes: create the missing indexes and check the query plans, only the ingest process does it
+
+    :returns: None
+
+    """
+    started = monotonic()
+
+    async def warm_up_mongo() -> None:
+        await asyncio.gather(*(databased.command("ping") for _ in range(MONGO_WARM_CONNECTIONS)))
+        if check_indexes:
+            await ensure_indexes(databased)
+            await verify_query_plans(databased)
+
+    await asyncio.gather(
+        # Replies are POSTs, which don't log in on their own
+        lemmy.request_builder.get_jwt_token(),
+        warm_up_mongo(),
+        asyncio.to_thread(config_store.reload_changed),
+        load_unsubscribed_users(databased),
+        seed_leaderboard(databased),
+    )
+    STARTUP_SECONDS.set(process_age(), phase="warm_up")
+    main_logger.info("Warmed up in %.2f seconds", monotonic() - started)
+
+
+async def report_first_poll() -> None:
+    await loop_watchdog.stream_started.wait()
+    STARTUP_SECONDS.set(age := process_age(), phase="first_poll")
+    main_logger.info("First poll %.2f seconds after the process started", age)
+
+
+async def finish_pending_work(deadline: float) -> None:
+    """Lets the scheduled comments and the fire and forget writes finish, whatever is left at the deadline is dropped.
+
+    :param deadline: monotonic time to give up at
+
+    :returns: None
+
+    """
+    await scheduler.drain(max(deadline - monotonic(), 0))
+    if background_tasks:
+        _, pending = await asyncio.wait(set(background_tasks), timeout=max(deadline - monotonic(), 0))
+        if pending:
+            main_logger.error("Cancelling %d background tasks still running at the shutdown deadline", len(pending))
+            for task in pending:
+                task.cancel()
+
+
+async def stop_tasks(tasks: list[asyncio.Task[Any]]) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def worker_main(index: int, comment_queue: Queue[Optional[WorkItem]]) -> None:
+    """Runs a worker process with its own Mongo client, Lemmy session and metrics port (METRICS_PORT + 1 + index).
+
+    :param index: worker index
+    :param comment_queue: queue filled by the ingest process
+
+    :returns: None
+
+    """
+    global in_worker_process
+    in_worker_process = True
+    async with get_databased() as databased, lemmy_client() as lemmy:
+        configure_from_env()
+        # Only to mark the claims of the ingest process completed, the worker holds no leases
+        partition_manager.configure(shards=int(getenv("BOT_REPLICA_SHARDS", "0")), replica_id=getenv("BOT_REPLICA_ID"))
+        BACKGROUND_TASKS.set_function(lambda: len(background_tasks))
+        register_client_metrics(lemmy)
+        metrics_runner = await start_metrics_server("127.0.0.1", int(getenv("METRICS_PORT", "9464")) + 1 + index)
+        await warm_up(lemmy, databased, check_indexes=False)
+        scheduler.start()
+        loops = [
+            asyncio.create_task(error_reporter.run()),
+            asyncio.create_task(sync_unsubscribed_users(databased)),
+            asyncio.create_task(watch_config()),
+            # Each worker only records the bases of its own users, reseed often so /mostbased includes the others
+            asyncio.create_task(maintain_leaderboard(databased, persist=False, reseed_interval=60)),
+        ]
+        main_logger.info("Worker %d ready", index)
+        try:
+            await process_work_items(lemmy, databased, comment_queue)
+            await finish_pending_work(monotonic() + SHUTDOWN_DEADLINE)
+        finally:
+            await stop_tasks(loops)
+            await metrics_runner.cleanup()
+            if tracer.exporter is not None:
+                tracer.exporter.close()
+
+
 async def main() -> None:
-    async with (
-        get_databased() as databased,
-        AsyncLemmyPy(base_url="https://lemmy.basedcount.com", username=getenv("LEMMY_USERNAME", "username"), password=getenv("LEMMY_PASSWORD", "pas")) as lemmy,
-    ):
-        await asyncio.gather(
-            read_comments(lemmy, databased),
-        )
+    global worker_pool
+    STARTUP_SECONDS.set(process_age(), phase="imports")
+    async with get_databased() as databased, lemmy_client() as lemmy:
+        configure_from_env()
+        partition_manager.configure(shards=int(getenv("BOT_REPLICA_SHARDS", "0")), replica_id=getenv("BOT_REPLICA_ID"))
+        pg_comment_source.configure(dsn=getenv("LEMMY_DATABASE_URL"), community_actor_id=PCM_ACTOR_ID)
+        lemmy.request_builder.request_observers.append(observe_lemmy_request)
+        lemmy.request_builder.request_observers.append(loop_watchdog.stream_progress)
+        BACKOFF_SECONDS.set_function(lambda: lemmy.poll_interval, kind="poll")
+        BACKOFF_SECONDS.set_function(lambda: cool_down_timer, kind="cooldown")
+        BACKGROUND_TASKS.set_function(lambda: len(background_tasks))
+        register_client_metrics(lemmy)
+        metrics_app = web.Application()
+        add_admin_routes(metrics_app)
+        metrics_runner = await start_metrics_server("127.0.0.1", int(getenv("METRICS_PORT", "9464")), metrics_app)
+        loop = asyncio.get_running_loop()
+        install_signal_handlers(loop)
+        stop_requested = asyncio.Event()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(stop_signal, stop_requested.set)
+
+        # Workers import and warm up in their own processes while this one does
+        if (worker_count := int(getenv("BOT_WORKERS", "0"))) > 0:
+            worker_pool = WorkerPool(size=worker_count)
+            worker_pool.start()
+        await warm_up(lemmy, databased, check_indexes=True)
+        if partition_manager.enabled:
+            await partition_manager.rebalance(databased)
+        persist = getenv("PERSIST_LEADERBOARD", "false").lower() == "true"
+        scheduler.start()
+        loop_watchdog.start()
+        sd_notify("READY=1\nSTATUS=Reading comments")
+        ingest = [
+            asyncio.create_task(read_comments(lemmy, databased), name="read_comments"),
+            asyncio.create_task(replay_taken_over_comments(lemmy, databased), name="replay_taken_over_comments"),
+        ]
+        if getenv("READ_INBOX", "false").lower() == "true":
+            ingest.append(asyncio.create_task(read_inbox(lemmy, databased), name="read_inbox"))
+        loops = [
+            asyncio.create_task(loop_watchdog.sample_lag(), name="sample_lag"),
+            asyncio.create_task(error_reporter.run(), name="error_reporter"),
+            asyncio.create_task(sync_unsubscribed_users(databased), name="sync_unsubscribed_users"),
+            asyncio.create_task(watch_config(), name="watch_config"),
+            asyncio.create_task(
+                maintain_leaderboard(
+                    databased,
+                    persist=persist,
+                    # Every replica only records the bases it handles itself, reseed often so /mostbased includes the others
+                    reseed_interval=60 if partition_manager.enabled else 1800,
+                ),
+                name="maintain_leaderboard",
+            ),
+        ]
+        # Without shards there are no leases to keep and maintain returns right away, which would count as a loop exiting
+        if partition_manager.enabled:
+            loops.append(asyncio.create_task(partition_manager.maintain(databased), name="partition_maintain"))
+        stop_waiter = asyncio.create_task(stop_requested.wait(), name="stop_requested")
+        first_poll_reporter = asyncio.create_task(report_first_poll(), name="report_first_poll")
+        try:
+            done, _ = await asyncio.wait([stop_waiter, *ingest, *loops], return_when=asyncio.FIRST_COMPLETED)
+            for task in done - {stop_waiter}:
+                main_logger.critical("%s exited, shutting down", task.get_name(), exc_info=None if task.cancelled() else task.exception())
+        finally:
+            # Stop reading first, then finish what was already read before the leases and the error digest go away
+            sd_notify("STOPPING=1\nSTATUS=Finishing queued comments")
+            deadline = monotonic() + SHUTDOWN_DEADLINE
+            main_logger.info("Stopping, finishing queued comments within %s seconds", SHUTDOWN_DEADLINE)
+            await stop_tasks([stop_waiter, first_poll_reporter, *ingest])
+            await finish_pending_work(deadline)
+            if worker_pool is not None:
+                await worker_pool.stop(timeout=max(deadline - monotonic(), 1))
+            if persist:
+                await persist_leaderboard(databased)
+            await stop_tasks(loops)
+            loop_watchdog.stop()
+            await metrics_runner.cleanup()
+            if tracer.exporter is not None:
+                tracer.exporter.close()
 
 
 if __name__ == "__main__":
-    cool_down_timer = 0
-    main_logger = create_logger(logger_name="basedcount_bot", set_format=True)
-    background_tasks: set[asyncio.Task[None]] = set()
+    setup_logging()
     asyncio.run(main())
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import json
+import random
+from pathlib import Path
+from typing import Any
+
+# Fixed seed so every run benchmarks the exact same inputs
+SEED = 1312
+
+CASUAL_COMMENTS = (
+    "I disagree with this take entirely, but I see where you are coming from.",
+    "Source? Because that is not what the article says at all.",
+    "lmao the flair checks out",
+    "This meme is a repost from last week.",
+    "Based on what exactly? Nothing in the post supports that.",
+    "Can someone explain the joke, I don't get it",
+    "The based department is closed today, come back tomorrow.",
+)
+BASED_COMMENTS = (
+    "based",
+    "Based",
+    "based and breadpilled",
+    "Based and touch-grass-pilled",
+    "Based but cringepilled",
+    "basado y pildorado",
+    "based\n\nI agree with all of this",
+    "BASED and based-count-pilled. Also this is a long comment that goes on for a while after the pill to make the regex scan further along the line.",
+    "Basiert",
+    "based on off",
+)
+
+
+def comment_corpus(size: int = 1000) -> list[str]:
+    """Comment bodies as they come from the pcm stream, roughly one based for every three comments.
+
+    :returns: lowercased comment bodies
+
+    """
+    rng = random.Random(SEED)
+    return [(rng.choice(BASED_COMMENTS) if rng.random() < 0.3 else rng.choice(CASUAL_COMMENTS)).lower() for _ in range(size)]
+
+
+def _without_nulls(data: dict[str, Any]) -> dict[str, Any]:
+    """Lemmy leaves optional fields out of its responses instead of sending null."""
+    return {key: value for key, value in data.items() if value is not None}
+
+
+def _lemmy_user(user_id: int) -> dict[str, Any]:
+    return _without_nulls(
+        {
+            "id": user_id,
+            "name": f"user{user_id}",
+            "display_name": f"User {user_id}",
+            "avatar": f"https://lemmy.basedcount.com/pictrs/image/{user_id}.png",
+            "banned": False,
+            "published": "2023-07-01T12:00:00.000000Z",
+            "updated": "2023-08-01T12:00:00.000000Z",
+            "actor_id": f"https://lemmy.basedcount.com/u/user{user_id}",
+            "bio": "I am here for the memes",
+            "local": True,
+            "banner": None,
+            "deleted": False,
+            "inbox_url": f"https://lemmy.basedcount.com/u/user{user_id}/inbox",
+            "matrix_user_id": None,
+            "admin": False,
+            "bot_account": False,
+            "ban_expires": None,
+            "instance_id": 1,
+        }
+    )
+
+
+PCM_COMMUNITY = {
+    "id": 2,
+    "name": "pcm",
+    "title": "PoliticalCompassMemes",
+    "description": "Political Compass Memes",
+    "removed": False,
+    "published": "2023-06-20T10:00:00.000000Z",
+    "updated": "2023-09-01T10:00:00.000000Z",
+    "deleted": False,
+    "nsfw": False,
+    "actor_id": "https://lemmy.basedcount.com/c/pcm",
+    "local": True,
+    "icon": "https://lemmy.basedcount.com/pictrs/image/pcm.png",
+    "banner": "https://lemmy.basedcount.com/pictrs/image/pcm-banner.png",
+    "hidden": False,
+    "posting_restricted_to_mods": False,
+    "instance_id": 1,
+}
+
+
+def comment_list_page(size: int = 50) -> dict[str, Any]:
+    """A comment/list response shaped like the ones the bot polls.
+
+    :param size: number of comments in the page, 50 is the limit the bot requests
+
+    :returns: decoded JSON response
+
+    """
+    rng = random.Random(SEED)
+    corpus = comment_corpus(size)
+    comments = []
+    for index in range(size):
+        post_id = rng.randint(1, 500)
+        comment_id = 10_000 + index
+        comments.append(
+            {
+                "comment": {
+                    "id": comment_id,
+                    "creator_id": rng.randint(1, 2000),
+                    "post_id": post_id,
+                    "content": corpus[index],
+                    "removed": False,
+                    "published": "2023-09-12T18:30:00.123456Z",
+                    "updated": "2023-09-12T18:31:00.123456Z",
+                    "deleted": False,
+                    "ap_id": f"https://lemmy.basedcount.com/comment/{comment_id}",
+                    "local": True,
+                    "path": f"0.{rng.randint(1, 9999)}.{comment_id}",
+                    "distinguished": False,
+                    "language_id": 37,
+                },
+                "creator": _lemmy_user(rng.randint(1, 2000)),
+                "post": _without_nulls(
+                    {
+                        "id": post_id,
+                        "name": f"Post {post_id}",
+                        "url": None,
+                        "body": "Post body",
+                        "creator_id": rng.randint(1, 2000),
+                        "community_id": 2,
+                        "removed": False,
+                        "locked": False,
+                        "published": "2023-09-12T12:00:00.000000Z",
+                        "updated": None,
+                        "deleted": False,
+                        "nsfw": False,
+                        "embed_title": None,
+                        "embed_description": None,
+                        "thumbnail_url": None,
+                        "ap_id": f"https://lemmy.basedcount.com/post/{post_id}",
+                        "local": True,
+                        "embed_video_url": None,
+                        "language_id": 37,
+                        "featured_community": False,
+                        "featured_local": False,
+                    }
+                ),
+                "community": dict(PCM_COMMUNITY),
+                "counts": {"id": comment_id, "comment_id": comment_id, "score": 3, "upvotes": 3, "downvotes": 0, "child_count": 0},
+                "creator_banned_from_community": False,
+                "subscribed": "NotSubscribed",
+                "saved": False,
+                "creator_blocked": False,
+                "my_vote": None,
+            }
+        )
+    return {"comments": comments}
+
+
+def load_comment_list_page(path: Path) -> dict[str, Any]:
+    """Loads a comment/list response recorded from the live API.
+
+    :returns: decoded JSON response
+
+    """
+    with path.open("r", encoding="utf-8") as fp:
+        page: dict[str, Any] = json.load(fp)
+    return page
+
+
+def user_profile(pill_count: int = 2000, merged_accounts: int = 3) -> dict[str, Any]:
+    """A users collection document of a long time user with a lot of pills.
+
+    :returns: profile document
+
+    """
+    rng = random.Random(SEED)
+    name = "https://lemmy.basedcount.com/u/longtimeuser"
+    return {
+        "name": name,
+        "count": 4321,
+        "combinedCount": 5000,
+        "combinedPillCount": pill_count + 100,
+        "flair": "AuthRight",
+        "compass": ["-3.5", "4.1"],
+        "sapply": ["-1.2", "2.3", "3.4"],
+        "basedTime": [1_690_000_000 + rng.randint(0, 10_000_000) for _ in range(500)],
+        "pills": [
+            {
+                "name": f"pill number {index}",
+                "commentID": f"https://lemmy.basedcount.com/comment/{index}",
+                "fromUser": f"https://lemmy.basedcount.com/u/user{rng.randint(1, 2000)}",
+                "date": 1_690_000_000 + index,
+                "amount": 1,
+            }
+            for index in range(pill_count)
+        ],
+        "mergedAccounts": [f"https://lemmy.basedcount.com/u/alt{index}" for index in range(merged_accounts)],
+        "is_lemmy": True,
+    }
+
+
+def rank_dict(size: int = 40) -> dict[str, dict[str, Any]]:
+    """Content of a ranks_dict.json, ranks every 250 based.
+
+    :returns: rank name to value and message
+
+    """
+    ranks: dict[str, dict[str, Any]] = {"House of Cards": {"value": 0, "message": "You are new here."}}
+    for index in range(1, size):
+        ranks[f"Rank {index}"] = {"value": index * 250, "message": f"You have reached rank {index}."}
+    return ranks
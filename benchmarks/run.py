@@ -0,0 +1,176 @@
+"""Microbenchmarks of the CPU bound hot paths of the bot, with a regression check against a saved baseline.
+
+python -m benchmarks.run --save-baseline   # on the base commit
+python -m benchmarks.run                   # after the change, exits 1 if a benchmark got slower than the threshold
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import re
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from attrs import define
+
+from async_lemmy_py.models.comment import Comment
+from async_lemmy_py.request_builder import RequestBuilder
+from basedcount_bot import BASED_REGEX, PILL_REGEX
+from benchmarks import fixtures
+from bot_commands import format_based_reply
+from config_store import config_store
+from models.ranks import rank_message, rank_name
+from models.user import User
+
+RESULTS_DIR = Path(__file__).parent / "results"
+BASELINE_FILE = RESULTS_DIR / "baseline.json"
+LATEST_FILE = RESULTS_DIR / "latest.json"
+
+
+@define(frozen=True, kw_only=True)
+class Benchmark:
+    name: str
+    function: Callable[[], Any]
+    # Items handled by one call, results are reported per item
+    items: int = 1
+
+
+def build_benchmarks(page_path: Optional[Path] = None) -> list[Benchmark]:
+    """Builds the inputs once and returns the benchmarks that run on them.
+
+    :param page_path: recorded comment/list response, a synthetic page is used when None
+
+    :returns: list of benchmarks
+
+    """
+    corpus = fixtures.comment_corpus()
+    based_lines = [next(line for line in body.splitlines() if line) for body in corpus if BASED_REGEX.match(body.replace("\n", ""))]
+    page = fixtures.load_comment_list_page(page_path) if page_path is not None else fixtures.comment_list_page()
+    # Comment.from_dict only keeps a reference to the request builder, no session is needed
+    request_builder = RequestBuilder.__new__(RequestBuilder)
+    profile = fixtures.user_profile()
+    user = User.from_data(profile)
+    based_counts = list(range(0, 12_000, 12))
+
+    # rank_name reads ranks_dict.json through the config store, serve it a fixed table. The store keeps the parsed file, the directory can go
+    data_directory = config_store.directory
+    with tempfile.TemporaryDirectory(prefix="benchmark_ranks_") as ranks_dir:
+        (Path(ranks_dir) / "ranks_dict.json").write_text(json.dumps(fixtures.rank_dict()), encoding="utf-8")
+        config_store.directory = Path(ranks_dir)
+        try:
+            config_store.reload_changed()
+        finally:
+            config_store.directory = data_directory
+
+    def based_match() -> None:
+        for body in corpus:
+            BASED_REGEX.match(body.replace("\n", ""))
+
+    def pill_search() -> None:
+        for line in based_lines:
+            if pill_match := PILL_REGEX.search(line):
+                pill_match.group(2).strip(" -")
+
+    def comments_from_page() -> None:
+        for comment_view in page["comments"]:
+            Comment.from_dict(comment_view=comment_view, request_builder=request_builder)
+
+    def ranks() -> None:
+        for based_count in based_counts:
+            rank_name(based_count, profile["name"])
+            rank_message(based_count)
+
+    def based_reply() -> None:
+        for based_count in (1, 5, 250, 251):
+            user.based_count = based_count
+            format_based_reply(profile["name"], user, rank_name(based_count, profile["name"]), rank_message(based_count), user.format_pills(2100))
+
+    return [
+        Benchmark(name="regex.based_match", function=based_match, items=len(corpus)),
+        Benchmark(name="regex.pill_search", function=pill_search, items=len(based_lines)),
+        Benchmark(name="comment.from_dict", function=comments_from_page, items=len(page["comments"])),
+        Benchmark(name="user.from_data", function=lambda: User.from_data(profile)),
+        Benchmark(name="ranks.rank_name_and_message", function=ranks, items=len(based_counts)),
+        Benchmark(name="reply.format_based_reply", function=based_reply, items=4),
+    ]
+
+
+def measure(benchmark: Benchmark, repeat: int) -> float:
+    """Runs the benchmark enough times to take at least 0.2 seconds, repeat times, and keeps the fastest run.
+
+    :returns: seconds per item
+
+    """
+    timer = timeit.Timer(benchmark.function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number / benchmark.items
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """Prints every benchmark against the baseline.
+
+    :returns: names of the benchmarks that are slower than the baseline by more than threshold
+
+    """
+    regressions = []
+    print(f"{'benchmark':<32}{'baseline':>14}{'now':>14}{'change':>10}")
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<32}{'-':>14}{seconds * 1e6:>11.3f} us{'new':>10}")
+            continue
+        change = seconds / base - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<32}{base * 1e6:>11.3f} us{seconds * 1e6:>11.3f} us{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Runs the hot path microbenchmarks and compares them to the saved baseline.")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="fail when a benchmark is slower than the baseline by more than this fraction")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the fastest is kept")
+    parser.add_argument("--filter", help="only run the benchmarks whose name matches this regex")
+    parser.add_argument("--page", type=Path, help="recorded comment/list response to use instead of the synthetic page")
+    args = parser.parse_args()
+
+    benchmarks = [benchmark for benchmark in build_benchmarks(args.page) if args.filter is None or re.search(args.filter, benchmark.name)]
+    results = {benchmark.name: measure(benchmark, args.repeat) for benchmark in benchmarks}
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    document = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "seconds_per_item": results,
+    }
+    output = BASELINE_FILE if args.save_baseline else LATEST_FILE
+    output.write_text(json.dumps(document, indent=2), encoding="utf-8")
+
+    if args.save_baseline or not BASELINE_FILE.is_file():
+        compare(results, {}, args.threshold)
+        print(f"\nSaved {output}" + ("" if args.save_baseline else f", run with --save-baseline to create {BASELINE_FILE}"))
+        return 0
+
+    baseline = json.loads(BASELINE_FILE.read_text(encoding="utf-8"))
+    if baseline.get("python") != document["python"] or baseline.get("machine") != document["machine"]:
+        print(f"Warning: baseline was recorded on Python {baseline.get('python')} {baseline.get('machine')}, results may not be comparable\n")
+    regressions = compare(results, baseline["seconds_per_item"], args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
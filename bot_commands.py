@@ -2,23 +2,65 @@ from __future__ import annotations
 
 import asyncio
 import random
-import re
 from contextlib import suppress
 from time import time
 from typing import Mapping, Optional, Any
 from urllib.parse import urlsplit, parse_qs
 
-import aiofiles
-import yaml
 from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
 
+from cheating_detector import CheatingReport
+from database_indexes import NAME_COLLATION
+from leaderboard import leaderboard
 from models.ranks import rank_name, rank_message
+from models.replies import bot_replies
 from models.user import User
+from reply_cache import reply_cache
 from utility_functions import get_mongo_collection, create_logger, actor_id_to_user_mention
 
 bot_commands_logger = create_logger(logger_name="basedcount_bot")
 
+# Lower cased actor ids of users who don't want replies from the bot
+unsubscribed_users: set[str] = set()
+
+# Standalone servers (40573) and old servers without $changeStream (40324)
+CHANGE_STREAM_UNSUPPORTED_CODES = (40573, 40324)
+
+# Every write to a profile stamps it, export_users.py exports the profiles stamped since its last run
+MARK_MODIFIED = {"lastModified": True}
+
+# Fields of a profile created for a lemmy user the bot hasn't seen before
+NEW_PROFILE: dict[str, Any] = {
+    "flair": "Unflaired",
+    "count": 0,
+    "pills": [],
+    "compass": [],
+    "sapply": [],
+    "basedTime": [],
+    "mergedAccounts": [],
+    "combinedCount": 0,
+    "combinedPillCount": 0,
+    "combinedAccounts": [],
+    "unsubscribed": False,
+    "is_lemmy": True,
+}
+
+
+def combined_counts_current(profile: Mapping[str, Any]) -> bool:
+    """Whether the combined counters of a profile were computed from its current merged accounts.
+
+    Merges are made on the website, which doesn't touch the combined counters, so every computation records the mergedAccounts it summed in
+    combinedAccounts. A profile whose merged accounts changed since, or that predates combinedAccounts, has to be recomputed.
+
+    :param profile: profile from the users collection
+
+    :returns: True if combinedCount and combinedPillCount can be used as they are
+
+    """
+    return "combinedCount" in profile and profile.get("combinedAccounts") == profile.get("mergedAccounts", [])
+
 
 async def find_or_create_user_profile(user_actor_id: str, users_collection: AsyncIOMotorCollection) -> Mapping[str, Any]:
     """Finds the user in the users_collection, or creates one if it doesn't exist using default values
@@ -29,24 +71,11 @@ async def find_or_create_user_profile(user_actor_id: str, users_collection: Asyn
     :returns: Dict object with user profile info
 
     """
-    query = {"$and": [{"name": re.compile(rf"^{user_actor_id}$", re.I)}, {"is_lemmy": {"$exists": True, "$eq": True}}]}
-    profile = await users_collection.find_one(query)
+    profile = await users_collection.find_one({"name": user_actor_id, "is_lemmy": True}, collation=NAME_COLLATION)
     if profile is None:
         profile = await users_collection.find_one_and_update(
             {"name": user_actor_id},
-            {
-                "$setOnInsert": {
-                    "flair": "Unflaired",
-                    "count": 0,
-                    "pills": [],
-                    "compass": [],
-                    "sapply": [],
-                    "basedTime": [],
-                    "mergedAccounts": [],
-                    "unsubscribed": False,
-                    "is_lemmy": True,
-                }
-            },
+            {"$setOnInsert": NEW_PROFILE, "$currentDate": MARK_MODIFIED},
             upsert=True,
             return_document=ReturnDocument.AFTER,
         )
@@ -64,24 +93,40 @@ async def based_and_pilled(user_actor_id: str, flair_name: str, pill: Optional[d
     :returns: Comment response for the user when based count is 1, multiple of 5 and when they reach a new rank
 
     """
-    bot_commands_logger.info(f"based_and_pilled args: {user_actor_id}, flair: {flair_name}, pill: {pill}")
+    bot_commands_logger.info("based_and_pilled args: %s, flair: %s, pill: %s", user_actor_id, flair_name, pill)
     users_collection = await get_mongo_collection(collection_name="users", databased=databased)
     profile = await find_or_create_user_profile(user_actor_id, users_collection)
-    bot_commands_logger.info(f"Based Count before: {profile['count']}")
+    bot_commands_logger.info("Based Count before: %s", profile["count"])
+    if not combined_counts_current(profile):
+        await backfill_combined_counts(profile, users_collection)
     await asyncio.gather(
         add_based_count(user_actor_id, flair_name, users_collection),
         add_pills(user_actor_id, pill, users_collection),
     )
     profile = await find_or_create_user_profile(user_actor_id, users_collection)
-    bot_commands_logger.info(f"Based Count: {profile['count']}")
+    bot_commands_logger.info("Based Count: %s", profile["count"])
 
     user = User.from_data(profile)
-    all_based_counts = await user.get_all_accounts_based_count(users_collection)
-    combined_based_count = sum(map(lambda x: x[1], all_based_counts))
+    combined_based_count = await user.get_combined_based_count(users_collection)
     combined_pills = await user.combined_formatted_pills(users_collection)
-    combined_rank = await rank_name(combined_based_count, user_actor_id)
-    rank_up = await rank_message(combined_based_count)
+    combined_rank = rank_name(combined_based_count, user_actor_id)
+    rank_up = rank_message(combined_based_count)
+
+    return format_based_reply(user_actor_id, user, combined_rank, rank_up, combined_pills)
+
+
+def format_based_reply(user_actor_id: str, user: User, combined_rank: str, rank_up: Optional[str], combined_pills: str) -> Optional[str]:
+    """Builds the reply to a based, only sent when the based count is 1 or a multiple of 5
+
+    :param user_actor_id: user who got the based, as written in the comment
+    :param user: profile of the user after the based was added
+    :param combined_rank: rank name for the combined based count
+    :param rank_up: rank message when the combined count just reached a new rank
+    :param combined_pills: formatted combined pill count
+
+    :returns: Comment response, None when the bot shouldn't reply
 
+    """
     user_mention = actor_id_to_user_mention(user_actor_id)
     if user.based_count == 1:
         return (
@@ -122,7 +167,68 @@ async def add_based_count(user_actor_id: str, flair_name: str, users_collection:
     :returns: None
 
     """
-    await users_collection.update_one({"name": user_actor_id}, {"$set": {"flair": flair_name}, "$inc": {"count": 1}, "$push": {"basedTime": int(time())}})
+    profile, _ = await asyncio.gather(
+        users_collection.find_one_and_update(
+            {"name": user_actor_id},
+            {"$set": {"flair": flair_name}, "$inc": {"count": 1, "combinedCount": 1}, "$push": {"basedTime": int(time())}, "$currentDate": MARK_MODIFIED},
+            projection={"_id": 0, "count": 1},
+            return_document=ReturnDocument.AFTER,
+        ),
+        add_to_primary_accounts(user_actor_id, "combinedCount", users_collection),
+    )
+    reply_cache.invalidate(user_actor_id)
+    if profile is not None:
+        leaderboard.record(user_actor_id, flair_name, profile["count"])
+
+
+async def add_to_primary_accounts(user_actor_id: str, field_name: str, users_collection: AsyncIOMotorCollection) -> None:
+    """Increments a combined counter on every account that has this user in its merged accounts
+
+    Accounts whose combined counters haven't been backfilled yet are skipped, the backfill counts this increment for them. The increment isn't
+    atomic with the one of the merged account itself, a failure in between leaves the main account off by one until `repair.py combined`.
+
+    :param user_actor_id: The merged account that was based or pilled
+    :param field_name: combinedCount or combinedPillCount
+    :param users_collection: The collection in which the profiles will be updated
+
+    :returns: None
+
+    """
+    await users_collection.update_many(
+        {"mergedAccounts": user_actor_id, field_name: {"$exists": True}}, {"$inc": {field_name: 1}, "$currentDate": MARK_MODIFIED}
+    )
+
+
+async def backfill_combined_counts(profile: Mapping[str, Any], users_collection: AsyncIOMotorCollection) -> None:
+    """Computes combinedCount and combinedPillCount for a profile created before they were maintained, or whose merged accounts changed
+
+    The write only applies while the counters and the merged accounts are still the ones read, a based or a merge meanwhile leaves the profile
+    stale and the next based recomputes it.
+
+    :param profile: The profile whose combined counters aren't current, see combined_counts_current
+    :param users_collection: The collection in which the profile will be updated
+
+    :returns: None
+
+    """
+    merged_accounts = profile.get("mergedAccounts", [])
+    all_based_counts = await User.from_data(profile).get_all_accounts_based_count(users_collection)
+    combined_counts = {
+        "combinedCount": sum(x[1] for x in all_based_counts),
+        "combinedPillCount": sum(x[2] for x in all_based_counts),
+        "combinedAccounts": merged_accounts,
+    }
+    # None also matches a missing field
+    await users_collection.update_one(
+        {
+            "name": profile["name"],
+            "combinedCount": profile.get("combinedCount"),
+            "combinedPillCount": profile.get("combinedPillCount"),
+            "mergedAccounts": merged_accounts if "mergedAccounts" in profile else {"$exists": False},
+        },
+        {"$set": combined_counts, "$currentDate": MARK_MODIFIED},
+    )
+    reply_cache.invalidate(profile["name"])
 
 
 async def add_pills(user_actor_id: str, pill: Optional[dict[str, str | int]], users_collection: AsyncIOMotorCollection) -> None:
@@ -138,7 +244,15 @@ async def add_pills(user_actor_id: str, pill: Optional[dict[str, str | int]], us
     if pill is None:
         return None
 
-    await users_collection.update_one({"name": user_actor_id, "pills.name": {"$ne": pill["name"]}}, {"$push": {"pills": pill}})
+    res = await users_collection.update_one(
+        {"name": user_actor_id, "pills.name": {"$ne": pill["name"]}}, {"$push": {"pills": pill}, "$currentDate": MARK_MODIFIED}
+    )
+    if res.modified_count:
+        await asyncio.gather(
+            users_collection.update_one({"name": user_actor_id}, {"$inc": {"combinedPillCount": 1}, "$currentDate": MARK_MODIFIED}),
+            add_to_primary_accounts(user_actor_id, "combinedPillCount", users_collection),
+        )
+        reply_cache.invalidate(user_actor_id)
 
 
 async def add_to_based_history(user_actor_id: str, parent_author_actor_id: str, databased: AsyncIOMotorDatabase) -> None:
@@ -155,13 +269,42 @@ async def add_to_based_history(user_actor_id: str, parent_author_actor_id: str,
     await based_history_collection.update_one({"to": parent_author_actor_id, "from": user_actor_id}, {"$inc": {"count": 1}}, upsert=True)
 
 
-async def most_based() -> str:
-    """Returns the link to the basedcount.com leaderboard.
+async def report_cheating(reports: list[CheatingReport], databased: AsyncIOMotorDatabase) -> None:
+    """Saves the reports of the cheating detector to the modReports collection for the mods to review
+
+    :param reports: Reports returned by the cheating detector
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    for report in reports:
+        bot_commands_logger.warning(
+            "Possible cheating (%s): %s gave %s based in %s seconds", report.kind, ", ".join(report.users), report.counts, report.window
+        )
+    mod_reports_collection = await get_mongo_collection(collection_name="modReports", databased=databased)
+    await mod_reports_collection.insert_many([report.to_document() for report in reports])
+
+
+async def most_based(flair: Optional[str] = None, limit: int = 10) -> str:
+    """Returns the top users of the in memory leaderboard, overall or for a single flair.
+
+    :param flair: Flair whose leaderboard is returned, the overall leaderboard is returned when None
+    :param limit: Number of users in the reply
 
     :returns: Str object containing the top 10 most based users
 
     """
-    return "See the Based Count Leaderboard at https://basedcount.com/leaderboard"
+    top_users = leaderboard.top(limit, flair)
+    if not top_users:
+        if flair is not None:
+            return f"There is no leaderboard for the {flair} flair. See the Based Count Leaderboard at https://basedcount.com/leaderboard"
+        return "See the Based Count Leaderboard at https://basedcount.com/leaderboard"
+
+    flair_title = f" {leaderboard.flair_name(flair)}" if flair is not None else ""
+    title = f"Top {len(top_users)} Most Based{flair_title} Users"
+    rows = "\n".join(f"{place}. {actor_id_to_user_mention(name)} - {count:,}" for place, (name, count) in enumerate(top_users, start=1))
+    return f"{title}\n\n{rows}\n\nSee the full Based Count Leaderboard at https://basedcount.com/leaderboard"
 
 
 async def get_based_count(user_actor_id: str, databased: AsyncIOMotorDatabase, is_me: bool = False) -> str:
@@ -174,16 +317,19 @@ async def get_based_count(user_actor_id: str, databased: AsyncIOMotorDatabase, i
     :returns: str object with based count summary of the user
 
     """
-    users_collection = await get_mongo_collection(collection_name="users", databased=databased)
-    profile = await users_collection.find_one({"name": re.compile(rf"^{user_actor_id}$", re.I)})
+    if (cached_reply := reply_cache.get(user_actor_id, is_me)) is not None:
+        return cached_reply
+
+    users_collection = await get_mongo_collection(collection_name="users", databased=databased, read_only=True)
+    profile = await users_collection.find_one({"name": user_actor_id}, collation=NAME_COLLATION)
 
     if profile is not None:
-        user = User.from_data(profile)
+        # Counters that predate a merge made on the website are summed from the accounts instead
+        user = User.from_data(profile if combined_counts_current(profile) else {**profile, "combinedCount": None, "combinedPillCount": None})
 
-        all_based_counts = await user.get_all_accounts_based_count(users_collection)
-        combined_based_count = sum(map(lambda x: x[1], all_based_counts))
+        combined_based_count = await user.get_combined_based_count(users_collection)
         combined_pills = await user.combined_formatted_pills(users_collection)
-        combined_rank = await rank_name(combined_based_count, user_actor_id)
+        combined_rank = rank_name(combined_based_count, user_actor_id)
 
         build_username = f"{profile['name']}'s"
         reply_message = (
@@ -194,20 +340,99 @@ async def get_based_count(user_actor_id: str, databased: AsyncIOMotorDatabase, i
         )
 
         if user.merged_accounts:
+            all_based_counts = await user.get_all_accounts_based_count(users_collection)
             merged_acc_summary = "\n\n".join([f"- [{x[0]}](https://basedcount.com/u/{x[0]}) {x[1]} based & {x[2]} pills" for x in all_based_counts])
             merged_account_reply = f"Based and Pill Count breakdown\n\n{merged_acc_summary}"
             reply_message = f"{reply_message}\n\n{merged_account_reply}"
+        reply_cache.put(user_actor_id, is_me, reply_message, accounts=[profile["name"], *user.merged_accounts])
 
     else:
-        async with aiofiles.open("data_dictionaries/bot_replies.yaml", "r") as fp:
-            replies = yaml.safe_load(await fp.read())
+        replies = bot_replies()
         if is_me:
-            reply_message = random.choice(replies.get("my_based_no_user_reply"))
+            reply_message = random.choice(replies.my_based_no_user_reply)
         else:
-            reply_message = random.choice(replies.get("based_count_no_user_reply"))
+            reply_message = random.choice(replies.based_count_no_user_reply)
     return reply_message
 
 
+async def recompute_combined_counts(databased: AsyncIOMotorDatabase, user_names: Optional[list[str]] = None, dry_run: bool = False) -> list[dict[str, Any]]:
+    """Recomputes combinedCount and combinedPillCount from the main and merged accounts and fixes the profiles where they drifted
+
+    Also records the merged accounts the counters were computed from, see combined_counts_current.
+
+    :param databased: MongoDB database used to get the collections
+    :param user_names: Only repair these profiles, every profile is repaired when None
+    :param dry_run: Only report the differences, don't write them
+
+    :returns: list of dicts with name, old and new combined counts for every profile that was (or would be) fixed
+
+    """
+    users_collection = await get_mongo_collection(collection_name="users", databased=databased)
+    pipeline: list[dict[str, Any]] = [
+        {"$match": {} if user_names is None else {"name": {"$in": user_names}}},
+        {"$lookup": {"from": "users", "localField": "mergedAccounts", "foreignField": "name", "as": "merged"}},
+        {
+            "$project": {
+                "name": 1,
+                "combinedCount": 1,
+                "combinedPillCount": 1,
+                "combinedAccounts": 1,
+                "mergedAccounts": {"$ifNull": ["$mergedAccounts", []]},
+                "expectedCount": {"$add": [{"$ifNull": ["$count", 0]}, {"$sum": "$merged.count"}]},
+                "expectedPillCount": {
+                    "$add": [
+                        {"$size": {"$ifNull": ["$pills", []]}},
+                        {"$sum": {"$map": {"input": "$merged", "in": {"$size": {"$ifNull": ["$$this.pills", []]}}}}},
+                    ]
+                },
+            }
+        },
+        {
+            "$match": {
+                "$expr": {
+                    "$or": [
+                        {"$ne": ["$combinedCount", "$expectedCount"]},
+                        {"$ne": ["$combinedPillCount", "$expectedPillCount"]},
+                        {"$ne": ["$combinedAccounts", "$mergedAccounts"]},
+                    ]
+                }
+            }
+        },
+    ]
+
+    fixes: list[dict[str, Any]] = []
+    requests: list[UpdateOne] = []
+    async for profile in users_collection.aggregate(pipeline):
+        fixes.append(
+            {
+                "name": profile["name"],
+                "combinedCount": (profile.get("combinedCount"), profile["expectedCount"]),
+                "combinedPillCount": (profile.get("combinedPillCount"), profile["expectedPillCount"]),
+            }
+        )
+        requests.append(
+            UpdateOne(
+                {"_id": profile["_id"]},
+                {
+                    "$set": {
+                        "combinedCount": profile["expectedCount"],
+                        "combinedPillCount": profile["expectedPillCount"],
+                        "combinedAccounts": profile["mergedAccounts"],
+                    },
+                    "$currentDate": MARK_MODIFIED,
+                },
+            )
+        )
+        if len(requests) >= 1000 and not dry_run:
+            await users_collection.bulk_write(requests, ordered=False)
+            requests = []
+
+    if requests and not dry_run:
+        await users_collection.bulk_write(requests, ordered=False)
+    bot_commands_logger.info("%s %d profiles with drifted combined counts", "Found" if dry_run else "Fixed", len(fixes))
+    return fixes
+
+
 async def my_compass(user_actor_id: str, compass: str, databased: AsyncIOMotorDatabase) -> str:
     """Parses the Political Compass/Sapply Values url and saves to compass values in database
 
@@ -230,8 +455,9 @@ async def my_compass(user_actor_id: str, compass: str, databased: AsyncIOMotorDa
             sv_soc_type = url_query["auth"][0]
             sv_prog_type = url_query["prog"][0]
             sapply_values = [sv_prog_type, sv_soc_type, sv_eco_type]
-            bot_commands_logger.info(f"Sapply Values: {sapply_values}")
-            await users_collection.update_one({"name": user_actor_id}, {"$set": {"sapply": sapply_values}})
+            bot_commands_logger.info("Sapply Values: %s", sapply_values)
+            await users_collection.update_one({"name": user_actor_id}, {"$set": {"sapply": sapply_values}, "$currentDate": MARK_MODIFIED})
+            reply_cache.invalidate(user_actor_id)
             user = User.from_data({**profile, "sapply": sapply_values})
             return f"Your Sapply compass has been updated.\n\n{user.sappy_values_type}"
 
@@ -239,8 +465,9 @@ async def my_compass(user_actor_id: str, compass: str, databased: AsyncIOMotorDa
             compass_economic_axis = url_query["ec"][0]
             compass_social_axis = url_query["soc"][0]
             compass_values = [compass_economic_axis, compass_social_axis]
-            bot_commands_logger.info(f"PCM Values: {profile['compass']}")
-            await users_collection.update_one({"name": user_actor_id}, {"$set": {"compass": compass_values}})
+            bot_commands_logger.info("PCM Values: %s", profile["compass"])
+            await users_collection.update_one({"name": user_actor_id}, {"$set": {"compass": compass_values}, "$currentDate": MARK_MODIFIED})
+            reply_cache.invalidate(user_actor_id)
             user = User.from_data({**profile, "compass": compass_values})
             return f"Your political compass has been updated.\n\n{user.political_compass_type}"
 
@@ -262,8 +489,9 @@ async def remove_pill(user_actor_id: str, pill: str, databased: AsyncIOMotorData
     """
     users_collection = await get_mongo_collection(collection_name="users", databased=databased)
     res = await users_collection.find_one_and_update(
-        {"name": user_actor_id, "pills.name": pill}, {"$set": {"pills.$.deleted": True}}, return_document=ReturnDocument.AFTER
+        {"name": user_actor_id, "pills.name": pill}, {"$set": {"pills.$.deleted": True}, "$currentDate": MARK_MODIFIED}, return_document=ReturnDocument.AFTER
     )
+    reply_cache.invalidate(user_actor_id)
     if not res:
         return "You do not have that pill!"
     else:
@@ -282,31 +510,101 @@ async def set_subscription(subscribe: bool, user_actor_id: str, databased: Async
     """
     users_collection = await get_mongo_collection(collection_name="users", databased=databased)
     profile = await find_or_create_user_profile(user_actor_id, users_collection)
-    res = await users_collection.update_one({"name": profile["name"]}, {"$set": {"unsubscribed": not subscribe}})
+    res = await users_collection.update_one({"name": profile["name"]}, {"$set": {"unsubscribed": not subscribe}, "$currentDate": MARK_MODIFIED})
+    if subscribe:
+        unsubscribed_users.discard(profile["name"].lower())
+    else:
+        unsubscribed_users.add(profile["name"].lower())
+
     if res:
         return "You have unsubscribed from basedcount_bot." if subscribe else "Thank you for subscribing to basedcount_bot!"
     else:
         return "Error: Please contact the mods."
 
 
-async def check_unsubscribed(user_actor_id: str, databased: AsyncIOMotorDatabase) -> bool:
-    """Check the value of the "unsubscribed" field for a user with the given username in a MongoDB collection.
+def check_unsubscribed(user_actor_id: str) -> bool:
+    """Check whether the user has unsubscribed from the bot replies.
+
+    Answered from the in memory set loaded by load_unsubscribed_users, so there is no database round trip per reply.
+
+    :param user_actor_id: The actor id of the user being replied to.
+
+    :returns: True if the user has unsubscribed, False otherwise (including users without a profile).
+
+    """
+    return user_actor_id.lower() in unsubscribed_users
+
 
-    If the "unsubscribed" field is missing, add it to the user document and set its value to False.
+async def load_unsubscribed_users(databased: AsyncIOMotorDatabase) -> None:
+    """Loads the actor ids of every unsubscribed user and swaps them in as the new unsubscribed set.
 
-    :param user_actor_id: The username to search for in the collection.
-    :param databased: A MotorAsyncIOMotorClient instance representing the MongoDB client.
+    :param databased: MongoDB database used to get the collections
 
-    :returns: The value of the "unsubscribed" field for the user, or False if the user doesn't exist or the "unsubscribed" field is missing.
+    :returns: None
 
     """
+    global unsubscribed_users
     users_collection = await get_mongo_collection(collection_name="users", databased=databased)
-    profile = await users_collection.find_one({"name": user_actor_id})
+    loaded_users = {profile["name"].lower() async for profile in users_collection.find({"unsubscribed": True}, projection={"_id": 0, "name": 1})}
+    unsubscribed_users = loaded_users
+    bot_commands_logger.info("Loaded %d unsubscribed users", len(loaded_users))
 
-    if profile is not None and profile.get("unsubscribed") is not None:
-        unsub: bool = profile.get("unsubscribed", False)
-        return unsub
-    else:
-        # If the "unsubscribed" field is missing, add it and set its value to False
-        await users_collection.update_one({"name": user_actor_id}, {"$set": {"unsubscribed": False}})
-        return False
+
+async def sync_unsubscribed_users(databased: AsyncIOMotorDatabase, refresh_interval: int = 600) -> None:
+    """Keeps the unsubscribed set up to date with edits made outside the bot.
+
+    Uses a change stream when the deployment supports it, otherwise (or after the stream breaks) reloads the whole set every refresh_interval seconds.
+    The stream follows inserts, replaces, updates that set or unset unsubscribed, and deleted profiles.
+
+    :param databased: MongoDB database used to get the collections
+    :param refresh_interval: Seconds between full reloads when change streams aren't available
+
+    :returns: None
+
+    """
+    users_collection = await get_mongo_collection(collection_name="users", databased=databased)
+    pipeline = [
+        {
+            "$match": {
+                "$or": [
+                    {"operationType": {"$in": ["insert", "replace", "delete"]}},
+                    {"updateDescription.updatedFields.unsubscribed": {"$exists": True}},
+                    {"updateDescription.removedFields": "unsubscribed"},
+                ]
+            }
+        }
+    ]
+    use_change_stream = True
+
+    while True:
+        if use_change_stream:
+            try:
+                async with users_collection.watch(pipeline, full_document="updateLookup") as change_stream:
+                    # Anything edited between the initial load and the stream opening would be missed otherwise
+                    await load_unsubscribed_users(databased)
+                    async for change in change_stream:
+                        if change["operationType"] == "delete":
+                            # Only the _id of a deleted profile is in the event, profiles are rarely deleted so the set is reloaded instead
+                            await load_unsubscribed_users(databased)
+                            continue
+                        profile = change.get("fullDocument")
+                        if profile is None:
+                            continue
+                        # A profile whose unsubscribed field was $unset is subscribed
+                        if profile.get("unsubscribed", False):
+                            unsubscribed_users.add(profile["name"].lower())
+                        else:
+                            unsubscribed_users.discard(profile["name"].lower())
+            except PyMongoError as mongo_error:
+                if isinstance(mongo_error, OperationFailure) and mongo_error.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                    bot_commands_logger.info("Change streams are not supported, refreshing unsubscribed users every %s seconds.", refresh_interval)
+                    use_change_stream = False
+                else:
+                    bot_commands_logger.warning("Unsubscribed users change stream broke, retrying.", exc_info=True)
+
+            # Back off before reopening the stream, it reloads the set once it is open again
+            await asyncio.sleep(5)
+        else:
+            await asyncio.sleep(refresh_interval)
+            with suppress(PyMongoError):
+                await load_unsubscribed_users(databased)
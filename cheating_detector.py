@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+from collections import deque
+from time import time
+from typing import Any, Optional
+
+from attrs import define, field
+from cachetools import LRUCache
+
+from config_store import config_store
+
+
+@define(frozen=True, kw_only=True)
+class CheatingReport:
+    kind: str
+    users: tuple[str, ...]
+    # Bases given inside the window along each edge of the pattern, in the same order as users
+    counts: tuple[int, ...]
+    window: int
+    detected_at: int
+
+    def to_document(self) -> dict[str, Any]:
+        """Document stored in the modReports collection.
+
+        :returns: dict form of the report
+
+        """
+        return {
+            "kind": self.kind,
+            "users": list(self.users),
+            "counts": list(self.counts),
+            "windowSeconds": self.window,
+            "detectedAt": self.detected_at,
+            "reviewed": False,
+        }
+
+
+@define(frozen=True, kw_only=True)
+class CheatingThresholds:
+    """Thresholds from cheating_thresholds.yaml, validated once when the file is loaded."""
+
+    window: int = 3600
+    pair_threshold: int = 10
+    reciprocal_threshold: int = 5
+    ring_threshold: int = 3
+    report_cooldown: int = 86_400
+
+    @classmethod
+    def from_dict(cls, thresholds: dict[str, Any]) -> CheatingThresholds:
+        """Validates the content of cheating_thresholds.yaml, missing keys keep their default.
+
+        :param thresholds: decoded yaml
+
+        :returns: CheatingThresholds
+
+        :raises TypeError: If there is an unknown key
+        :raises ValueError: If a value isn't a positive integer
+
+        """
+        cheating_thresholds = cls(**thresholds)
+        for name, value in thresholds.items():
+            if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+                raise ValueError(f"{name} must be a positive integer")
+        return cheating_thresholds
+
+    @property
+    def history(self) -> int:
+        """Bases kept per pair, enough to tell whether any threshold is reached."""
+        return max(self.pair_threshold, self.reciprocal_threshold, self.ring_threshold) + 1
+
+
+config_store.register("cheating_thresholds.yaml", CheatingThresholds.from_dict)
+
+
+@define(kw_only=True)
+class CheatingDetector:
+    """Flags suspicious based giving as it happens, instead of aggregating basedHistory in batches.
+
+    Keeps a sliding window of based timestamps for every recently active (from, to) pair, and the recent targets of every giver to find small rings.
+    Both are LRU bounded so memory stays flat however many users there are, and every observed based costs O(1) amortized. A pair only keeps
+    as many timestamps as the highest threshold needs, counts past it make no difference.
+
+    The thresholds are read from cheating_thresholds.yaml on every based, so edits apply without a restart, unless thresholds is given.
+
+    """
+
+    thresholds: Optional[CheatingThresholds] = None
+    max_pairs: int = 50_000
+    max_targets: int = 32
+
+    _pair_times: LRUCache[tuple[str, str], deque[float]] = field(init=False)
+    _recent_targets: LRUCache[str, dict[str, float]] = field(init=False)
+    # When each pattern was last reported, a timestamp rather than a TTL so a new cooldown applies to the old reports too
+    _reported: LRUCache[tuple[str, tuple[str, ...]], float] = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._pair_times = LRUCache(maxsize=self.max_pairs)
+        self._recent_targets = LRUCache(maxsize=self.max_pairs)
+        self._reported = LRUCache(maxsize=self.max_pairs)
+
+    def current_thresholds(self) -> CheatingThresholds:
+        return self.thresholds or config_store.get("cheating_thresholds.yaml", CheatingThresholds)
+
+    def _window_count(self, giver: str, receiver: str, now: float, window: int) -> int:
+        """Number of bases along the edge inside the window, dropping the expired ones.
+
+        :returns: based count inside the window
+
+        """
+        times = self._pair_times.get((giver, receiver))
+        if times is None:
+            return 0
+        while times and times[0] <= now - window:
+            times.popleft()
+        return len(times)
+
+    def _report(self, kind: str, users: tuple[str, ...], counts: tuple[int, ...], thresholds: CheatingThresholds, now: float) -> Optional[CheatingReport]:
+        """Builds a report unless the same pattern was already reported during the cooldown.
+
+        :returns: the report or None
+
+        """
+        key = (kind, users)
+        if (reported_at := self._reported.get(key)) is not None and reported_at > now - thresholds.report_cooldown:
+            return None
+        self._reported[key] = now
+        return CheatingReport(kind=kind, users=users, counts=counts, window=thresholds.window, detected_at=int(time()))
+
+    def observe(self, giver: str, receiver: str, now: Optional[float] = None) -> list[CheatingReport]:
+        """Records a based and returns any pattern it completes.
+
+        :param giver: actor id of the user who gave the based
+        :param receiver: actor id of the user who received it
+        :param now: timestamp of the based, defaults to the current time
+
+        :returns: new reports, usually an empty list
+
+        """
+        now = time() if now is None else now
+        giver, receiver = giver.lower(), receiver.lower()
+        thresholds = self.current_thresholds()
+
+        times = self._pair_times.get((giver, receiver))
+        if times is None or times.maxlen != thresholds.history:
+            # New pair, or the thresholds changed since it was created
+            times = deque(times or (), maxlen=thresholds.history)
+            self._pair_times[(giver, receiver)] = times
+        times.append(now)
+        pair_count = self._window_count(giver, receiver, now, thresholds.window)
+
+        targets = self._recent_targets.get(giver)
+        if targets is None:
+            targets = {}
+            self._recent_targets[giver] = targets
+        targets.pop(receiver, None)
+        targets[receiver] = now
+        if len(targets) > self.max_targets:
+            del targets[next(iter(targets))]
+
+        reports: list[Optional[CheatingReport]] = []
+        if pair_count >= thresholds.pair_threshold:
+            reports.append(self._report("pair_rate", (giver, receiver), (pair_count,), thresholds, now))
+
+        reverse_count = self._window_count(receiver, giver, now, thresholds.window)
+        if pair_count >= thresholds.reciprocal_threshold and reverse_count >= thresholds.reciprocal_threshold:
+            first, second = sorted((giver, receiver))
+            counts = (pair_count, reverse_count) if first == giver else (reverse_count, pair_count)
+            reports.append(self._report("reciprocal", (first, second), counts, thresholds, now))
+
+        if pair_count >= thresholds.ring_threshold:
+            reports.extend(self._find_rings(giver, receiver, pair_count, now, thresholds))
+        return [report for report in reports if report is not None]
+
+    def _find_rings(self, giver: str, receiver: str, pair_count: int, now: float, thresholds: CheatingThresholds) -> list[Optional[CheatingReport]]:
+        """Looks for giver -> receiver -> third -> giver rings closed by this based. Bounded by max_targets checks.
+
+        :returns: reports for every ring found
+
+        """
+        reports: list[Optional[CheatingReport]] = []
+        for third, last_given in list(self._recent_targets.get(receiver, {}).items()):
+            if third == giver or last_given <= now - thresholds.window:
+                continue
+            second_count = self._window_count(receiver, third, now, thresholds.window)
+            third_count = self._window_count(third, giver, now, thresholds.window)
+            if second_count >= thresholds.ring_threshold and third_count >= thresholds.ring_threshold:
+                ring = (giver, receiver, third)
+                counts = (pair_count, second_count, third_count)
+                # Rotate so the same ring always has the same key, whichever edge closed it
+                start = ring.index(min(ring))
+                reports.append(self._report("ring", ring[start:] + ring[:start], counts[start:] + counts[:start], thresholds, now))
+        return reports
+
+
+cheating_detector = CheatingDetector()
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, TypeVar
+
+from attrs import define, field
+
+from utility_functions import create_logger
+
+config_logger = create_logger(logger_name="basedcount_bot")
+
+T = TypeVar("T")
+DATA_DICTIONARIES = Path("data_dictionaries")
+
+
+@define(frozen=True, kw_only=True)
+class ConfigFile:
+    mtime_ns: int
+    value: Any
+
+
+@define(kw_only=True)
+class ConfigStore:
+    """Parses every file in data_dictionaries once and serves the parsed versions from memory.
+
+    Files with a registered parser are turned into precomputed structures, and a new version of a file only replaces the old one once it parses and
+    validates. Readers always see a complete snapshot since the whole dict is swapped in a single assignment.
+
+    """
+
+    directory: Path = DATA_DICTIONARIES
+    _parsers: dict[str, Callable[[Any], Any]] = field(factory=dict)
+    _files: dict[str, ConfigFile] = field(factory=dict)
+    # mtime of versions that failed validation, so a broken file is reported once and not on every check
+    _rejected: dict[str, int] = field(factory=dict)
+    _loaded: bool = False
+    _reload_lock: Lock = field(factory=Lock)
+
+    def register(self, file_name: str, parser: Callable[[Any], Any]) -> None:
+        """Registers the parser that validates the raw file content and builds the structure served for it.
+
+        The parser should raise ValueError, KeyError or TypeError for invalid content.
+
+        :param file_name: name of the file inside data_dictionaries
+        :param parser: callable taking the decoded json/yaml content
+
+        :returns: None
+
+        """
+        self._parsers[file_name] = parser
+        if self._loaded:
+            self.reload_changed(force={file_name})
+
+    def get(self, file_name: str, expected_type: type[T]) -> T:
+        """Returns the parsed version of a file, loading the directory on first use.
+
+        :param file_name: name of the file inside data_dictionaries
+        :param expected_type: type the registered parser returns
+
+        :returns: parsed file
+
+        :raises FileNotFoundError: If the file doesn't exist or never parsed successfully
+
+        """
+        if not self._loaded:
+            self.reload_changed()
+
+        config_file = self._files.get(file_name)
+        if config_file is None:
+            raise FileNotFoundError(f"{self.directory / file_name} is missing or invalid")
+        if not isinstance(config_file.value, expected_type):
+            raise TypeError(f"{file_name} was parsed as {type(config_file.value).__name__}, not {expected_type.__name__}")
+        return config_file.value
+
+    def _parse(self, path: Path) -> Any:
+        """Decodes and validates a single file.
+
+        :returns: parsed file
+
+        """
+        with path.open("r", encoding="utf-8") as fp:
+            if path.suffix == ".json":
+                raw = json.load(fp)
+            else:
+                # Imported on first use, the first load runs off the event loop during startup
+                from yaml import safe_load
+
+                raw = safe_load(fp)
+        parser = self._parsers.get(path.name)
+        return raw if parser is None else parser(raw)
+
+    def reload_changed(self, force: set[str] | None = None) -> list[str]:
+        """Parses the files that are new or whose mtime changed and swaps them in.
+
+        A file that fails to parse or validate is logged and the previous version keeps being served, same for files that were deleted.
+
+        :param force: file names that are reparsed even if unchanged
+
+        :returns: names of the files that were reloaded
+
+        """
+        from yaml import YAMLError
+
+        with self._reload_lock:
+            files = dict(self._files)
+            reloaded: list[str] = []
+            paths = {path.name: path for path in self.directory.iterdir() if path.suffix in (".json", ".yaml", ".yml")}
+
+            for name, path in paths.items():
+                mtime_ns = path.stat().st_mtime_ns
+                current = files.get(name)
+                unchanged = (current is not None and current.mtime_ns == mtime_ns) or self._rejected.get(name) == mtime_ns
+                if unchanged and name not in (force or set()):
+                    continue
+                try:
+                    files[name] = ConfigFile(mtime_ns=mtime_ns, value=self._parse(path))
+                except (OSError, YAMLError, ValueError, KeyError, TypeError):
+                    config_logger.error("Invalid %s, keeping the previous version", path, exc_info=True)
+                    self._rejected[name] = mtime_ns
+                    continue
+                reloaded.append(name)
+
+            self._files = files
+            self._loaded = True
+        if reloaded:
+            config_logger.info("Loaded %s", ", ".join(sorted(reloaded)))
+        return reloaded
+
+
+config_store = ConfigStore()
+
+
+async def watch_config(interval: int = 30) -> None:
+    """Checks data_dictionaries for changed files every interval seconds, off the event loop.
+
+    :param interval: Seconds between checks
+
+    :returns: None
+
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(config_store.reload_changed)
+        except OSError:
+            config_logger.warning("Could not check data_dictionaries for changes", exc_info=True)
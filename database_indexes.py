@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, Iterator, Mapping, Optional
+
+from attrs import define
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from utility_functions import create_logger, get_databased, get_mongo_collection, setup_logging
+
+indexes_logger = create_logger(logger_name="basedcount_bot")
+
+SAMPLE_ACTOR_ID = "https://lemmy.basedcount.com/u/basedcount_bot"
+# Compares names ignoring case, queries only use an index built with the same collation
+NAME_COLLATION = Collation(locale="en", strength=CollationStrength.SECONDARY)
+# An index scan reading this share of the collection's keys is no better than a COLLSCAN, e.g. a case-insensitive ^...$ regex on name
+FULL_INDEX_SCAN_RATIO = 0.5
+# Below this many documents every plan reads most of the collection, the index scan check would only flag noise
+MIN_DOCUMENTS_FOR_SCAN_CHECK = 1000
+
+
+@define(frozen=True, kw_only=True)
+class IndexSpec:
+    collection: str
+    keys: tuple[tuple[str, int], ...]
+    unique: bool = False
+    sparse: bool = False
+    expire_after_seconds: Optional[int] = None
+    partial_filter: Optional[dict[str, Any]] = None
+    collation: Optional[Collation] = None
+
+    @property
+    def name(self) -> str:
+        """Same name MongoDB would generate for these keys, so existing hand made indexes are recognised. Collated ones get a suffix."""
+        name = "_".join(f"{key}_{direction}" for key, direction in self.keys)
+        return name if self.collation is None else f"{name}_{self.collation.document['locale']}_{self.collation.document['strength']}"
+
+    def create_kwargs(self) -> dict[str, Any]:
+        """Options passed to ``create_index`` along with the keys.
+
+        :returns: dict of index options
+
+        """
+        kwargs: dict[str, Any] = {"name": self.name}
+        if self.unique:
+            kwargs["unique"] = True
+        if self.sparse:
+            kwargs["sparse"] = True
+        if self.expire_after_seconds is not None:
+            kwargs["expireAfterSeconds"] = self.expire_after_seconds
+        if self.partial_filter is not None:
+            kwargs["partialFilterExpression"] = self.partial_filter
+        if self.collation is not None:
+            kwargs["collation"] = self.collation
+        return kwargs
+
+
+@define(frozen=True, kw_only=True)
+class QueryShape:
+    name: str
+    collection: str
+    query: Mapping[str, Any]
+    hot: bool = True
+    sort: Optional[list[tuple[str, int]]] = None
+    collation: Optional[Collation] = None
+
+
+# Every index a query in bot_commands.py relies on. The compound users index also serves the plain `name` lookups since `name` is its prefix.
+INDEXES: list[IndexSpec] = [
+    IndexSpec(collection="users", keys=(("name", ASCENDING), ("pills.name", ASCENDING))),
+    # Case-insensitive lookups of a profile by the actor id a user typed or Lemmy sent
+    IndexSpec(collection="users", keys=(("name", ASCENDING),), collation=NAME_COLLATION),
+    IndexSpec(collection="users", keys=(("mergedAccounts", ASCENDING),)),
+    IndexSpec(collection="users", keys=(("unsubscribed", ASCENDING),), partial_filter={"unsubscribed": True}),
+    IndexSpec(collection="users", keys=(("count", DESCENDING),), partial_filter={"is_lemmy": True}),
+    IndexSpec(collection="users", keys=(("flair", ASCENDING), ("count", DESCENDING)), partial_filter={"is_lemmy": True}),
+    # Delta exports of export_users.py, profiles never written since the marker was added don't have the field
+    IndexSpec(collection="users", keys=(("lastModified", ASCENDING),), sparse=True),
+    IndexSpec(collection="basedHistory", keys=(("to", ASCENDING), ("from", ASCENDING)), unique=True),
+    # Exactly-once claims of the bot replicas, claims are only needed while the comment can still show up in a replica's stream
+    IndexSpec(collection="processedComments", keys=(("ap_id", ASCENDING),), unique=True),
+    IndexSpec(collection="processedComments", keys=(("claimedAt", ASCENDING),), expire_after_seconds=7 * 86_400),
+]
+
+# One entry per distinct filter used in bot_commands.py, filled with sample values so explain() has something to plan.
+QUERY_SHAPES: list[QueryShape] = [
+    QueryShape(name="find_or_create_user_profile", collection="users", query={"name": SAMPLE_ACTOR_ID, "is_lemmy": True}, collation=NAME_COLLATION),
+    QueryShape(name="get_based_count", collection="users", query={"name": SAMPLE_ACTOR_ID}, collation=NAME_COLLATION),
+    QueryShape(name="user_by_name", collection="users", query={"name": SAMPLE_ACTOR_ID}),
+    QueryShape(name="add_pills", collection="users", query={"name": SAMPLE_ACTOR_ID, "pills.name": {"$ne": "sample"}}),
+    QueryShape(name="remove_pill", collection="users", query={"name": SAMPLE_ACTOR_ID, "pills.name": "sample"}),
+    QueryShape(name="add_to_primary_accounts", collection="users", query={"mergedAccounts": SAMPLE_ACTOR_ID, "combinedCount": {"$exists": True}}),
+    QueryShape(name="load_unsubscribed_users", collection="users", query={"unsubscribed": True}, hot=False),
+    QueryShape(name="seed_leaderboard", collection="users", query={"is_lemmy": True}, sort=[("count", DESCENDING)], hot=False),
+    QueryShape(name="seed_flair_leaderboard", collection="users", query={"is_lemmy": True, "flair": "Centrist"}, sort=[("count", DESCENDING)], hot=False),
+    QueryShape(
+        name="export_users_delta", collection="users", query={"is_lemmy": True, "lastModified": {"$gt": datetime(2024, 1, 1, tzinfo=timezone.utc)}}, hot=False
+    ),
+    QueryShape(name="add_to_based_history", collection="basedHistory", query={"to": SAMPLE_ACTOR_ID, "from": SAMPLE_ACTOR_ID}),
+]
+
+
+async def ensure_indexes(databased: AsyncIOMotorDatabase) -> None:
+    """Creates every declared index. Safe to call on every start, existing indexes with the same spec are a no-op for MongoDB.
+
+    Conflicts with indexes made by hand and unique indexes blocked by duplicate documents are logged instead of raised, the bot still works without them.
+
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    for spec in INDEXES:
+        collection = await get_mongo_collection(collection_name=spec.collection, databased=databased)
+        try:
+            await collection.create_index(list(spec.keys), **spec.create_kwargs())
+        except DuplicateKeyError:
+            indexes_logger.error("Could not create unique index %s on %s, collection has duplicate documents.", spec.name, spec.collection)
+        except OperationFailure as op_failure:
+            indexes_logger.warning("Could not create index %s on %s: %s", spec.name, spec.collection, op_failure)
+    indexes_logger.info("Ensured %d indexes", len(INDEXES))
+
+
+def plan_stages(plan: Any) -> Iterator[str]:
+    """Walks a query plan from explain() and yields the name of every stage in it.
+
+    :param plan: winningPlan (or any sub plan) from the explain output
+
+    :yields: stage names, outermost first
+
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for key in ("queryPlan", "inputStage", "inputStages", "outerStage", "innerStage"):
+            if key in plan:
+                yield from plan_stages(plan[key])
+    elif isinstance(plan, list):
+        for sub_plan in plan:
+            yield from plan_stages(sub_plan)
+
+
+async def explain_query_shape(shape: QueryShape, databased: AsyncIOMotorDatabase) -> tuple[list[str], Optional[str]]:
+    """Runs explain() for the query shape and tells whether its winning plan reads the whole collection.
+
+    Next to a COLLSCAN, an IXSCAN examining about as many keys as the collection has documents is flagged too: an unanchored or
+    case-insensitive regex walks the whole index, explain() still reports it as an index scan.
+
+    :param shape: The query shape to explain
+    :param databased: MongoDB database used to get the collections
+
+    :returns: the stages of the winning plan, and COLLSCAN or FULL IXSCAN when the plan scans the whole collection, None otherwise
+
+    """
+    collection = await get_mongo_collection(collection_name=shape.collection, databased=databased)
+    cursor = collection.find(shape.query, collation=shape.collation)
+    if shape.sort is not None:
+        cursor = cursor.sort(shape.sort)
+    explanation = await cursor.explain()
+    stages = list(plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {})))
+    if "COLLSCAN" in stages:
+        return stages, "COLLSCAN"
+
+    keys_examined = explanation.get("executionStats", {}).get("totalKeysExamined", 0)
+    documents = await collection.estimated_document_count()
+    if documents >= MIN_DOCUMENTS_FOR_SCAN_CHECK and keys_examined >= FULL_INDEX_SCAN_RATIO * documents:
+        return stages, "FULL IXSCAN"
+    return stages, None
+
+
+async def verify_query_plans(databased: AsyncIOMotorDatabase) -> dict[str, list[str]]:
+    """Explains every query shape and warns when a hot one scans the whole collection, see explain_query_shape.
+
+    :param databased: MongoDB database used to get the collections
+
+    :returns: dict of query shape name to the stages of its winning plan
+
+    """
+    plans: dict[str, list[str]] = {}
+    for shape in QUERY_SHAPES:
+        try:
+            stages, full_scan = await explain_query_shape(shape, databased)
+        except OperationFailure as op_failure:
+            indexes_logger.warning("Could not explain %s: %s", shape.name, op_failure)
+            continue
+
+        plans[shape.name] = stages
+        if shape.hot and full_scan is not None:
+            indexes_logger.warning("Hot query %s on %s is doing a %s, plan: %s", shape.name, shape.collection, full_scan, " <- ".join(stages))
+    return plans
+
+
+async def self_check(create: bool) -> None:
+    """Prints the winning plan for every query shape.
+
+    :param create: Create the declared indexes before explaining
+
+    :returns: None
+
+    """
+    async with get_databased() as databased:
+        if create:
+            await ensure_indexes(databased)
+        for shape in QUERY_SHAPES:
+            stages, full_scan = await explain_query_shape(shape, databased)
+            print(f"[{full_scan or 'ok':>11}] {shape.collection}.{shape.name}: {' <- '.join(stages)}")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Checks the dataBased indexes and prints the query plan of every query the bot runs.")
+    parser.add_argument("--create", action="store_true", help="create missing indexes before explaining")
+    args = parser.parse_args()
+    asyncio.run(self_check(create=args.create))
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import traceback
+from time import monotonic
+from typing import Optional
+
+from aiohttp import ClientError, ClientSession
+from attrs import define, field
+
+from metrics import ERROR_REPORTS
+from utility_functions import create_logger, send_traceback_to_discord
+
+reporter_logger = create_logger(logger_name="basedcount_bot")
+
+
+def fingerprint(exc: BaseException) -> str:
+    """Identifies an error by its exception type and the functions on its stack.
+
+    Line numbers and the message are left out, so the same failure still matches after a deploy or with a different comment id in the message.
+
+    :param exc: caught exception
+
+    :returns: hex digest of the fingerprint
+
+    """
+    frames = traceback.extract_tb(exc.__traceback__)
+    stack = "|".join(f"{frame.filename.rsplit('/', 1)[-1]}:{frame.name}" for frame in frames)
+    return hashlib.sha1(f"{type(exc).__module__}.{type(exc).__qualname__}|{stack}".encode(), usedforsecurity=False).hexdigest()[:16]
+
+
+@define(kw_only=True)
+class ErrorDigest:
+    fingerprint: str
+    exception_name: str
+    exception_message: str
+    exception_body: str
+    # Occurrences since the last digest was sent
+    count: int = 0
+    total: int = 0
+    last_sent: Optional[float] = None
+
+
+@define(frozen=True, kw_only=True)
+class ErrorOccurrence:
+    fingerprint: str
+    exception_name: str
+    exception_message: str
+    exception_body: str
+
+
+@define(kw_only=True)
+class ErrorReporter:
+    """Reports exceptions to Discord in the background, one digest per fingerprint at most every digest_interval seconds.
+
+    report() never blocks: it puts the error on a bounded queue and drops it when the queue is full. The worker aggregates the occurrences by
+    fingerprint, sends the first occurrence of a new error right away and the repeats as a single digest with their count.
+
+    """
+
+    digest_interval: int = 900
+    max_queued: int = 100
+    max_fingerprints: int = 1000
+    _queue: asyncio.Queue[ErrorOccurrence] = field(init=False)
+    _digests: dict[str, ErrorDigest] = field(factory=dict)
+
+    def __attrs_post_init__(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+
+    def report(self, exc: BaseException) -> None:
+        """Queues the exception for reporting without waiting.
+
+        :param exc: caught exception
+
+        :returns: None
+
+        """
+        occurrence = ErrorOccurrence(
+            fingerprint=fingerprint(exc),
+            exception_name=type(exc).__name__,
+            exception_message=str(exc),
+            exception_body="".join(traceback.format_exception(exc)),
+        )
+        try:
+            self._queue.put_nowait(occurrence)
+        except asyncio.QueueFull:
+            ERROR_REPORTS.inc(outcome="dropped")
+
+    def _aggregate(self, occurrence: ErrorOccurrence) -> None:
+        digest = self._digests.get(occurrence.fingerprint)
+        if digest is None:
+            if len(self._digests) >= self.max_fingerprints:
+                self._prune()
+            digest = self._digests[occurrence.fingerprint] = ErrorDigest(
+                fingerprint=occurrence.fingerprint,
+                exception_name=occurrence.exception_name,
+                exception_message=occurrence.exception_message,
+                exception_body=occurrence.exception_body,
+            )
+        else:
+            # Keep the latest traceback, the stack is the same but the message may not be
+            digest.exception_message = occurrence.exception_message
+            digest.exception_body = occurrence.exception_body
+        digest.count += 1
+        digest.total += 1
+        ERROR_REPORTS.inc(outcome="aggregated")
+
+    def _prune(self) -> None:
+        """Forgets the fingerprints that have nothing pending and weren't reported during the last interval."""
+        cutoff = monotonic() - self.digest_interval
+        self._digests = {key: digest for key, digest in self._digests.items() if digest.count or (digest.last_sent is not None and digest.last_sent > cutoff)}
+
+    def _due(self, now: float, force: bool = False) -> list[ErrorDigest]:
+        """Digests with unsent occurrences whose interval has passed.
+
+        :returns: digests to send
+
+        """
+        return [
+            digest
+            for digest in self._digests.values()
+            if digest.count and (force or digest.last_sent is None or now - digest.last_sent >= self.digest_interval)
+        ]
+
+    async def _send(self, digest: ErrorDigest, session: ClientSession) -> None:
+        """Sends one digest. A failure is logged and the occurrences are kept for the next digest.
+
+        :returns: None
+
+        """
+        message = digest.exception_message
+        if digest.count > 1 or digest.last_sent is not None:
+            message = f"{message} (x{digest.count} since the last report, x{digest.total} in total, fingerprint {digest.fingerprint})"
+        # Set before sending, so a failing webhook is retried after the interval and not in a loop
+        digest.last_sent = monotonic()
+        try:
+            sent = await send_traceback_to_discord(digest.exception_name, message, digest.exception_body, session)
+        except ClientError:
+            reporter_logger.warning("Could not report %s to Discord", digest.fingerprint, exc_info=True)
+            sent = False
+        else:
+            if not sent:
+                reporter_logger.warning("PasteBin or the Discord webhook refused the report of %s", digest.fingerprint)
+        if not sent:
+            ERROR_REPORTS.inc(outcome="failed")
+            return
+        digest.count = 0
+        ERROR_REPORTS.inc(outcome="sent")
+
+    async def run(self) -> None:
+        """Worker that aggregates the queued errors and sends the digests that are due, with one shared session.
+
+        :returns: None
+
+        """
+        async with ClientSession() as session:
+            try:
+                while True:
+                    pending = [(digest.last_sent or 0) + self.digest_interval for digest in self._digests.values() if digest.count]
+                    timeout = max(min(pending) - monotonic(), 0) if pending else None
+                    try:
+                        self._aggregate(await asyncio.wait_for(self._queue.get(), timeout))
+                        while not self._queue.empty():
+                            self._aggregate(self._queue.get_nowait())
+                    except TimeoutError:
+                        pass
+                    for digest in self._due(monotonic()):
+                        await self._send(digest, session)
+            finally:
+                await self._flush(session)
+
+    async def _flush(self, session: ClientSession, timeout: float = 10) -> None:
+        """Sends whatever is still pending on shutdown, giving up after timeout seconds.
+
+        :returns: None
+
+        """
+        while not self._queue.empty():
+            self._aggregate(self._queue.get_nowait())
+        try:
+            async with asyncio.timeout(timeout):
+                for digest in self._due(monotonic(), force=True):
+                    await self._send(digest, session)
+        except TimeoutError:
+            reporter_logger.warning("Gave up sending the pending error reports")
+
+
+error_reporter = ErrorReporter()
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import monotonic
+from typing import IO, Any, Optional
+
+from attrs import define
+from bson import ObjectId
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+
+from utility_functions import create_logger, get_databased, get_mongo_collection, setup_logging
+
+export_logger = create_logger(logger_name="basedcount_bot")
+
+# What basedcount.com and the analytics read, basedTime grows with every based and stays out
+EXPORT_PROJECTION = {
+    "_id": 0,
+    "name": 1,
+    "flair": 1,
+    "count": 1,
+    "pills": 1,
+    "compass": 1,
+    "sapply": 1,
+    "mergedAccounts": 1,
+    "combinedCount": 1,
+    "combinedPillCount": 1,
+    "unsubscribed": 1,
+    "is_lemmy": 1,
+    "lastModified": 1,
+}
+# A write stamped just before an export started can commit after the cursor passed its profile, the next delta overlaps by this much
+MARKER_OVERLAP = timedelta(minutes=5)
+# Only the bot stamps lastModified, a full export at least this often picks up what other writers changed since
+FULL_EXPORT_INTERVAL = timedelta(days=7)
+# Only the profiles this bot writes, the reddit profiles in the same collection are never stamped
+EXPORT_QUERY = {"is_lemmy": True}
+
+
+@define(kw_only=True)
+class ExportResult:
+    documents: int
+    full: bool
+    # Server time the export started at, the next delta exports the profiles modified since
+    marker: datetime
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _open_snapshot(path: Path, gzipped: bool) -> IO[str]:
+    if gzipped:
+        return gzip.open(path, "wt", encoding="utf-8")
+    return path.open("w", encoding="utf-8")
+
+
+def read_marker(state_path: Path, key: str = "marker") -> Optional[datetime]:
+    """Marker of the last export, None when there was none.
+
+    :param state_path: state file written by export_users
+    :param key: marker, or full_marker for the last full export
+
+    :returns: the server time the last export started at
+
+    """
+    try:
+        marker = json.loads(state_path.read_text()).get(key)
+    except FileNotFoundError:
+        return None
+    return None if marker is None else datetime.fromisoformat(marker)
+
+
+async def export_users(
+    databased: AsyncIOMotorDatabase,
+    output: Path,
+    state_path: Path,
+    delta: bool = False,
+    batch_size: int = 500,
+    max_rate: float = 2000,
+    full_interval: timedelta = FULL_EXPORT_INTERVAL,
+) -> ExportResult:
+    """Streams the lemmy profiles of the users collection into a line-delimited JSON snapshot, one profile per line.
+
+    Profiles are read like the read-only commands, from a secondary when there is one, a batch at a time and written as they arrive, so memory
+    doesn't grow with the collection. The read rate is capped at max_rate profiles per second to leave the primary's cache and the network to
+    the bot. The snapshot is written next to output and renamed once complete, so readers never see half a file. An output ending in .gz is
+    gzipped.
+
+    A delta only holds the profiles stamped with lastModified since the previous export. The bot and its repair tools stamp every write, other
+    writers (merges made on the website, manual fixes) don't and their changes only show up in the next full export, any other writer has to
+    $currentDate lastModified too for deltas to see it. A delta is turned into a full export when the last full one is older than
+    full_interval, so snapshot plus deltas can't drift for longer than that.
+
+    :param databased: MongoDB database used to get the collections
+    :param output: snapshot file
+    :param state_path: keeps the marker of the last export for the next delta
+    :param delta: only export the profiles modified since the last export, a full export when there was none
+    :param batch_size: profiles per cursor batch
+    :param max_rate: profiles read per second at most
+    :param full_interval: age of the last full export after which a delta exports every profile anyway
+
+    :returns: what was exported
+
+    """
+    users_collection = await get_mongo_collection(collection_name="users", databased=databased, read_only=True)
+    marker = (await databased.command("hello"))["localTime"]
+
+    since = read_marker(state_path) if delta else None
+    last_full = read_marker(state_path, "full_marker")
+    if delta and since is None:
+        export_logger.warning("No previous export in %s, exporting every profile", state_path)
+    elif since is not None and (last_full is None or marker - last_full > full_interval):
+        export_logger.info("Last full export is older than %s, exporting every profile", full_interval)
+        since = None
+    if since is None:
+        cursor = users_collection.find(EXPORT_QUERY, EXPORT_PROJECTION, sort=[("_id", ASCENDING)], batch_size=batch_size)
+    else:
+        cursor = users_collection.find(
+            EXPORT_QUERY | {"lastModified": {"$gt": since - MARKER_OVERLAP}},
+            EXPORT_PROJECTION,
+            sort=[("lastModified", ASCENDING)],
+            batch_size=batch_size,
+        )
+
+    partial = output.with_name(f"{output.name}.partial")
+    documents, started = 0, monotonic()
+    try:
+        with _open_snapshot(partial, gzipped=output.name.endswith(".gz")) as snapshot:
+            async for profile in cursor:
+                snapshot.write(json.dumps(profile, separators=(",", ":"), default=_json_default) + "\n")
+                documents += 1
+                if documents % batch_size == 0:
+                    # Sleeps off whatever the export is ahead of max_rate
+                    await asyncio.sleep(max(0.0, documents / max_rate - (monotonic() - started)))
+                    export_logger.debug("Exported %s profiles", documents)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    os.replace(partial, output)
+
+    result = ExportResult(documents=documents, full=since is None, marker=marker)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    full_marker = marker if result.full else last_full
+    state_path.write_text(
+        json.dumps(
+            {
+                "marker": marker.isoformat(),
+                "full_marker": None if full_marker is None else full_marker.isoformat(),
+                "documents": documents,
+                "full": result.full,
+                "output": str(output),
+            }
+        )
+    )
+    export_logger.info("Exported %s profiles to %s in %.1f seconds", documents, output, monotonic() - started)
+    return result
+
+
+async def main(output: Path, state_path: Path, delta: bool, batch_size: int, max_rate: float, full_days: float) -> None:
+    async with get_databased() as databased:
+        result = await export_users(
+            databased, output, state_path, delta=delta, batch_size=batch_size, max_rate=max_rate, full_interval=timedelta(days=full_days)
+        )
+    print(f"{'Full export' if result.full else 'Delta'} of {result.documents} profiles written to {output}, marker {result.marker.isoformat()}")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Exports the lemmy profiles of the dataBased users collection as line-delimited JSON, one per line.")
+    parser.add_argument("output", type=Path, help="snapshot file, gzipped when it ends with .gz")
+    parser.add_argument("--delta", action="store_true", help="only export the profiles modified since the last export")
+    parser.add_argument("--state", type=Path, default=Path("logs/export_users.json"), help="keeps the marker of the last export")
+    parser.add_argument("--batch-size", type=int, default=500, help="profiles per cursor batch (default: 500)")
+    parser.add_argument("--max-rate", type=float, default=2000, help="profiles read per second at most (default: 2000)")
+    parser.add_argument("--full-every", type=float, default=7, help="days after which --delta does a full export anyway (default: 7)")
+    args = parser.parse_args()
+    asyncio.run(main(args.output, args.state, args.delta, args.batch_size, args.max_rate, args.full_every))
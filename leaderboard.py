@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+from bisect import bisect_left, insort
+from time import time
+from typing import Any, Mapping, Optional
+
+from attrs import define, field
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import DESCENDING
+
+from utility_functions import create_logger, get_mongo_collection
+
+leaderboard_logger = create_logger(logger_name="basedcount_bot")
+
+# Boards hold more entries than /mostbased shows, so a user knocked off the top by an external edit is replaced from the buffer until the next reseed
+BOARD_CAPACITY = 50
+LEADERBOARD_QUERY = {"is_lemmy": True}
+
+
+@define(kw_only=True)
+class TopN:
+    """Users with the highest based count, sorted by count and then by name."""
+
+    capacity: int
+    _order: list[tuple[int, str]] = field(factory=list)
+    _counts: dict[str, int] = field(factory=dict)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._counts
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def update(self, name: str, count: int) -> None:
+        """Records the new count of a user, adding them if they beat the last place.
+
+        :param name: actor id of the user
+        :param count: their new based count
+
+        :returns: None
+
+        """
+        if name in self._counts:
+            self.remove(name)
+        elif len(self._order) >= self.capacity and (-count, name) >= self._order[-1]:
+            return
+
+        insort(self._order, (-count, name))
+        self._counts[name] = count
+        if len(self._order) > self.capacity:
+            _, dropped_name = self._order.pop()
+            del self._counts[dropped_name]
+
+    def remove(self, name: str) -> None:
+        """Removes the user from the board if they are on it.
+
+        :param name: actor id of the user
+
+        :returns: None
+
+        """
+        count = self._counts.pop(name, None)
+        if count is not None:
+            del self._order[bisect_left(self._order, (-count, name))]
+
+    def top(self, limit: int) -> list[tuple[str, int]]:
+        """Returns the first places of the board.
+
+        :param limit: number of places to return
+
+        :returns: list of (actor id, based count) tuples, highest count first
+
+        """
+        return [(name, -negative_count) for negative_count, name in self._order[:limit]]
+
+
+@define(kw_only=True)
+class Leaderboard:
+    """Overall and per flair boards, seeded from Mongo and kept current from the bot's own based count updates."""
+
+    capacity: int = BOARD_CAPACITY
+    overall: TopN = field()
+    flairs: dict[str, TopN] = field(factory=dict)
+    # Flair of every user on a board, so they can be moved when their flair changes
+    user_flairs: dict[str, str] = field(factory=dict)
+    dirty: bool = False
+
+    @overall.default
+    def _overall_default(self) -> TopN:
+        return TopN(capacity=self.capacity)
+
+    def record(self, name: str, flair: str, count: int) -> None:
+        """Applies a based count update to the overall and the flair board.
+
+        :param name: actor id of the user
+        :param flair: their current flair
+        :param count: their new based count
+
+        :returns: None
+
+        """
+        old_flair = self.user_flairs.get(name)
+        if old_flair is not None and old_flair != flair:
+            self.flairs[old_flair].remove(name)
+
+        flair_board = self.flairs.setdefault(flair, TopN(capacity=self.capacity))
+        self.overall.update(name, count)
+        flair_board.update(name, count)
+
+        if name in self.overall or name in flair_board:
+            self.user_flairs[name] = flair
+        else:
+            self.user_flairs.pop(name, None)
+        self.dirty = True
+
+    def top(self, limit: int, flair: Optional[str] = None) -> list[tuple[str, int]]:
+        """Returns the first places of the overall board, or of a flair board matched case insensitively.
+
+        :param limit: number of places to return
+        :param flair: flair name, the overall board is used when None
+
+        :returns: list of (actor id, based count) tuples, empty if the flair has no board
+
+        """
+        if flair is None:
+            return self.overall.top(limit)
+        flair_name = self.flair_name(flair)
+        return self.flairs[flair_name].top(limit) if flair_name is not None else []
+
+    def flair_name(self, flair: str) -> Optional[str]:
+        """Finds the flair board matching the name case insensitively, commands arrive lower cased.
+
+        :param flair: flair name as typed by the user
+
+        :returns: the flair name as stored, or None if no user with that flair is on the leaderboard
+
+        """
+        for flair_name, board in self.flairs.items():
+            if flair_name.lower() == flair.lower() and len(board):
+                return flair_name
+        return None
+
+    def to_document(self) -> dict[str, Any]:
+        """Materialized form of the leaderboard, stored in the leaderboards collection.
+
+        :returns: dict with the overall and per flair top users
+
+        """
+        return {
+            "overall": [{"name": name, "count": count} for name, count in self.overall.top(self.capacity)],
+            "flairs": {flair: [{"name": name, "count": count} for name, count in board.top(self.capacity)] for flair, board in self.flairs.items()},
+            "updatedAt": int(time()),
+        }
+
+
+leaderboard = Leaderboard()
+
+
+async def seed_leaderboard(databased: AsyncIOMotorDatabase) -> None:
+    """Builds the leaderboard from the users collection and swaps it in.
+
+    Uses one sorted, limited query per board, both backed by the count indexes in database_indexes.py.
+
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    users_collection = await get_mongo_collection(collection_name="users", databased=databased)
+    projection = {"_id": 0, "name": 1, "count": 1, "flair": 1}
+
+    async def top_profiles(query: dict[str, Any]) -> list[Mapping[str, Any]]:
+        cursor = users_collection.find(query, projection=projection).sort("count", DESCENDING).limit(BOARD_CAPACITY)
+        return await cursor.to_list(length=BOARD_CAPACITY)
+
+    flair_names = await users_collection.distinct("flair", LEADERBOARD_QUERY)
+    board_profiles = await asyncio.gather(top_profiles(LEADERBOARD_QUERY), *[top_profiles({**LEADERBOARD_QUERY, "flair": flair}) for flair in flair_names])
+
+    new_leaderboard = Leaderboard()
+    for profiles in board_profiles:
+        for profile in profiles:
+            new_leaderboard.record(profile["name"], profile.get("flair", "Unflaired"), profile["count"])
+    # Swapped in place since other modules hold a reference to the leaderboard object
+    leaderboard.overall, leaderboard.flairs, leaderboard.user_flairs = new_leaderboard.overall, new_leaderboard.flairs, new_leaderboard.user_flairs
+    leaderboard.dirty = True
+    leaderboard_logger.info("Seeded leaderboard with %d users and %d flairs", len(leaderboard.overall), len(leaderboard.flairs))
+
+
+async def persist_leaderboard(databased: AsyncIOMotorDatabase) -> None:
+    """Saves the leaderboard as a materialized document if it changed since it was last saved.
+
+    A failed save leaves the leaderboard dirty so the next one retries it.
+
+    :param databased: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    if not leaderboard.dirty:
+        return
+    leaderboards_collection = await get_mongo_collection(collection_name="leaderboards", databased=databased)
+    document = leaderboard.to_document()
+    # Cleared before the write so a based recorded while it is in flight marks the leaderboard dirty again
+    leaderboard.dirty = False
+    try:
+        await leaderboards_collection.replace_one({"_id": "mostbased"}, document, upsert=True)
+    except BaseException:
+        leaderboard.dirty = True
+        raise
+
+
+async def maintain_leaderboard(databased: AsyncIOMotorDatabase, persist: bool, persist_interval: int = 60, reseed_interval: int = 1800) -> None:
+    """Periodically persists the leaderboard and reseeds it so edits made outside the bot show up.
+
+    :param databased: MongoDB database used to get the collections
+    :param persist: Whether the materialized document should be written at all
+    :param persist_interval: Seconds between saves of the materialized document
+    :param reseed_interval: Seconds between full reseeds from the users collection
+
+    :returns: None
+
+    """
+    last_seeded = time()
+    while True:
+        await asyncio.sleep(persist_interval)
+        try:
+            if time() - last_seeded >= reseed_interval:
+                await seed_leaderboard(databased)
+                last_seeded = time()
+            if persist:
+                await persist_leaderboard(databased)
+        except Exception:
+            leaderboard_logger.warning("Could not maintain the leaderboard", exc_info=True)
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import socket
+import sys
+import threading
+from collections import deque
+from functools import partial
+from os import getenv
+from pathlib import Path
+from statistics import quantiles
+from time import monotonic
+from typing import Optional
+
+from attrs import define, field
+
+from metrics import LOOP_LAG_QUANTILE, LOOP_LAG_SECONDS, SLOW_CALLBACKS
+from utility_functions import create_logger
+
+watchdog_logger = create_logger(logger_name="basedcount_bot")
+
+LAG_QUANTILES = (0.5, 0.9, 0.99, 1.0)
+
+
+def sd_notify(state: str) -> bool:
+    """Sends a state update to systemd, a no-op when the bot isn't started by a Type=notify unit.
+
+    :param state: newline separated assignments, e.g. READY=1 or WATCHDOG=1
+
+    :returns: True if the message was sent
+
+    """
+    address = getenv("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # Abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.sendto(state.encode(), address)
+    except OSError:
+        watchdog_logger.warning("Could not notify systemd", exc_info=True)
+        return False
+    return True
+
+
+@define(kw_only=True)
+class LoopWatchdog:
+    """Watches the event loop and the comment stream, and pings the systemd watchdog only while both make progress.
+
+    The lag sampler runs on the loop: it sleeps for interval seconds and records how late it woke up. A monitor thread reads when the sampler is
+    due to wake up next, when it is more than slow_callback seconds overdue it logs the stack the loop thread is stuck in, once per stall. The
+    stream heartbeat is updated after every comment/list poll, failed or not, so only a hung stream stops it.
+
+    """
+
+    interval: float = 0.5
+    slow_callback: float = 0.25
+    loop_timeout: float = 30
+    stream_timeout: float = 600
+    window: int = 600
+    _lags: deque[float] = field(init=False)
+    # When the lag sampler should wake up from its current sleep
+    _next_wake: float = field(factory=monotonic)
+    _last_poll: float = field(factory=monotonic)
+    _loop_thread_id: Optional[int] = None
+    _stop: threading.Event = field(factory=threading.Event)
+    # Set on the first progress of the comment stream, startup is over from then on
+    stream_started: asyncio.Event = field(factory=asyncio.Event)
+
+    def __attrs_post_init__(self) -> None:
+        self._lags = deque(maxlen=self.window)
+
+    def stream_progress(self, method: str, endpoint: str, status: int, seconds: float) -> None:
+        """Request observer for RequestBuilder, every finished poll of the stream counts as progress."""
+        if endpoint == "comment/list":
+            self.mark_stream_progress()
+
+    def mark_stream_progress(self) -> None:
+        """Records progress of a comment source that doesn't poll, e.g. a notification or keepalive on the Postgres connection."""
+        self._last_poll = monotonic()
+        if not self.stream_started.is_set():
+            self.stream_started.set()
+
+    def lag_quantile(self, quantile: float) -> float:
+        """Quantile of the loop lag over the last window samples.
+
+        :returns: lag in seconds
+
+        """
+        lags = list(self._lags)
+        if not lags:
+            return 0.0
+        if quantile >= 1.0:
+            return max(lags)
+        if len(lags) == 1:
+            return lags[0]
+        return quantiles(lags, n=100, method="inclusive")[round(quantile * 100) - 1]
+
+    async def sample_lag(self) -> None:
+        """Measures how late the loop wakes up from a sleep, the time callbacks kept it busy.
+
+        :returns: None
+
+        """
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        for quantile in LAG_QUANTILES:
+            LOOP_LAG_QUANTILE.set_function(partial(self.lag_quantile, quantile), quantile=str(quantile))
+
+        while True:
+            expected = loop.time() + self.interval
+            self._next_wake = monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            self._lags.append(lag)
+            LOOP_LAG_SECONDS.observe(lag)
+
+    def stalled(self) -> Optional[str]:
+        """Tells why the bot should be considered stalled.
+
+        :returns: the reason, None while the loop and the stream make progress
+
+        """
+        now = monotonic()
+        if now - self._next_wake > self.loop_timeout:
+            return f"event loop blocked for {now - self._next_wake:.0f} seconds"
+        if now - self._last_poll > self.stream_timeout:
+            return f"no progress on the comment stream for {now - self._last_poll:.0f} seconds"
+        return None
+
+    def _loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread_id or 0)
+        stack = []
+        while frame is not None:
+            stack.append(f"  {Path(frame.f_code.co_filename).name}:{frame.f_lineno} in {frame.f_code.co_name}")
+            frame = frame.f_back
+        return "\n".join(reversed(stack))
+
+    def _monitor(self, ping_interval: Optional[float]) -> None:
+        """Monitor thread, reports blocking callbacks and feeds the systemd watchdog.
+
+        :param ping_interval: seconds between watchdog pings, None when systemd doesn't watch the bot
+
+        """
+        reported_wake = 0.0
+        last_ping = 0.0
+        was_stalled = False
+        while not self._stop.wait(min(self.slow_callback / 2, ping_interval or self.slow_callback)):
+            now = monotonic()
+            next_wake = self._next_wake
+            # An idle loop sleeps interval seconds between ticks, only the time past the wake up counts as blocked
+            if now - next_wake > self.slow_callback and next_wake != reported_wake:
+                reported_wake = next_wake
+                SLOW_CALLBACKS.inc()
+                watchdog_logger.warning("Event loop blocked for more than %.2f seconds in:\n%s", self.slow_callback, self._loop_stack())
+
+            if ping_interval is None or now - last_ping < ping_interval:
+                continue
+            reason = self.stalled()
+            if reason is None:
+                sd_notify("WATCHDOG=1")
+                last_ping = now
+                was_stalled = False
+            elif not was_stalled:
+                # Stop pinging and let systemd restart the bot once WatchdogSec runs out
+                watchdog_logger.error("Bot is stalled (%s), no longer pinging the systemd watchdog", reason)
+                sd_notify(f"STATUS=Stalled: {reason}")
+                was_stalled = True
+
+    def start(self) -> None:
+        """Starts the monitor thread. Pings the systemd watchdog at half of WatchdogSec when the unit has one.
+
+        :returns: None
+
+        """
+        self._last_poll = monotonic()
+        self._next_wake = self._last_poll + self.interval
+        watchdog_usec = getenv("WATCHDOG_USEC")
+        ping_interval = int(watchdog_usec) / 1_000_000 / 2 if watchdog_usec else None
+        threading.Thread(target=self._monitor, args=(ping_interval,), name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+loop_watchdog = LoopWatchdog()
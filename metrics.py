@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterator, Optional
+
+from aiohttp import web
+from pymongo import monitoring
+
+# Seconds, from a fast Mongo query up to a slow reply POST
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Seconds the event loop woke up late, anything above a few milliseconds means something blocked it
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Seconds from a comment being published to the bot replying to it, includes the polling delay
+END_TO_END_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: LabelValues, extra: str = "") -> str:
+    """Formats labels the way the Prometheus text format wants them.
+
+    :returns: label string including the braces, or an empty string when there are no labels
+
+    """
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, (_escape(value) for value in label_values))]
+    if extra:
+        pairs.append(extra)
+    return f"{{{','.join(pairs)}}}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric(ABC):
+    """Base class of the metric types, holds the name, help and label names and renders the header."""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        # Metrics are updated from pymongo's monitoring threads as well as the event loop
+        self._lock = Lock()
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        if labels.keys() != set(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}", *self._samples()]
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        """Sample lines of the metric in the Prometheus text format."""
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+        self._functions: dict[LabelValues, Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        label_values = self._label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        """Reads the count from the function every time the metrics are scraped, for counts kept by a library.
+
+        :param function: returns the current count, which must never decrease
+        :param labels: label values of the series
+
+        """
+        self._functions[self._label_values(labels)] = function
+
+    def value(self, **labels: str) -> float:
+        label_values = self._label_values(labels)
+        if (function := self._functions.get(label_values)) is not None:
+            return function()
+        return self._values.get(label_values, 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        values.update({label_values: function() for label_values, function in self._functions.items()})
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {value}" for label_values, value in values.items()]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+        self._functions: dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        label_values = self._label_values(labels)
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        """Reads the gauge value from the function every time the metrics are scraped.
+
+        :param function: returns the current value
+        :param labels: label values of the series
+
+        """
+        self._functions[self._label_values(labels)] = function
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        values.update({label_values: function() for label_values, function in self._functions.items()})
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {value}" for label_values, value in values.items()]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+        # Per series: count of every bucket (not cumulative, the last one is +Inf), sum and count
+        self._series: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        label_values = self._label_values(labels)
+        bucket_index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            series[0][bucket_index] += 1
+            series[1][0] += value
+            series[1][1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes how long the body of the with block took, even when it raises."""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            series_list = [(label_values, list(bucket_counts), list(totals)) for label_values, (bucket_counts, totals) in self._series.items()]
+
+        samples: list[str] = []
+        for label_values, bucket_counts, (total, count) in series_list:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = f'le="{le}"'
+                samples.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, le_label)} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.label_names, label_values)} {total}")
+            samples.append(f"{self.name}_count{_format_labels(self.label_names, label_values)} {int(count)}")
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def counter(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        self.register(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        metric = Gauge(name, documentation, label_names)
+        self.register(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, label_names, buckets)
+        self.register(metric)
+        return metric
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format.
+
+        :returns: the text served on /metrics
+
+        """
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+LEMMY_REQUEST_SECONDS = registry.histogram("lemmy_request_seconds", "Lemmy API request latency, comment/list is the poll", ("method", "endpoint"))
+PARENT_INFO_SECONDS = registry.histogram("get_parent_info_seconds", "Time to fetch the parent comment/post and its author's flair")
+FLAIR_SECONDS = registry.histogram("get_flair_seconds", "Flair API request latency")
+MONGO_COMMAND_SECONDS = registry.histogram("mongo_command_seconds", "MongoDB command latency", ("command", "collection"))
+REPLY_SECONDS = registry.histogram("reply_seconds", "Time to post a reply")
+END_TO_END_SECONDS = registry.histogram("comment_to_reply_seconds", "Time from a comment being published to the bot replying to it", buckets=END_TO_END_BUCKETS)
+COMMENT_DETECTION_SECONDS = registry.histogram(
+    "comment_detection_seconds",
+    "Time from a comment being published to the bot reading it, by ingest source",
+    ("source",),
+    buckets=LOOP_LAG_BUCKETS + (10.0, 30.0),
+)
+PG_HYDRATE_SECONDS = registry.histogram("pg_hydrate_seconds", "Time to load a batch of notified comments from Postgres")
+LOOP_LAG_SECONDS = registry.histogram("event_loop_lag_seconds", "How late the event loop woke up from a sleep", buckets=LOOP_LAG_BUCKETS)
+
+COMMENTS_SEEN = registry.counter("comments_seen_total", "Comments read from the pcm stream")
+BASES_AWARDED = registry.counter("bases_awarded_total", "Based counts given out")
+COMMANDS = registry.counter("commands_total", "Bot commands received", ("command",))
+INBOX_ITEMS = registry.counter("inbox_items_total", "Mentions, replies and private messages read from the inbox, outside pcm", ("kind",))
+ERRORS = registry.counter("errors_total", "Failed calls to a dependency", ("dependency",))
+ERROR_REPORTS = registry.counter("error_reports_total", "Caught exceptions by what the error reporter did with them", ("outcome",))
+
+CLAIMS = registry.counter(
+    "comment_claims_total",
+    "Comment claims by this replica, duplicate means another replica had it, taken_over that it died or stalled before completing it",
+    ("outcome",),
+)
+WORKER_RESTARTS = registry.counter("worker_restarts_total", "Worker processes found dead and restarted", ("worker",))
+SCHEDULED_JOBS = registry.counter("scheduled_jobs_total", "Comment jobs by priority class and what the scheduler did with them", ("priority", "outcome"))
+INGEST_FALLBACKS = registry.counter("ingest_fallbacks_total", "Times the Postgres comment source failed and the bot went back to polling")
+REQUESTS_COALESCED = registry.counter("requests_coalesced_total", "Requests not sent because an identical one was already in flight", ("kind",))
+MONGO_CHECKOUT_FAILURES = registry.counter(
+    "mongo_checkout_failures_total", "Connections the Mongo pool couldn't hand out, timeout means it was saturated", ("reason",)
+)
+REPLY_CACHE_LOOKUPS = registry.counter("reply_cache_total", "Based count replies served from the cache, rendered, or dropped by a write", ("outcome",))
+THROTTLED_COMMANDS = registry.counter(
+    "throttled_commands_total", "Commands over the per user or per post limit, by limit and what happened to them", ("scope", "outcome")
+)
+SLOW_CALLBACKS = registry.counter("event_loop_blocked_total", "Times the event loop was blocked longer than the slow callback threshold")
+
+BACKOFF_SECONDS = registry.gauge("backoff_seconds", "Current sleep between polls or after an exception", ("kind",))
+BACKGROUND_TASKS = registry.gauge("background_tasks", "Fire and forget tasks still running")
+SHARDS_OWNED = registry.gauge("shards_owned", "Comment shards this replica holds the lease of")
+WORKER_QUEUE_DEPTH = registry.gauge("worker_queue_depth", "Comments waiting for each worker process", ("worker",))
+SCHEDULER_BACKLOG = registry.gauge("scheduler_backlog", "Comment jobs waiting in the scheduler", ("priority",))
+STARTUP_SECONDS = registry.gauge("startup_seconds", "Seconds since the process started at the end of each startup phase", ("phase",))
+INGEST_SOURCE = registry.gauge("ingest_source", "1 for the comment source currently feeding the bot", ("source",))
+MONGO_POOL_CONNECTIONS = registry.gauge("mongo_pool_connections", "Connections of the Mongo pool of each server, open or checked out", ("address", "state"))
+MONGO_POOL_WAITING = registry.gauge("mongo_pool_waiting", "Operations waiting for a connection of the Mongo pool of each server", ("address",))
+MONGO_POOL_MAX_SIZE = registry.gauge("mongo_pool_max_size", "Connections the Mongo pool of each server opens at most")
+LOOP_LAG_QUANTILE = registry.gauge("event_loop_lag_quantile_seconds", "Event loop lag quantiles over the last 600 samples", ("quantile",))
+
+
+def observe_lemmy_request(method: str, endpoint: str, status: int, seconds: float) -> None:
+    """Request observer for RequestBuilder, records the latency and counts the failures.
+
+    :param method: HTTP method
+    :param endpoint: API endpoint without the /api/v3 prefix
+    :param status: HTTP status, 0 when no response was received
+    :param seconds: request duration
+
+    :returns: None
+
+    """
+    LEMMY_REQUEST_SECONDS.observe(seconds, method=method, endpoint=endpoint)
+    if status == 0 or status >= 300:
+        ERRORS.inc(dependency="lemmy")
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records the duration of every command the driver sends, which covers every Mongo operation of the bot."""
+
+    def __init__(self) -> None:
+        self._collections: dict[int, str] = {}
+
+    def _collection(self, event: monitoring.CommandSucceededEvent | monitoring.CommandFailedEvent) -> str:
+        return self._collections.pop(event.request_id, "")
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, command=event.command_name, collection=self._collection(event))
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, command=event.command_name, collection=self._collection(event))
+        ERRORS.inc(dependency="mongo")
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Keeps the pool gauges of every server, checked out connections near the max size and waiting operations mean the pool is saturated."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._counts: dict[tuple[str, str], int] = {}
+
+    def _add(self, address: tuple[str, Optional[int]], kind: str, amount: int) -> None:
+        server = f"{address[0]}:{address[1]}"
+        with self._lock:
+            value = self._counts[(server, kind)] = self._counts.get((server, kind), 0) + amount
+        if kind == "waiting":
+            MONGO_POOL_WAITING.set(value, address=server)
+        else:
+            MONGO_POOL_CONNECTIONS.set(value, address=server, state=kind)
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+        MONGO_POOL_MAX_SIZE.set(event.options.get("maxPoolSize", 100))
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+        pass
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+        pass
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+        self._add(event.address, "open", 1)
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+        pass
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+        self._add(event.address, "open", -1)
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent) -> None:
+        self._add(event.address, "waiting", 1)
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent) -> None:
+        self._add(event.address, "waiting", -1)
+        MONGO_CHECKOUT_FAILURES.inc(reason=event.reason)
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent) -> None:
+        self._add(event.address, "waiting", -1)
+        self._add(event.address, "checked_out", 1)
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+        self._add(event.address, "checked_out", -1)
+
+
+async def start_metrics_server(host: str, port: int, app: Optional[web.Application] = None) -> web.AppRunner:
+    """Starts serving /metrics in the background on the running event loop.
+
+    :param host: interface to bind, keep it local
+    :param port: port to listen on
+    :param app: application to add the route to, a new one is created when None
+
+    :returns: the runner, call cleanup() on it to stop the server
+
+    """
+
+    async def handle_metrics(_: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = app or web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
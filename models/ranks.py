@@ -1,11 +1,12 @@
 from __future__ import annotations
 
-import json
-from typing import Optional
+from bisect import bisect_right
+from typing import Any, Optional
 
-import aiofiles
 from attrs import define
 
+from config_store import config_store
+
 
 @define(kw_only=True)
 class Rank:
@@ -14,24 +15,40 @@ class Rank:
     message: str
 
 
-rank_list: list[Rank] = []
+@define(frozen=True, kw_only=True)
+class RankTable:
+    """Ranks from ranks_dict.json, sorted by value so the rank of a based count is a bisect away."""
 
+    values: tuple[int, ...]
+    names: tuple[str, ...]
+    messages: dict[int, str]
 
-async def load_ranks() -> None:
-    """Loads rank from specified path to a global variable.
+    @classmethod
+    def from_dict(cls, rank_dict: dict[str, Any]) -> RankTable:
+        """Validates the content of ranks_dict.json and builds the lookup table.
 
-    :returns: None
+        :param rank_dict: rank name to {"value": int, "message": str}
 
-    """
-    global rank_list
-    async with aiofiles.open("data_dictionaries/ranks_dict.json", "r") as fp:
-        rank_dict = json.loads(await fp.read())
+        :returns: RankTable
+
+        :raises ValueError: If there are no ranks or the values aren't increasing integers
+
+        """
+        ranks = [Rank(name=key, value=value["value"], message=value["message"]) for key, value in rank_dict.items()]
+        if not ranks:
+            raise ValueError("ranks_dict.json has no ranks")
+        for rank in ranks:
+            if not isinstance(rank.value, int) or not isinstance(rank.message, str):
+                raise ValueError(f"Rank {rank.name!r} needs an int value and a str message")
+        if any(previous.value >= rank.value for previous, rank in zip(ranks, ranks[1:])):
+            raise ValueError("ranks_dict.json values must be strictly increasing")
+        return cls(values=tuple(rank.value for rank in ranks), names=tuple(rank.name for rank in ranks), messages={rank.value: rank.message for rank in ranks})
 
-        for key, value in rank_dict.items():
-            rank_list.append(Rank(name=key, value=value["value"], message=value["message"]))
 
+config_store.register("ranks_dict.json", RankTable.from_dict)
 
-async def rank_name(based_count: int, user: str) -> str:
+
+def rank_name(based_count: int, user: str) -> str:
     """Gets the user rank name from their based count.
 
     :param based_count: user based count
@@ -40,22 +57,17 @@ async def rank_name(based_count: int, user: str) -> str:
     :returns: rank which user is at
 
     """
-    if not rank_list:
-        await load_ranks()
-
     if based_count >= 10_000:
         return f"u/{user}'s Mom"
 
-    for rank_index, rank in enumerate(rank_list):
-        if based_count == rank.value:
-            return rank_list[rank_index].name
-        elif based_count < rank.value:
-            return rank_list[rank_index - 1].name
+    rank_table = config_store.get("ranks_dict.json", RankTable)
+    rank_index = bisect_right(rank_table.values, based_count) - 1
+    if rank_index < 0:
+        raise ValueError("No ranks for the given based count.")
+    return rank_table.names[rank_index]
 
-    raise ValueError("No ranks for the given based count.")
 
-
-async def rank_message(based_count: int) -> Optional[str]:
+def rank_message(based_count: int) -> Optional[str]:
     """Gets the user rank message from their based count if they have reached a new rank
 
     :param based_count: user based count
@@ -63,10 +75,4 @@ async def rank_message(based_count: int) -> Optional[str]:
     :returns: rank message of rank which user is at
 
     """
-    if not rank_list:
-        await load_ranks()
-
-    for r in rank_list:
-        if based_count == r.value:
-            return r.message
-    return None
+    return config_store.get("ranks_dict.json", RankTable).messages.get(based_count)
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from typing import Any
+
+from attrs import define
+
+from config_store import config_store
+
+DEFAULT_SLOW_DOWN_REPLY = "You're sending me commands faster than I can answer them, I'll ignore your commands for a minute."
+
+
+@define(frozen=True, kw_only=True)
+class BotReplies:
+    """Replies from bot_replies.yaml, validated once when the file is loaded."""
+
+    info_message: str
+    my_based_no_user_reply: tuple[str, ...]
+    based_count_no_user_reply: tuple[str, ...]
+    # Sent once to a user over the command limit, older copies of the file don't have it
+    slow_down_reply: str = DEFAULT_SLOW_DOWN_REPLY
+
+    @classmethod
+    def from_dict(cls, replies: dict[str, Any]) -> BotReplies:
+        """Validates the content of bot_replies.yaml.
+
+        :param replies: decoded yaml
+
+        :returns: BotReplies
+
+        :raises ValueError: If a reply is missing or a reply list is empty
+
+        """
+        bot_replies = cls(
+            info_message=replies["info_message"],
+            my_based_no_user_reply=tuple(replies["my_based_no_user_reply"]),
+            based_count_no_user_reply=tuple(replies["based_count_no_user_reply"]),
+            slow_down_reply=replies.get("slow_down_reply", DEFAULT_SLOW_DOWN_REPLY),
+        )
+        if not isinstance(bot_replies.info_message, str) or not bot_replies.info_message:
+            raise ValueError("info_message must be a non empty string")
+        if not bot_replies.my_based_no_user_reply or not bot_replies.based_count_no_user_reply:
+            raise ValueError("The no user reply lists can't be empty")
+        return bot_replies
+
+
+config_store.register("bot_replies.yaml", BotReplies.from_dict)
+
+
+def bot_replies() -> BotReplies:
+    """Returns the current replies from bot_replies.yaml.
+
+    :returns: BotReplies
+
+    """
+    return config_store.get("bot_replies.yaml", BotReplies)
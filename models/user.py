@@ -36,6 +36,9 @@ class User:
     based_time: list[int] = field(factory=list)
     pills: list[Pill] = field(factory=list)
     merged_accounts: list[str] = field(factory=list)
+    # Maintained totals over the main and merged accounts, None for profiles that haven't been backfilled yet
+    combined_based_count: Optional[int] = field(default=None)
+    combined_pill_count: Optional[int] = field(default=None)
 
     # Post Init stuff
     political_compass_type: Optional[str] = field(default=None)
@@ -72,6 +75,8 @@ class User:
             based_time=user_dict.get("basedTime", []),
             pills=pills,
             merged_accounts=user_dict.get("mergedAccounts", []),
+            combined_based_count=user_dict.get("combinedCount"),
+            combined_pill_count=user_dict.get("combinedPillCount"),
         )
         return user_instance
 
@@ -92,12 +97,28 @@ class User:
             "Add compass to profile by replying with /mycompass politicalcompass.org url or sapplyvalues.github.io url.\n\n"
         )
 
+    def format_pills(self, pill_count: int) -> str:
+        """Formats the pill count into a nice string which is replied back to the user
+
+        :param pill_count: Number of pills to show, usually the combined count of all merged accounts
+
+        :returns: str object with pill count and link to website to view all the pills
+
+        """
+        pill_str = f"{pill_count:,}" if pill_count > 0 else "None"
+        return f"[{pill_str} | View pills](https://basedcount.com/u/{self.user_actor_id}/)"
+
     async def combined_formatted_pills(self, user_collection: AsyncIOMotorCollection) -> str:
         """Formats the pills from all merged accounts into a nice string which is replied back to the user
 
+        Uses the maintained combined pill count when the profile has one, otherwise fetches every merged account.
+
         :returns: str object with pill count and link to website to view all the pills
 
         """
+        if self.combined_pill_count is not None:
+            return self.format_pills(self.combined_pill_count)
+
         task_list: list[Any] = []
         for user_name in self.merged_accounts:
             task_list.append(user_collection.find_one({"name": user_name}))
@@ -107,9 +128,22 @@ class User:
         for profile in profile_list:
             pills.extend(profile["pills"])
 
-        combined_pill_count = len(pills) + len(self.pills)
-        pill_str = f"{combined_pill_count:,}" if combined_pill_count > 0 else "None"
-        return f"[{pill_str} | View pills](https://basedcount.com/u/{self.user_actor_id}/)"
+        return self.format_pills(len(pills) + len(self.pills))
+
+    async def get_combined_based_count(self, user_collection: AsyncIOMotorCollection) -> int:
+        """Gets the based count of the main and all merged accounts added together
+
+        Uses the maintained combined count when the profile has one, otherwise fetches every merged account.
+
+        :param user_collection: Mongo db collection object which will be used to fetch data
+
+        :returns: combined based count
+
+        """
+        if self.combined_based_count is not None:
+            return self.combined_based_count
+        all_based_counts = await self.get_all_accounts_based_count(user_collection)
+        return sum(map(lambda x: x[1], all_based_counts))
 
     async def get_all_accounts_based_count(self, user_collection: AsyncIOMotorCollection) -> list[tuple[str, int, int]]:
         """Gets the based count from all the all accounts (main + merged accounts)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from importlib.util import find_spec
+from logging import getLogger
+from os import getenv
+from typing import Any
+
+from attrs import define
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+# utility_functions builds the client from this profile, so the logger doesn't come from its create_logger
+mongo_profile_logger = getLogger("basedcount_bot")
+
+# Module each wire compressor needs, zlib is in the standard library
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+# The lowest maxStalenessSeconds MongoDB accepts
+MIN_STALENESS_SECONDS = 90
+
+
+@define(kw_only=True)
+class MongoProfile:
+    """How the bot talks to MongoDB: pool sizes, wire compression and where the read-only queries go.
+
+    The pool has to cover the fire and forget writes and the request path queries of every comment in flight, an operation that waits longer
+    than wait_queue_timeout_ms for a connection fails instead of piling up behind a saturated pool. Read-only command queries go to a secondary
+    that is at most max_staleness_seconds behind the primary, a user asking for their count right after a based may see the count from a moment
+    ago. Everything else, and every read of a standalone server, stays on the primary.
+
+    """
+
+    max_pool_size: int = 50
+    min_pool_size: int = 0
+    max_connecting: int = 2
+    wait_queue_timeout_ms: int = 2000
+    compressors: tuple[str, ...] = ("zstd", "snappy", "zlib")
+    # 0 keeps the read-only queries on the primary
+    max_staleness_seconds: int = MIN_STALENESS_SECONDS
+
+    def configure_from_env(self) -> None:
+        self.max_pool_size = int(getenv("MONGO_MAX_POOL_SIZE", str(self.max_pool_size)))
+        self.min_pool_size = int(getenv("MONGO_MIN_POOL_SIZE", str(self.min_pool_size)))
+        self.max_connecting = int(getenv("MONGO_MAX_CONNECTING", str(self.max_connecting)))
+        self.wait_queue_timeout_ms = int(getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", str(self.wait_queue_timeout_ms)))
+        self.compressors = tuple(name.strip() for name in getenv("MONGO_COMPRESSORS", ",".join(self.compressors)).split(",") if name.strip())
+        self.max_staleness_seconds = int(getenv("MONGO_READ_MAX_STALENESS_SECONDS", str(self.max_staleness_seconds)))
+        if 0 < self.max_staleness_seconds < MIN_STALENESS_SECONDS:
+            mongo_profile_logger.warning("MONGO_READ_MAX_STALENESS_SECONDS is below %s, using %s", MIN_STALENESS_SECONDS, MIN_STALENESS_SECONDS)
+            self.max_staleness_seconds = MIN_STALENESS_SECONDS
+
+    def available_compressors(self) -> list[str]:
+        """The configured compressors whose module is installed, in order of preference. The server picks the first one it supports too."""
+        available = []
+        for name in self.compressors:
+            module = COMPRESSOR_MODULES.get(name)
+            if module is not None and find_spec(module) is not None:
+                available.append(name)
+            else:
+                mongo_profile_logger.debug("Wire compressor %s is not available", name)
+        return available
+
+    def client_options(self) -> dict[str, Any]:
+        """Keyword arguments of the MongoClient.
+
+        :returns: dict of client options
+
+        """
+        options: dict[str, Any] = {
+            "maxPoolSize": self.max_pool_size,
+            "minPoolSize": self.min_pool_size,
+            "maxConnecting": self.max_connecting,
+            "waitQueueTimeoutMS": self.wait_queue_timeout_ms,
+        }
+        if compressors := self.available_compressors():
+            options["compressors"] = ",".join(compressors)
+        return options
+
+    @property
+    def read_only_preference(self) -> Primary | SecondaryPreferred:
+        if self.max_staleness_seconds <= 0:
+            return Primary()
+        return SecondaryPreferred(max_staleness=self.max_staleness_seconds)
+
+
+mongo_profile = MongoProfile()
@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import socket
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from os import getpid
+from typing import Any, Optional
+from zlib import crc32
+
+from attrs import define, field
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from async_lemmy_py.models.comment import Comment
+from async_lemmy_py.models.private_message import PrivateMessage
+from metrics import CLAIMS, SHARDS_OWNED
+from utility_functions import create_logger, get_mongo_collection
+
+partitions_logger = create_logger(logger_name="basedcount_bot")
+
+REPLICA_PREFIX = "replica:"
+SHARD_PREFIX = "shard:"
+
+
+def shard_of(comment_id: int, shards: int) -> int:
+    return comment_id % shards
+
+
+@define(kw_only=True)
+class PartitionManager:
+    """Splits the comment stream between bot replicas that coordinate through the leases collection.
+
+    Comments are sharded by comment id. Every shard has a lease document owned by one replica until it expires, replicas renew their leases every
+    renew_interval seconds and take over expired ones, so a dead replica's shards move within lease_ttl + renew_interval seconds. Each replica
+    aims for an equal share of the shards, counted from the heartbeat documents of the live replicas.
+
+    Leases alone can overlap for a moment during a takeover, so a comment is only handled after inserting its ap_id into processedComments, whose
+    unique index lets one replica at a time hold the claim. Only based comments and commands are claimed, the bot has nothing to do with the
+    others. Comments of other replicas' shards are kept for backlog_seconds and replayed when their shard is taken over, in case the previous
+    owner died before handling them. The claim is marked completed once the comment was handled, a replayed comment whose claim never completed
+    is taken over when the claiming replica's heartbeat expired, or when it claimed it more than claim_timeout seconds ago.
+
+    With shards set to 0 partitioning is off: every comment is owned and claims always succeed without touching Mongo.
+
+    Only the comments are partitioned. The cheating detector, the command throttle and the leaderboard of every replica only see the comments
+    that replica handled, so with N replicas a cheating ring or a user spamming commands is detected or limited about N times later, and
+    /mostbased may lag until the leaderboard is reseeded from Mongo.
+
+    """
+
+    shards: int = 0
+    replica_id: str = field(factory=lambda: f"{socket.gethostname()}-{getpid()}")
+    lease_ttl: float = 15
+    renew_interval: float = 3
+    backlog_seconds: float = 300
+    claim_timeout: float = 600
+    owned: set[int] = field(factory=set)
+    replay_queue: asyncio.Queue[Comment] = field(factory=asyncio.Queue)
+    _backlog: deque[tuple[datetime, Comment]] = field(factory=deque)
+
+    def configure(self, shards: int, replica_id: Optional[str] = None) -> None:
+        """Turns partitioning on.
+
+        :param shards: number of shards, 0 runs a single instance without leases
+        :param replica_id: name of this replica in the leases, defaults to hostname-pid
+
+        """
+        self.shards = shards
+        if replica_id:
+            self.replica_id = replica_id
+
+    @property
+    def enabled(self) -> bool:
+        return self.shards > 0
+
+    def owns(self, comment_id: int) -> bool:
+        return not self.enabled or shard_of(comment_id, self.shards) in self.owned
+
+    def defer(self, comment: Comment) -> None:
+        """Keeps a comment of another replica's shard in case that replica dies before handling it.
+
+        :param comment: comment from the stream
+
+        :returns: None
+
+        """
+        now = datetime.now(timezone.utc)
+        self._backlog.append((now, comment))
+        while self._backlog and self._backlog[0][0] < now - timedelta(seconds=self.backlog_seconds):
+            self._backlog.popleft()
+
+    async def claim(self, comment: Comment | PrivateMessage, databased: AsyncIOMotorDatabase) -> bool:
+        """Claims a comment or private message for this replica, only one replica at a time holds the claim of an ap_id.
+
+        :param comment: comment or private message about to be handled
+        :param databased: MongoDB database used to get the collections
+
+        :returns: True if this replica should handle the comment
+
+        """
+        if not self.enabled:
+            return True
+        processed_collection = await get_mongo_collection(collection_name="processedComments", databased=databased)
+        try:
+            await processed_collection.insert_one({"ap_id": comment.ap_id, "replica": self.replica_id, "claimedAt": datetime.now(timezone.utc)})
+        except DuplicateKeyError:
+            if await self._take_over(processed_collection, comment.ap_id, databased):
+                CLAIMS.inc(outcome="taken_over")
+                return True
+            CLAIMS.inc(outcome="duplicate")
+            return False
+        CLAIMS.inc(outcome="claimed")
+        return True
+
+    async def _take_over(self, processed_collection: AsyncIOMotorCollection, ap_id: str, databased: AsyncIOMotorDatabase) -> bool:
+        """Takes over the claim of another replica that never completed it, if that replica died or has been at it for claim_timeout seconds.
+
+        :returns: True if this replica holds the claim now
+
+        """
+        claim = await processed_collection.find_one({"ap_id": ap_id})
+        # An own claim that didn't complete is still queued here, or failed
+        if claim is None or "completedAt" in claim or claim["replica"] == self.replica_id:
+            return False
+        now = datetime.now(timezone.utc)
+        leases_collection = await get_mongo_collection(collection_name="leases", databased=databased)
+        alive = await leases_collection.count_documents({"_id": f"{REPLICA_PREFIX}{claim['replica']}", "expiresAt": {"$gt": now}}, limit=1)
+        # Conditional on the claim read above, when several replicas take over at once only one update matches
+        takeover_filter: dict[str, Any] = {"_id": claim["_id"], "replica": claim["replica"], "claimedAt": claim["claimedAt"], "completedAt": {"$exists": False}}
+        if alive:
+            takeover_filter["claimedAt"] = {"$eq": claim["claimedAt"], "$lte": now - timedelta(seconds=self.claim_timeout)}
+        result = await processed_collection.update_one(takeover_filter, {"$set": {"replica": self.replica_id, "claimedAt": now}})
+        if result.modified_count:
+            partitions_logger.info("Took over the claim of %s from %s", ap_id, claim["replica"])
+        return bool(result.modified_count)
+
+    async def complete(self, ap_id: str, databased: AsyncIOMotorDatabase) -> None:
+        """Marks a claimed comment or private message as handled, other replicas don't take the claim over anymore.
+
+        :param ap_id: ap_id of the claimed comment or private message
+        :param databased: MongoDB database used to get the collections
+
+        :returns: None
+
+        """
+        if not self.enabled:
+            return
+        processed_collection = await get_mongo_collection(collection_name="processedComments", databased=databased)
+        try:
+            await processed_collection.update_one({"ap_id": ap_id}, {"$set": {"completedAt": datetime.now(timezone.utc)}})
+        except PyMongoError:
+            partitions_logger.warning("Could not mark %s as handled", ap_id, exc_info=True)
+
+    async def _heartbeat(self, leases_collection: AsyncIOMotorCollection, now: datetime) -> int:
+        """Refreshes this replica's heartbeat and counts the live replicas, this one included.
+
+        :returns: number of live replicas
+
+        """
+        await leases_collection.update_one(
+            {"_id": f"{REPLICA_PREFIX}{self.replica_id}"}, {"$set": {"expiresAt": now + timedelta(seconds=self.lease_ttl)}}, upsert=True
+        )
+        return int(await leases_collection.count_documents({"_id": {"$regex": f"^{REPLICA_PREFIX}"}, "expiresAt": {"$gt": now}}))
+
+    async def _acquire(self, leases_collection: AsyncIOMotorCollection, shard: int, now: datetime) -> bool:
+        """Takes or renews the lease of a shard, fails if another replica holds an unexpired lease.
+
+        :returns: True if this replica owns the shard
+
+        """
+        try:
+            lease = await leases_collection.find_one_and_update(
+                {"_id": f"{SHARD_PREFIX}{shard}", "$or": [{"owner": self.replica_id}, {"expiresAt": {"$lte": now}}]},
+                {"$set": {"owner": self.replica_id, "expiresAt": now + timedelta(seconds=self.lease_ttl)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The lease exists and belongs to a live replica, the upsert tried to insert a second one
+            return False
+        return lease is not None and bool(lease["owner"] == self.replica_id)
+
+    async def _release(self, leases_collection: AsyncIOMotorCollection, shard: int) -> None:
+        await leases_collection.update_one({"_id": f"{SHARD_PREFIX}{shard}", "owner": self.replica_id}, {"$set": {"expiresAt": datetime.now(timezone.utc)}})
+
+    async def rebalance(self, databased: AsyncIOMotorDatabase) -> None:
+        """Renews the owned leases, gives up the shards above this replica's share and takes free ones below it.
+
+        :param databased: MongoDB database used to get the collections
+
+        :returns: None
+
+        """
+        leases_collection = await get_mongo_collection(collection_name="leases", databased=databased)
+        now = datetime.now(timezone.utc)
+        target = math.ceil(self.shards / await self._heartbeat(leases_collection, now))
+
+        owned: set[int] = set()
+        for shard in sorted(self.owned):
+            if len(owned) < target and await self._acquire(leases_collection, shard, now):
+                owned.add(shard)
+            elif len(owned) >= target:
+                await self._release(leases_collection, shard)
+        # Start at a different shard on every replica so they don't all race for the same free lease
+        offset = crc32(self.replica_id.encode()) % self.shards
+        for shard in ((offset + index) % self.shards for index in range(self.shards)):
+            if len(owned) >= target:
+                break
+            if shard not in owned and await self._acquire(leases_collection, shard, now):
+                owned.add(shard)
+
+        lost, gained = self.owned - owned, owned - self.owned
+        self.owned = owned
+        SHARDS_OWNED.set(len(owned))
+        if lost or gained:
+            partitions_logger.info("Replica %s owns shards %s (lost %s, gained %s)", self.replica_id, sorted(owned), sorted(lost), sorted(gained))
+        if gained:
+            self._replay(gained)
+
+    def _replay(self, shards: set[int]) -> None:
+        """Queues the recent comments of newly owned shards, the claims drop the ones the previous owner already handled."""
+        kept: deque[tuple[datetime, Comment]] = deque()
+        for deferred_at, comment in self._backlog:
+            if shard_of(comment.comment_id, self.shards) in shards:
+                self.replay_queue.put_nowait(comment)
+            else:
+                kept.append((deferred_at, comment))
+        self._backlog = kept
+
+    async def maintain(self, databased: AsyncIOMotorDatabase) -> None:
+        """Keeps the leases renewed and balanced until cancelled, then releases them so the other replicas take over right away.
+
+        :param databased: MongoDB database used to get the collections
+
+        :returns: None
+
+        """
+        if not self.enabled:
+            return
+        try:
+            while True:
+                try:
+                    await self.rebalance(databased)
+                except PyMongoError:
+                    partitions_logger.warning("Could not renew the shard leases", exc_info=True)
+                    # Stop handling comments once the leases may have expired, another replica takes them over
+                    if self.owned:
+                        self.owned = set()
+                        SHARDS_OWNED.set(0)
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            await self.release_all(databased)
+
+    async def release_all(self, databased: AsyncIOMotorDatabase) -> None:
+        """Gives up every lease and the heartbeat.
+
+        :returns: None
+
+        """
+        owned, self.owned = self.owned, set()
+        try:
+            leases_collection = await get_mongo_collection(collection_name="leases", databased=databased)
+            for shard in owned:
+                await self._release(leases_collection, shard)
+            await leases_collection.delete_one({"_id": f"{REPLICA_PREFIX}{self.replica_id}"})
+        except PyMongoError:
+            partitions_logger.warning("Could not release the shard leases, they expire in %s seconds", self.lease_ttl, exc_info=True)
+
+
+partition_manager = PartitionManager()
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from functools import partial
+from time import time
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Optional
+
+from attrs import define, field
+from cachetools import Cache
+
+from async_lemmy_py import AsyncLemmyPy
+from async_lemmy_py.models.comment import Comment
+from loop_watchdog import loop_watchdog
+from metrics import COMMENT_DETECTION_SECONDS, INGEST_FALLBACKS, INGEST_SOURCE, PG_HYDRATE_SECONDS
+from utility_functions import create_logger
+
+if TYPE_CHECKING:
+    import asyncpg
+
+pg_ingest_logger = create_logger(logger_name="basedcount_bot")
+
+# Channel of the trigger in sql/comment_notify.sql
+NOTIFY_CHANNEL = "basedcount_comment"
+SOURCES = ("postgres", "polling")
+
+# Builds the same comment view comment/list returns. Columns are listed one by one so private keys never leave the database, nulls are
+# stripped like the API does, except for the community whose model needs every field.
+_COMMENT_VIEW_QUERY = """
+SELECT
+    json_strip_nulls(json_build_object(
+        'id', c.id, 'creator_id', c.creator_id, 'post_id', c.post_id, 'content', c.content, 'removed', c.removed, 'published', c.published,
+        'updated', c.updated, 'deleted', c.deleted, 'ap_id', c.ap_id, 'local', c.local, 'path', c.path::text, 'distinguished', c.distinguished,
+        'language_id', c.language_id
+    )) AS comment,
+    json_strip_nulls(json_build_object(
+        'id', p.id, 'name', p.name, 'url', p.url, 'body', p.body, 'creator_id', p.creator_id, 'community_id', p.community_id, 'removed', p.removed,
+        'locked', p.locked, 'published', p.published, 'updated', p.updated, 'deleted', p.deleted, 'nsfw', p.nsfw, 'embed_title', p.embed_title,
+        'embed_description', p.embed_description, 'thumbnail_url', p.thumbnail_url, 'ap_id', p.ap_id, 'local', p.local,
+        'embed_video_url', p.embed_video_url, 'language_id', p.language_id, 'featured_community', p.featured_community,
+        'featured_local', p.featured_local
+    )) AS post,
+    json_build_object(
+        'id', co.id, 'name', co.name, 'title', co.title, 'description', co.description, 'removed', co.removed, 'published', co.published,
+        'updated', co.updated, 'deleted', co.deleted, 'nsfw', co.nsfw, 'actor_id', co.actor_id, 'local', co.local, 'icon', co.icon,
+        'banner', co.banner, 'hidden', co.hidden, 'posting_restricted_to_mods', co.posting_restricted_to_mods, 'instance_id', co.instance_id
+    ) AS community,
+    json_strip_nulls(json_build_object(
+        'id', pe.id, 'name', pe.name, 'display_name', pe.display_name, 'avatar', pe.avatar, 'banned', pe.banned, 'published', pe.published,
+        'updated', pe.updated, 'actor_id', pe.actor_id, 'bio', pe.bio, 'local', pe.local, 'banner', pe.banner, 'deleted', pe.deleted,
+        'inbox_url', pe.inbox_url, 'matrix_user_id', pe.matrix_user_id, 'bot_account', pe.bot_account, 'ban_expires', pe.ban_expires,
+        'instance_id', pe.instance_id
+    )) AS creator
+FROM comment c
+JOIN post p ON p.id = c.post_id
+JOIN community co ON co.id = p.community_id
+JOIN person pe ON pe.id = c.creator_id
+WHERE {condition} AND p.community_id = $2
+ORDER BY c.id
+"""
+COMMENTS_BY_ID = _COMMENT_VIEW_QUERY.format(condition="c.id = ANY($1::int[])")
+COMMENTS_AFTER = _COMMENT_VIEW_QUERY.format(condition="c.id > $1") + "LIMIT $3"
+COMMUNITY_ID = "SELECT id FROM community WHERE actor_id = $1"
+
+
+@define(kw_only=True)
+class PgCommentSource:
+    """Streams new comments from Lemmy's Postgres instead of polling comment/list, for a bot running next to the instance.
+
+    A trigger (sql/comment_notify.sql) sends the id of every new comment on NOTIFY_CHANNEL. The ids that arrived while the previous batch was
+    loading are loaded together in one query, so a burst of comments costs a few queries instead of one per comment.
+
+    While the database is unreachable, or the connection drops, comments are read by polling comment/list again, and the connection is retried
+    every retry_interval seconds. After reconnecting, the comments written while disconnected are caught up from the last comment id seen, and
+    polling is paused rather than stopped, so it remembers which comments it already returned the next time it is needed.
+
+    The id of the community is looked up by its actor id on every connect, ids differ between instances and backups restored elsewhere. When the
+    database has no such community the source stays on polling instead of retrying.
+
+    """
+
+    dsn: Optional[str] = None
+    community_actor_id: Optional[str] = None
+    # Resolved from community_actor_id when connecting
+    community_id: Optional[int] = None
+    keepalive_interval: float = 30
+    retry_interval: float = 30
+    catch_up_limit: int = 500
+    source: str = "polling"
+    _notified: asyncio.Queue[int] = field(factory=asyncio.Queue)
+    _comments: asyncio.Queue[tuple[str, Comment]] = field(factory=asyncio.Queue)
+    _seen: Cache[int, None] = field(factory=lambda: Cache(maxsize=2000))
+    # Highest comment id when the stream started, the comments up to it existed before the bot and are skipped
+    _watermark: Optional[int] = None
+    # Highest comment id handed to the bot, the catch up after a reconnect starts there
+    _last_id: Optional[int] = None
+    _poller: Optional[asyncio.Task[None]] = None
+    _polling: asyncio.Event = field(factory=asyncio.Event)
+
+    def __attrs_post_init__(self) -> None:
+        for source in SOURCES:
+            INGEST_SOURCE.set_function(partial(self._is_source, source), source=source)
+
+    def _is_source(self, source: str) -> float:
+        return float(self.source == source)
+
+    def configure(self, dsn: Optional[str], community_actor_id: str) -> None:
+        """Turns the Postgres source on.
+
+        :param dsn: libpq connection string of the Lemmy database, None keeps polling
+        :param community_actor_id: actor id of the community whose comments are streamed
+
+        """
+        self.dsn = dsn
+        self.community_actor_id = community_actor_id
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.dsn)
+
+    async def stream(self, lemmy_instance: AsyncLemmyPy) -> AsyncGenerator[Comment, None]:
+        """Yields new comments in the order they were written, whichever source they came from.
+
+        :param lemmy_instance: client the comments are bound to, and polled with while the database is unreachable
+
+        :yields: Comment
+
+        """
+        supervisor = asyncio.create_task(self._supervise(lemmy_instance), name="pg_ingest")
+        try:
+            while True:
+                source, comment = await self._comments.get()
+                if comment.comment_id in self._seen or (self._watermark is not None and comment.comment_id <= self._watermark):
+                    continue
+                self._seen[comment.comment_id] = None
+                self._last_id = max(self._last_id or 0, comment.comment_id)
+                COMMENT_DETECTION_SECONDS.observe(time() - comment.published.timestamp(), source=source)
+                yield comment
+        finally:
+            supervisor.cancel()
+            await asyncio.gather(supervisor, return_exceptions=True)
+            if self._poller is not None:
+                self._poller.cancel()
+                self._poller = None
+
+    async def _supervise(self, lemmy_instance: AsyncLemmyPy) -> None:
+        # Only imported when the source is configured
+        import asyncpg
+
+        misconfigured = False
+        while True:
+            if not misconfigured:
+                try:
+                    await self._listen(lemmy_instance)
+                except LookupError:
+                    # Reconnecting won't make the community appear, only the poller is restarted from now on
+                    pg_ingest_logger.exception("Postgres comment source is misconfigured, polling instead")
+                    misconfigured = True
+                except (OSError, TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                    pg_ingest_logger.warning("Postgres comment source failed, polling until it reconnects", exc_info=True)
+                except Exception:
+                    pg_ingest_logger.exception("Unexpected error in the Postgres comment source, polling until it reconnects")
+                INGEST_FALLBACKS.inc()
+            self.source = "polling"
+            self._polling.set()
+            if self._poller is None or self._poller.done():
+                self._poller = asyncio.create_task(self._poll(lemmy_instance), name="pg_ingest_poller")
+            await asyncio.sleep(self.retry_interval)
+
+    async def _poll(self, lemmy_instance: AsyncLemmyPy) -> None:
+        # Without a watermark the first page is skipped like the bot always did, with one the page may hold comments written since the disconnect
+        try:
+            async for comment in lemmy_instance.stream_comments(skip_existing=self._watermark is None):
+                # Suspends the poll while Postgres is streaming
+                await self._polling.wait()
+                self._comments.put_nowait(("polling", comment))
+        except Exception:
+            pg_ingest_logger.exception("Polling comment/list failed, retrying in %s seconds", self.retry_interval)
+
+    def _on_notification(self, _connection: Any, _pid: int, _channel: str, payload: str) -> None:
+        self._notified.put_nowait(int(payload))
+
+    async def _listen(self, lemmy_instance: AsyncLemmyPy) -> None:
+        """Streams from the database until the connection fails.
+
+        :raises OSError: If the database is unreachable
+        :raises asyncpg.PostgresError: If a query fails, e.g. because the connection was lost
+        :raises LookupError: If the database has no community with community_actor_id
+
+        """
+        import asyncpg
+
+        connection = await asyncpg.connect(self.dsn, timeout=10)
+        try:
+            if (community_id := await connection.fetchval(COMMUNITY_ID, self.community_actor_id, timeout=10)) is None:
+                raise LookupError(f"The Lemmy database has no community with the actor id {self.community_actor_id}")
+            self.community_id = community_id
+            # Listen first so nothing is missed between the catch up and the first notification
+            await connection.add_listener(NOTIFY_CHANNEL, self._on_notification)
+            if self._last_id is None:
+                self._last_id = await connection.fetchval("SELECT coalesce(max(id), 0) FROM comment")
+                if self._poller is None:
+                    self._watermark = self._last_id
+            else:
+                cursor = self._last_id
+                while (
+                    len(loaded := await self._load(connection, lemmy_instance, COMMENTS_AFTER, cursor, self.community_id, self.catch_up_limit))
+                    == self.catch_up_limit
+                ):
+                    cursor = loaded[-1]
+            self._polling.clear()
+            self.source = "postgres"
+            pg_ingest_logger.info("Streaming comments from Postgres")
+            loop_watchdog.mark_stream_progress()
+
+            while True:
+                try:
+                    comment_ids = [await asyncio.wait_for(self._notified.get(), self.keepalive_interval)]
+                except TimeoutError:
+                    # A dropped connection is only noticed when using it
+                    await connection.fetchval("SELECT 1", timeout=10)
+                else:
+                    while not self._notified.empty():
+                        comment_ids.append(self._notified.get_nowait())
+                    await self._load(connection, lemmy_instance, COMMENTS_BY_ID, comment_ids, self.community_id)
+                loop_watchdog.mark_stream_progress()
+        finally:
+            try:
+                await connection.close(timeout=5)
+            except (OSError, TimeoutError, asyncpg.InterfaceError):
+                connection.terminate()
+
+    async def _load(self, connection: asyncpg.Connection, lemmy_instance: AsyncLemmyPy, query: str, *params: Any) -> list[int]:
+        """Loads comments with one query and queues them for the stream. The trigger fires for every community, the query keeps the streamed one.
+
+        :returns: ids of the loaded comments, in order
+
+        """
+        with PG_HYDRATE_SECONDS.time():
+            rows = await connection.fetch(query, *params, timeout=10)
+        comment_ids = []
+        for row in rows:
+            comment_view = {key: json.loads(row[key]) for key in ("comment", "post", "community", "creator")}
+            comment = Comment.from_dict(comment_view=comment_view, request_builder=lemmy_instance.request_builder)
+            self._comments.put_nowait(("postgres", comment))
+            comment_ids.append(comment.comment_id)
+        return comment_ids
+
+
+pg_comment_source = PgCommentSource()
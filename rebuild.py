@@ -0,0 +1,452 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Mapping, Optional
+
+from aiohttp import ClientError
+from attrs import define, field
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import DeleteOne, UpdateOne
+
+from async_lemmy_py import AsyncLemmyPy
+from async_lemmy_py.models.user import User
+from basedcount_bot import BOT_ACTOR_ID, PCM_ACTOR_ID, extract_pill, is_based_comment, is_low_effort_parent, is_self_based
+from bot_commands import MARK_MODIFIED, NEW_PROFILE, recompute_combined_counts
+from utility_functions import create_logger, get_mongo_collection
+
+rebuild_logger = create_logger(logger_name="basedcount_bot")
+
+# The most items comment/list and post/list return per page
+PAGE_LIMIT = 50
+PAGE_RETRIES = 3
+# A full rebuild lowering more counts than this share of the profiles is refused without force, it likely fetched an incomplete history
+MAX_LOWERED_SHARE = 0.1
+
+
+def _compact_comment(comment_view: dict[str, Any]) -> dict[str, Any]:
+    comment = comment_view["comment"]
+    return {
+        "id": comment["id"],
+        "ap_id": comment.get("ap_id", ""),
+        "author": comment_view["creator"]["actor_id"],
+        "post_id": comment["post_id"],
+        "path": comment.get("path", "0"),
+        "content": comment.get("content", ""),
+        "published": comment.get("published", "1970-01-01T00:00:00Z"),
+        "removed": comment.get("removed", False),
+    }
+
+
+def _compact_post(post_view: dict[str, Any]) -> dict[str, Any]:
+    return {"id": post_view["post"]["id"], "author": post_view["creator"]["actor_id"]}
+
+
+# endpoint, key of the list in the response, and what is kept of every item
+HISTORY: dict[str, tuple[str, str, Callable[[dict[str, Any]], dict[str, Any]]]] = {
+    "comment": ("comment/list", "comments", _compact_comment),
+    "post": ("post/list", "posts", _compact_post),
+}
+
+
+@define(kw_only=True)
+class Checkpoint:
+    """History pages already fetched, one JSON line per page, so an interrupted rebuild resumes where it stopped.
+
+    Only full pages are written, the last page keeps growing while the bot runs and is fetched again on resume.
+
+    """
+
+    path: Path
+    pages: dict[tuple[str, int], list[dict[str, Any]]] = field(factory=dict)
+
+    @classmethod
+    def open(cls, path: Path, resume: bool) -> Checkpoint:
+        """Loads the pages of a previous run when resuming, otherwise starts an empty checkpoint file.
+
+        :param path: checkpoint file
+        :param resume: keep the pages of the previous run
+
+        :returns: the checkpoint
+
+        """
+        checkpoint = cls(path=path)
+        if resume and path.exists():
+            with path.open() as lines:
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted run can be cut off
+                        break
+                    checkpoint.pages[(entry["kind"], entry["page"])] = entry["items"]
+            rebuild_logger.info("Resuming from %s pages in %s", len(checkpoint.pages), path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("")
+        return checkpoint
+
+    def save(self, kind: str, page: int, items: list[dict[str, Any]]) -> None:
+        self.pages[(kind, page)] = items
+        if len(items) == PAGE_LIMIT:
+            with self.path.open("a") as lines:
+                lines.write(json.dumps({"kind": kind, "page": page, "items": items}) + "\n")
+
+    def items(self, kind: str) -> list[dict[str, Any]]:
+        """Items of every page of a kind in page order, without the duplicates pages shifting during the fetch can cause."""
+        items: dict[int, dict[str, Any]] = {}
+        for page_kind, page in sorted(self.pages):
+            if page_kind == kind:
+                for item in self.pages[(page_kind, page)]:
+                    items.setdefault(item["id"], item)
+        return list(items.values())
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+@define(kw_only=True)
+class RebuiltProfile:
+    """Count, pills and based history of one user as the comment history says they should be."""
+
+    actor_id: str
+    count: int = 0
+    pills: list[dict[str, Any]] = field(factory=list)
+    # Bases received per giver, one basedHistory document each
+    history: Counter[str] = field(factory=Counter)
+
+
+@define(kw_only=True)
+class ProfileDiff:
+    name: str
+    count: tuple[int, int]
+    added_pills: list[str]
+    # Pills of the profile the history doesn't explain, e.g. from the reddit days or cheating that was cleaned up
+    extra_pills: list[str]
+    new_profile: bool = False
+
+
+@define(kw_only=True)
+class RebuildReport:
+    bases: int = 0
+    # Based comments whose parent isn't in the fetched history
+    unresolved: int = 0
+    diffs: list[ProfileDiff] = field(factory=list)
+    history_changes: int = 0
+    # basedHistory documents the history doesn't explain as (to, from, count), deleted only with prune_history
+    history_deletions: list[tuple[str, str, int]] = field(factory=list)
+    # Conditional writes that didn't match because the bot changed the document meanwhile
+    skipped: int = 0
+    # Profiles whose count would go down, and whether nothing was written because there were too many of them
+    lowered: int = 0
+    refused: bool = False
+
+
+async def fetch_page(lemmy_instance: AsyncLemmyPy, community_id: int, kind: str, page: int) -> list[dict[str, Any]]:
+    """Fetches one page of pcm history, oldest first, retrying transient failures.
+
+    :param lemmy_instance: The AsyncLemmyPy Instance. Used to make API calls.
+    :param community_id: id of pcm on the instance
+    :param kind: comment or post
+    :param page: page number, starting at 1
+
+    :returns: the compacted items of the page
+
+    :raises ClientError: If the page still fails after PAGE_RETRIES attempts
+
+    """
+    endpoint, key, compact = HISTORY[kind]
+    params = {"community_id": community_id, "sort": "Old", "page": page, "limit": PAGE_LIMIT}
+    for attempt in range(1, PAGE_RETRIES + 1):
+        try:
+            response = await lemmy_instance.request_builder.get(endpoint, params=params)
+            return [compact(view) for view in response.get(key, [])]
+        except (ClientError, TimeoutError):
+            if attempt == PAGE_RETRIES:
+                raise
+            rebuild_logger.warning("Fetching %s page %s failed, retrying", kind, page, exc_info=True)
+            await asyncio.sleep(2**attempt)
+    return []
+
+
+async def fetch_history(lemmy_instance: AsyncLemmyPy, community_id: int, checkpoint: Checkpoint, kind: str, concurrency: int) -> list[dict[str, Any]]:
+    """Fetches the whole pcm history of a kind, concurrency pages at a time, skipping the pages of the checkpoint.
+
+    Pages are sorted oldest first so new comments only ever land on the last page and the checkpointed pages stay valid.
+
+    :returns: every item, oldest first
+
+    """
+    page = 1
+    while True:
+        window = range(page, page + concurrency)
+        missing = [number for number in window if (kind, number) not in checkpoint.pages]
+        fetched = await asyncio.gather(*(fetch_page(lemmy_instance, community_id, kind, number) for number in missing))
+        for number, items in zip(missing, fetched):
+            checkpoint.save(kind, number, items)
+        if any(len(checkpoint.pages[(kind, number)]) < PAGE_LIMIT for number in window):
+            break
+        page += concurrency
+        rebuild_logger.info("Fetched %s pages of %ss", page - 1, kind)
+    return checkpoint.items(kind)
+
+
+async def flaired_users(actor_ids: set[str], concurrency: int) -> set[str]:
+    """Which of the users have a flair now, lowercased. The flair they had when the based was given isn't kept anywhere."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def has_flair(actor_id: str) -> bool:
+        async with semaphore:
+            return await User.from_dict({"actor_id": actor_id}).get_flair() is not None
+
+    flags = await asyncio.gather(*(has_flair(actor_id) for actor_id in actor_ids))
+    return {actor_id.lower() for actor_id, flag in zip(actor_ids, flags) if flag}
+
+
+async def replay_history(comments: list[dict[str, Any]], posts: list[dict[str, Any]], report: RebuildReport, concurrency: int) -> dict[str, RebuiltProfile]:
+    """Runs the based and pill detection of the bot over the comment history.
+
+    :param comments: compacted comments, see fetch_history
+    :param posts: compacted posts, the parents of top level comments
+    :param report: counts the bases and the unresolved parents
+    :param concurrency: concurrent flair lookups
+
+    :returns: the rebuilt profiles by lowercased actor id
+
+    """
+    comments_by_id = {comment["id"]: comment for comment in comments}
+    post_authors = {post["id"]: post["author"] for post in posts}
+
+    bases: list[tuple[dict[str, Any], str, str]] = []
+    for comment in sorted(comments_by_id.values(), key=lambda comment: comment["id"]):
+        body = comment["content"].lower()
+        if comment["removed"] or comment["author"] == BOT_ACTOR_ID or not is_based_comment(body):
+            continue
+        parent_ids = comment["path"].split(".")
+        parent_id = int(parent_ids[-2]) if len(parent_ids) > 1 else 0
+        if parent_id == 0:
+            parent_author, parent_body = post_authors.get(comment["post_id"]), "submission"
+        elif parent := comments_by_id.get(parent_id):
+            parent_author, parent_body = parent["author"], parent["content"].lower()
+        else:
+            parent_author, parent_body = None, ""
+        if parent_author is None:
+            report.unresolved += 1
+            continue
+        if not is_self_based(comment["author"], parent_author):
+            bases.append((comment, parent_author, parent_body))
+
+    # Like is_valid_comment, unflaired users still get based from a low effort parent
+    flaired = await flaired_users({parent_author for _, parent_author, parent_body in bases if is_low_effort_parent(parent_body)}, concurrency)
+
+    rebuilt: dict[str, RebuiltProfile] = {}
+    for comment, parent_author, parent_body in bases:
+        if is_low_effort_parent(parent_body) and parent_author.lower() in flaired:
+            continue
+        profile = rebuilt.setdefault(parent_author.lower(), RebuiltProfile(actor_id=parent_author))
+        profile.count += 1
+        profile.history[comment["author"]] += 1
+        report.bases += 1
+        pill_name = extract_pill(comment["content"].lower())
+        if pill_name is not None and all(pill["name"] != pill_name for pill in profile.pills):
+            profile.pills.append(
+                {
+                    "name": pill_name,
+                    "commentID": comment["ap_id"],
+                    "fromUser": comment["author"],
+                    "date": int(datetime.fromisoformat(comment["published"]).timestamp()),
+                    "amount": 1,
+                }
+            )
+    return rebuilt
+
+
+async def _bulk_write(collection: AsyncIOMotorCollection, requests: list[Any]) -> int:
+    """Writes the requests in batches of 1000.
+
+    :returns: the number of requests whose filter matched nothing
+
+    """
+    skipped = 0
+    for start in range(0, len(requests), 1000):
+        batch = requests[start : start + 1000]
+        result = await collection.bulk_write(batch, ordered=False)
+        skipped += len(batch) - result.matched_count - result.upserted_count - result.deleted_count
+    return skipped
+
+
+async def apply_rebuild(
+    databased: AsyncIOMotorDatabase,
+    rebuilt: dict[str, RebuiltProfile],
+    report: RebuildReport,
+    user_names: Optional[list[str]] = None,
+    replace_pills: bool = False,
+    prune_history: bool = False,
+    dry_run: bool = False,
+    force: bool = False,
+) -> None:
+    """Diffs the rebuilt profiles against the database and writes the differences.
+
+    Every write is conditional on the value it was computed from, so a based the bot awards during the rebuild isn't overwritten, that write is
+    skipped and counted in the report instead. Pills only in the profile are kept unless replace_pills, pills users removed stay removed
+    either way since remove_pill only marks them as deleted.
+
+    Only the basedHistory documents of the rebuilt lemmy profiles are read, the collection is shared with the reddit profiles. Documents the
+    history doesn't explain, e.g. of bases whose comment was removed since, are listed in the report and only deleted with prune_history.
+
+    A rebuild of every profile that would lower the count of more than MAX_LOWERED_SHARE of them writes nothing and marks the report refused,
+    unless forced. Missing history pages lower counts, a real correction rarely touches that many profiles.
+
+    :param databased: MongoDB database used to get the collections
+    :param rebuilt: rebuilt profiles by lowercased actor id
+    :param report: receives the differences
+    :param user_names: actor ids to rebuild, every lemmy profile when None
+    :param replace_pills: replace the pill lists instead of only adding the missing pills
+    :param prune_history: delete the basedHistory documents the history doesn't explain
+    :param dry_run: Only report the differences, don't write them
+    :param force: write a full rebuild even if it lowers many counts
+
+    :returns: None
+
+    """
+    users_collection = await get_mongo_collection(collection_name="users", databased=databased)
+    history_collection = await get_mongo_collection(collection_name="basedHistory", databased=databased)
+    scope = None if user_names is None else {name.lower() for name in user_names}
+
+    profiles: dict[str, Mapping[str, Any]] = {}
+    async for document in users_collection.find({"is_lemmy": True}, {"name": 1, "count": 1, "pills": 1}):
+        if scope is None or document["name"].lower() in scope:
+            profiles[document["name"].lower()] = document
+
+    user_requests: list[UpdateOne] = []
+    for name in sorted((profiles.keys() | rebuilt.keys()) if scope is None else scope):
+        profile, rebuilt_profile = profiles.get(name), rebuilt.get(name)
+        new_count = 0 if rebuilt_profile is None else rebuilt_profile.count
+        new_pills = [] if rebuilt_profile is None else rebuilt_profile.pills
+        if profile is None:
+            if rebuilt_profile is not None:
+                report.diffs.append(
+                    ProfileDiff(
+                        name=rebuilt_profile.actor_id, count=(0, new_count), added_pills=[pill["name"] for pill in new_pills], extra_pills=[], new_profile=True
+                    )
+                )
+                user_requests.append(
+                    UpdateOne(
+                        {"name": rebuilt_profile.actor_id},
+                        {
+                            "$setOnInsert": NEW_PROFILE
+                            | {"count": new_count, "pills": new_pills, "combinedCount": new_count, "combinedPillCount": len(new_pills)},
+                            "$currentDate": MARK_MODIFIED,
+                        },
+                        upsert=True,
+                    )
+                )
+            continue
+
+        old_count, old_pills = profile.get("count", 0), profile.get("pills", [])
+        old_names = {pill["name"] for pill in old_pills}
+        added_pills = [pill for pill in new_pills if pill["name"] not in old_names]
+        extra_pills = sorted(old_names - {pill["name"] for pill in new_pills})
+        if old_count == new_count and not added_pills and not (replace_pills and extra_pills):
+            continue
+        report.diffs.append(
+            ProfileDiff(name=profile["name"], count=(old_count, new_count), added_pills=[pill["name"] for pill in added_pills], extra_pills=extra_pills)
+        )
+        if new_count < old_count:
+            report.lowered += 1
+        if old_count != new_count:
+            user_requests.append(UpdateOne({"_id": profile["_id"], "count": old_count}, {"$set": {"count": new_count}, "$currentDate": MARK_MODIFIED}))
+        if replace_pills and (added_pills or extra_pills):
+            deleted = {pill["name"] for pill in old_pills if pill.get("deleted")}
+            replaced = [pill | {"deleted": True} if pill["name"] in deleted else pill for pill in new_pills]
+            user_requests.append(UpdateOne({"_id": profile["_id"], "pills": old_pills}, {"$set": {"pills": replaced}, "$currentDate": MARK_MODIFIED}))
+        else:
+            # Same condition as add_pills, a pill the bot adds meanwhile isn't added twice
+            user_requests.extend(
+                UpdateOne({"_id": profile["_id"], "pills.name": {"$ne": pill["name"]}}, {"$push": {"pills": pill}, "$currentDate": MARK_MODIFIED})
+                for pill in added_pills
+            )
+
+    receivers = {profile["name"] for profile in profiles.values()} | {profile.actor_id for name, profile in rebuilt.items() if scope is None or name in scope}
+    recorded = {(record["to"], record["from"]): record async for record in history_collection.find({"to": {"$in": sorted(receivers)}})}
+    expected = {
+        (profile.actor_id, giver): count for name, profile in rebuilt.items() if scope is None or name in scope for giver, count in profile.history.items()
+    }
+
+    history_requests: list[UpdateOne | DeleteOne] = []
+    for to_from in recorded.keys() | expected.keys():
+        record, new_count = recorded.get(to_from), expected.get(to_from, 0)
+        if record is None:
+            history_requests.append(UpdateOne({"to": to_from[0], "from": to_from[1]}, {"$setOnInsert": {"count": new_count}}, upsert=True))
+        elif new_count == 0:
+            report.history_deletions.append((to_from[0], to_from[1], record["count"]))
+            if prune_history:
+                history_requests.append(DeleteOne({"_id": record["_id"], "count": record["count"]}))
+        elif record["count"] != new_count:
+            history_requests.append(UpdateOne({"_id": record["_id"], "count": record["count"]}, {"$set": {"count": new_count}}))
+    report.history_changes = len(history_requests)
+
+    if dry_run:
+        return
+    if scope is None and not force and report.lowered > MAX_LOWERED_SHARE * len(profiles):
+        rebuild_logger.warning("Refusing to lower the count of %s of %s profiles without force", report.lowered, len(profiles))
+        report.refused = True
+        return
+    report.skipped += await _bulk_write(users_collection, user_requests)
+    report.skipped += await _bulk_write(history_collection, history_requests)
+
+    # The combined counts of the changed profiles and of the main accounts they are merged into
+    changed = [diff.name for diff in report.diffs]
+    if changed:
+        primaries = [profile["name"] async for profile in users_collection.find({"mergedAccounts": {"$in": changed}}, {"name": 1})]
+        await recompute_combined_counts(databased, user_names=changed + primaries)
+
+
+async def rebuild_from_history(
+    lemmy_instance: AsyncLemmyPy,
+    databased: AsyncIOMotorDatabase,
+    checkpoint_path: Path,
+    user_names: Optional[list[str]] = None,
+    resume: bool = False,
+    concurrency: int = 8,
+    replace_pills: bool = False,
+    prune_history: bool = False,
+    dry_run: bool = False,
+    force: bool = False,
+) -> RebuildReport:
+    """Rebuilds count, pills and basedHistory of lemmy profiles from the pcm comment history.
+
+    :param lemmy_instance: The AsyncLemmyPy Instance. Used to make API calls.
+    :param databased: MongoDB database used to get the collections
+    :param checkpoint_path: file keeping the fetched pages, removed once the rebuild was written
+    :param user_names: actor ids to rebuild, every lemmy profile when None
+    :param resume: reuse the pages fetched by an earlier run
+    :param concurrency: pages fetched at the same time per kind
+    :param replace_pills: replace the pill lists instead of only adding the missing pills
+    :param prune_history: delete the basedHistory documents the history doesn't explain
+    :param dry_run: Only report the differences, don't write them
+    :param force: write a full rebuild even if it lowers many counts
+
+    :returns: the differences found
+
+    """
+    checkpoint = Checkpoint.open(checkpoint_path, resume=resume)
+    community_id = await lemmy_instance.community_id(PCM_ACTOR_ID)
+    posts, comments = await asyncio.gather(
+        fetch_history(lemmy_instance, community_id, checkpoint, "post", concurrency),
+        fetch_history(lemmy_instance, community_id, checkpoint, "comment", concurrency),
+    )
+    rebuild_logger.info("Replaying %s comments on %s posts", len(comments), len(posts))
+
+    report = RebuildReport()
+    rebuilt = await replay_history(comments, posts, report, concurrency)
+    await apply_rebuild(
+        databased, rebuilt, report, user_names=user_names, replace_pills=replace_pills, prune_history=prune_history, dry_run=dry_run, force=force
+    )
+    # A dry run or a refused rebuild keeps the pages so the real run can resume from them
+    if not dry_run and not report.refused:
+        checkpoint.remove()
+    return report
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from basedcount_bot import lemmy_client
+from bot_commands import recompute_combined_counts
+from rebuild import rebuild_from_history
+from utility_functions import get_databased, setup_logging
+
+
+async def repair_combined_counts(user_names: list[str] | None, dry_run: bool) -> None:
+    """Recomputes the combined counts of merged accounts and prints every profile that drifted.
+
+    :param user_names: Profiles to repair, all of them when None
+    :param dry_run: Only print the differences
+
+    :returns: None
+
+    """
+    async with get_databased() as databased:
+        fixes = await recompute_combined_counts(databased, user_names=user_names, dry_run=dry_run)
+    for fix in fixes:
+        old_count, new_count = fix["combinedCount"]
+        old_pills, new_pills = fix["combinedPillCount"]
+        print(f"{fix['name']}: combinedCount {old_count} -> {new_count}, combinedPillCount {old_pills} -> {new_pills}")
+    print(f"{len(fixes)} profiles {'would be' if dry_run else 'were'} repaired")
+
+
+async def rebuild_counts(
+    user_names: list[str] | None,
+    checkpoint: Path,
+    resume: bool,
+    concurrency: int,
+    replace_pills: bool,
+    prune_history: bool,
+    dry_run: bool,
+    force: bool,
+) -> None:
+    """Rebuilds count, pills and basedHistory from the pcm comment history and prints every profile that drifted.
+
+    :param user_names: Profiles to rebuild, all lemmy profiles when None
+    :param checkpoint: File keeping the fetched history pages
+    :param resume: Reuse the pages fetched by an earlier run
+    :param concurrency: Pages fetched at the same time
+    :param replace_pills: Replace the pill lists instead of only adding the missing pills
+    :param prune_history: Delete the basedHistory documents the history doesn't explain
+    :param dry_run: Only print the differences
+    :param force: Write a full rebuild even if it lowers many counts
+
+    :returns: None
+
+    """
+    async with lemmy_client() as lemmy, get_databased() as databased:
+        report = await rebuild_from_history(
+            lemmy,
+            databased,
+            checkpoint,
+            user_names=user_names,
+            resume=resume,
+            concurrency=concurrency,
+            replace_pills=replace_pills,
+            prune_history=prune_history,
+            dry_run=dry_run,
+            force=force,
+        )
+    for diff in report.diffs:
+        changes = [f"count {diff.count[0]} -> {diff.count[1]}"]
+        if diff.added_pills:
+            changes.append(f"+pills {', '.join(diff.added_pills)}")
+        if diff.extra_pills:
+            changes.append(f"{'-' if replace_pills else 'not in history:'} pills {', '.join(diff.extra_pills)}")
+        print(f"{diff.name}{' (new profile)' if diff.new_profile else ''}: {'; '.join(changes)}")
+    for to, giver, count in report.history_deletions:
+        print(f"basedHistory {giver} -> {to}: {count} bases not in history{', deleted' if prune_history and not dry_run else ''}")
+    print(f"{report.bases} bases replayed, {report.unresolved} with a parent outside the fetched history")
+    if report.refused:
+        print(f"Nothing was written, {report.lowered} counts would go down, check the history with --dry-run and pass --force if they should")
+        return
+    print(f"{len(report.diffs)} profiles and {report.history_changes} basedHistory documents {'would be' if dry_run else 'were'} rebuilt")
+    if report.skipped:
+        print(f"{report.skipped} writes were skipped because the bot changed the documents meanwhile, run again to rebuild them")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Repairs counters in the dataBased users collection.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    combined_parser = subparsers.add_parser("combined", help="recompute combinedCount and combinedPillCount from the main and merged accounts")
+    combined_parser.add_argument("--user", action="append", dest="users", help="actor id of a profile to repair, can be repeated (default: all profiles)")
+    combined_parser.add_argument("--dry-run", action="store_true", help="only print the differences")
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="rebuild count, pills and basedHistory by replaying the pcm comment history")
+    rebuild_parser.add_argument("--user", action="append", dest="users", help="actor id of a profile to rebuild, can be repeated (default: all lemmy profiles)")
+    rebuild_parser.add_argument("--dry-run", action="store_true", help="only print the differences, the fetched pages are kept for --resume")
+    rebuild_parser.add_argument("--checkpoint", type=Path, default=Path("logs/rebuild_checkpoint.jsonl"), help="file keeping the fetched history pages")
+    rebuild_parser.add_argument("--resume", action="store_true", help="reuse the pages of an interrupted or dry run")
+    rebuild_parser.add_argument("--concurrency", type=int, default=8, help="pages fetched at the same time (default: 8)")
+    rebuild_parser.add_argument("--replace-pills", action="store_true", help="also remove pills the history doesn't explain")
+    rebuild_parser.add_argument("--prune-history", action="store_true", help="also delete the basedHistory documents the history doesn't explain")
+    rebuild_parser.add_argument("--force", action="store_true", help="write a full rebuild even if it lowers more than 10%% of the counts")
+
+    args = parser.parse_args()
+    if args.command == "combined":
+        asyncio.run(repair_combined_counts(args.users, args.dry_run))
+    elif args.command == "rebuild":
+        asyncio.run(
+            rebuild_counts(args.users, args.checkpoint, args.resume, args.concurrency, args.replace_pills, args.prune_history, args.dry_run, args.force)
+        )
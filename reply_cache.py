@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from typing import Iterable, Optional
+
+from attrs import define, field
+from cachetools import TTLCache
+
+from metrics import REPLY_CACHE_LOOKUPS
+
+ReplyKey = tuple[str, bool]
+
+
+@define(kw_only=True)
+class ReplyCache:
+    """Rendered /basedcount and /mybasedcount replies, by lowercased actor id and whether the user asked for their own count.
+
+    A reply depends on the profile and on every account merged into it, a write to any of them drops it. The bot's own writes invalidate
+    right away, edits made elsewhere (the website, the repair tools, another worker process) show up once the ttl expired.
+
+    For settle_seconds after an invalidation, replies of the account aren't cached: a read that started before the write, or that went to a
+    secondary that hasn't replicated it yet, would otherwise cache the old count until the ttl. Replies are read from secondaries up to
+    mongo_profile.max_staleness_seconds behind, the bot sets settle_seconds to at least that, so a reply rendered from a secondary that missed
+    the write is served once and never cached.
+
+    """
+
+    ttl: float = 60
+    maxsize: int = 1024
+    settle_seconds: float = 2
+    _replies: TTLCache[ReplyKey, str] = field(init=False)
+    # Account to the keys of the cached replies that depend on it, may hold keys that already expired
+    _dependents: dict[str, set[ReplyKey]] = field(factory=dict)
+    _recently_invalidated: TTLCache[str, None] = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self.configure(self.ttl, self.maxsize, self.settle_seconds)
+
+    def configure(self, ttl: float, maxsize: int = 1024, settle_seconds: float = 2) -> None:
+        """Sets the limits and drops every cached reply.
+
+        :param ttl: seconds a reply is served from the cache, 0 turns the cache off
+        :param maxsize: replies kept at most, the least recently used is dropped first
+        :param settle_seconds: seconds after an invalidation during which the account's replies aren't cached
+
+        """
+        self.ttl, self.maxsize, self.settle_seconds = ttl, maxsize, settle_seconds
+        self._replies = TTLCache(maxsize=maxsize, ttl=max(ttl, 0.001))
+        self._recently_invalidated = TTLCache(maxsize=maxsize, ttl=max(settle_seconds, 0.001))
+        self._dependents.clear()
+
+    def get(self, actor_id: str, is_me: bool) -> Optional[str]:
+        reply = self._replies.get((actor_id.lower(), is_me)) if self.ttl > 0 else None
+        REPLY_CACHE_LOOKUPS.inc(outcome="miss" if reply is None else "hit")
+        return reply
+
+    def put(self, actor_id: str, is_me: bool, reply: str, accounts: Iterable[str]) -> None:
+        """Caches a rendered reply.
+
+        :param actor_id: the account asked about
+        :param is_me: whether the user asked for their own count
+        :param reply: the rendered reply
+        :param accounts: actor ids of every account the reply was rendered from
+
+        """
+        dependencies = {actor_id.lower(), *(account.lower() for account in accounts)}
+        if self.ttl <= 0 or any(account in self._recently_invalidated for account in dependencies):
+            return
+        key = (actor_id.lower(), is_me)
+        self._replies[key] = reply
+        if len(self._dependents) > 4 * self.maxsize:
+            # Drops the accounts whose replies all expired or were evicted
+            self._dependents = {account: keys & self._replies.keys() for account, keys in self._dependents.items() if keys & self._replies.keys()}
+        for account in dependencies:
+            self._dependents.setdefault(account, set()).add(key)
+
+    def invalidate(self, actor_id: str) -> None:
+        """Drops every reply rendered from the account, call it once the write to the account finished.
+
+        :param actor_id: actor id of the written account
+
+        """
+        account = actor_id.lower()
+        self._recently_invalidated[account] = None
+        for key in self._dependents.pop(account, ()):
+            if self._replies.pop(key, None) is not None:
+                REPLY_CACHE_LOOKUPS.inc(outcome="invalidated")
+
+
+reply_cache = ReplyCache()
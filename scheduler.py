@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from enum import IntEnum
+from functools import partial
+from itertools import count
+from time import monotonic
+from typing import Awaitable, Callable
+
+from attrs import define, field
+
+from error_reporter import error_reporter
+from metrics import SCHEDULED_JOBS, SCHEDULER_BACKLOG
+from utility_functions import create_logger
+
+scheduler_logger = create_logger(logger_name="basedcount_bot")
+
+Job = Callable[[], Awaitable[None]]
+
+
+class Priority(IntEnum):
+    # Awards bases and writes profiles, never shed
+    COUNT_CHANGING = 0
+    # Commands that read counts and leaderboards
+    READ_ONLY = 1
+    # /info and other canned replies
+    INFORMATIONAL = 2
+
+
+# Backlog above which new work of a class is dropped instead of queued
+DEFAULT_SHED_THRESHOLDS = {Priority.READ_ONLY: 200, Priority.INFORMATIONAL: 50}
+# Backlog above which the comment sources stop reading until the consumers caught up, count changing work is never shed so it needs a limit
+DEFAULT_HIGH_WATER = 1000
+
+
+@define(kw_only=True)
+class Scheduler:
+    """Runs the comment handling jobs by priority class, with a fixed number of consumers.
+
+    Jobs are queued as callables and only turned into coroutines when a consumer picks them up, so shed jobs cost nothing. Within a class jobs
+    run in the order they were submitted. A job that raises is logged and reported, it doesn't stop the consumer.
+
+    Count changing jobs are never shed, the sources await wait_for_room before submitting instead, so above high_water jobs the stream stops
+    reading until the backlog went down, like it did when comments were handled one at a time.
+
+    """
+
+    concurrency: int = 1
+    shed_thresholds: dict[Priority, int] = field(factory=lambda: dict(DEFAULT_SHED_THRESHOLDS))
+    high_water: int = DEFAULT_HIGH_WATER
+    _queue: asyncio.PriorityQueue[tuple[int, int, str, Job]] = field(factory=asyncio.PriorityQueue)
+    _sequence: count[int] = field(factory=count)
+    _consumers: list[asyncio.Task[None]] = field(factory=list)
+    _queued: Counter[Priority] = field(factory=Counter)
+    _accepting: bool = True
+    # Set while the backlog is below high_water
+    _room: asyncio.Event = field(factory=asyncio.Event)
+
+    def __attrs_post_init__(self) -> None:
+        self._room.set()
+        for priority in Priority:
+            SCHEDULER_BACKLOG.set_function(partial(self.backlog, priority), priority=priority.name.lower())
+
+    def backlog(self, priority: Priority | None = None) -> int:
+        """Number of queued jobs, of one class or of all of them.
+
+        :returns: queued jobs
+
+        """
+        if priority is None:
+            return self._queue.qsize()
+        return self._queued[priority]
+
+    def submit(self, priority: Priority, job: Job, name: str) -> bool:
+        """Queues a job unless the scheduler is draining or the backlog is over the threshold of its class.
+
+        :param priority: class of the job
+        :param job: callable returning the coroutine to run
+        :param name: what the job is about, for the logs
+
+        :returns: True if the job was queued
+
+        """
+        label = priority.name.lower()
+        if not self._accepting:
+            SCHEDULED_JOBS.inc(priority=label, outcome="rejected")
+            return False
+        threshold = self.shed_thresholds.get(priority)
+        if threshold is not None and self._queue.qsize() >= threshold:
+            SCHEDULED_JOBS.inc(priority=label, outcome="shed")
+            scheduler_logger.info("Shedding %s job %s, backlog is %d", label, name, self._queue.qsize())
+            return False
+        self._queue.put_nowait((priority, next(self._sequence), name, job))
+        self._queued[priority] += 1
+        if self._queue.qsize() >= self.high_water:
+            self._room.clear()
+        SCHEDULED_JOBS.inc(priority=label, outcome="queued")
+        return True
+
+    async def wait_for_room(self) -> None:
+        """Waits until the backlog is below high_water, call it before reading the next comment.
+
+        :returns: None
+
+        """
+        await self._room.wait()
+
+    async def _consume(self) -> None:
+        while True:
+            priority, _, name, job = await self._queue.get()
+            self._queued[Priority(priority)] -= 1
+            if self._queue.qsize() < self.high_water:
+                self._room.set()
+            try:
+                await job()
+                SCHEDULED_JOBS.inc(priority=Priority(priority).name.lower(), outcome="done")
+            except Exception as exc:
+                SCHEDULED_JOBS.inc(priority=Priority(priority).name.lower(), outcome="failed")
+                scheduler_logger.exception("Job %s failed", name)
+                error_reporter.report(exc)
+            finally:
+                self._queue.task_done()
+
+    def start(self) -> None:
+        """Starts the consumers on the running loop.
+
+        :returns: None
+
+        """
+        self._accepting = True
+        self._consumers = [asyncio.create_task(self._consume(), name=f"scheduler-consumer-{index}") for index in range(self.concurrency)]
+
+    async def drain(self, timeout: float) -> bool:
+        """Stops accepting jobs and waits for the queued and running ones to finish, then stops the consumers.
+
+        :param timeout: seconds to wait before cancelling whatever is left
+
+        :returns: True if everything finished in time
+
+        """
+        self._accepting = False
+        started = monotonic()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+            drained = True
+        except TimeoutError:
+            drained = False
+            scheduler_logger.error("Could not finish %d jobs in %s seconds, dropping them", self._queue.qsize(), timeout)
+        for consumer in self._consumers:
+            consumer.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+        scheduler_logger.info("Scheduler drained in %.1f seconds", monotonic() - started)
+        return drained
+
+
+scheduler = Scheduler()
@@ -0,0 +1,23 @@
+-- Notifies the bot of every new comment, read by pg_ingest.py when LEMMY_DATABASE_URL is set.
+--
+-- Install it on the Lemmy database as its owner:
+--     psql "$LEMMY_OWNER_URL" -f sql/comment_notify.sql
+-- The bot only needs to read the tables it hydrates comments from:
+--     GRANT SELECT ON comment, post, community, person TO basedcount_bot;
+--
+-- The payload is only the comment id, notifications are delivered at commit so the comment is visible when the bot loads it.
+
+CREATE OR REPLACE FUNCTION basedcount_notify_comment() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('basedcount_comment', NEW.id::text);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS basedcount_notify_comment ON comment;
+
+CREATE TRIGGER basedcount_notify_comment
+    AFTER INSERT ON comment
+    FOR EACH ROW
+    EXECUTE FUNCTION basedcount_notify_comment();
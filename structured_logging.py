@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import json
+import random
+from datetime import datetime, timezone
+from logging import DEBUG, INFO, Filter, Formatter, Handler, LogRecord, getLogger
+from logging.handlers import QueueHandler
+from time import monotonic
+from typing import Any
+
+# Attributes every LogRecord has, anything else on a record was passed through `extra` and goes into the JSON as is
+_RECORD_ATTRIBUTES = frozenset(vars(LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves all formatting to the listener thread.
+
+    The stock QueueHandler formats the message in the logging thread so the record can be pickled. The bot's queue never leaves the process, so the
+    record is queued untouched and the event loop only pays for creating it.
+
+    """
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        return record
+
+
+class ForwardingHandler(Handler):
+    """Passes records that come from worker processes to the logger of the same name in this process, so they reach the same log file."""
+
+    def emit(self, record: LogRecord) -> None:
+        getLogger(record.name).handle(record)
+
+
+class JsonFormatter(Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "where": f"{record.filename}.{record.funcName}:{record.lineno}",
+            "msg": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RateLimitFilter(Filter):
+    """Token bucket per log line (the unformatted message), for lines that can repeat for every comment.
+
+    Records above max_level always pass. The first record let through after some were dropped says how many were suppressed.
+
+    """
+
+    def __init__(self, rate: float, burst: int, max_level: int = INFO) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        # message template -> (tokens, last refill, suppressed count)
+        self._buckets: dict[str, tuple[float, float, int]] = {}
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+
+        key = str(record.msg)
+        now = monotonic()
+        tokens, last_refill, suppressed = self._buckets.get(key, (float(self.burst), now, 0))
+        tokens = min(float(self.burst), tokens + (now - last_refill) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, suppressed + 1)
+            return False
+
+        if suppressed:
+            record.suppressed = suppressed
+        self._buckets[key] = (tokens - 1, now, 0)
+        if len(self._buckets) > 10_000:
+            self._buckets.clear()
+        return True
+
+
+class SamplingFilter(Filter):
+    """Keeps a random sample of the records at or below max_level."""
+
+    def __init__(self, sample_rate: float, max_level: int = DEBUG) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.max_level = max_level
+
+    def filter(self, record: LogRecord) -> bool:
+        return record.levelno > self.max_level or random.random() < self.sample_rate  # noqa: S311
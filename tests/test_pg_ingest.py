@@ -0,0 +1,126 @@
+"""Runs the comment trigger and PgCommentSource against a real Postgres.
+
+Set BASEDCOUNT_TEST_DATABASE_URL to a postgresql:// URL of a scratch database to run them, every test creates its own schema with the few
+Lemmy columns the source reads and drops it afterwards.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from os import getenv, getpid
+from pathlib import Path
+from typing import AsyncIterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pytest
+
+from async_lemmy_py import AsyncLemmyPy
+from pg_ingest import PgCommentSource
+
+TEST_DATABASE_URL = getenv("BASEDCOUNT_TEST_DATABASE_URL")
+PCM_ACTOR_ID = "https://lemmy.basedcount.com/c/pcm"
+NOTIFY_SQL = Path(__file__).parent.parent / "sql" / "comment_notify.sql"
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="BASEDCOUNT_TEST_DATABASE_URL is not set")
+
+LEMMY_TABLES = """
+CREATE TABLE community (
+    id int PRIMARY KEY, name text NOT NULL, title text NOT NULL, description text, removed bool DEFAULT false, published timestamptz DEFAULT now(),
+    updated timestamptz, deleted bool DEFAULT false, nsfw bool DEFAULT false, actor_id text NOT NULL, local bool DEFAULT true, icon text,
+    banner text, hidden bool DEFAULT false, posting_restricted_to_mods bool DEFAULT false, instance_id int DEFAULT 1
+);
+CREATE TABLE person (
+    id int PRIMARY KEY, name text NOT NULL, display_name text, avatar text, banned bool DEFAULT false, published timestamptz DEFAULT now(),
+    updated timestamptz, actor_id text NOT NULL, bio text, local bool DEFAULT true, banner text, deleted bool DEFAULT false, inbox_url text,
+    matrix_user_id text, bot_account bool DEFAULT false, ban_expires timestamptz, instance_id int DEFAULT 1
+);
+CREATE TABLE post (
+    id int PRIMARY KEY, name text NOT NULL, url text, body text, creator_id int REFERENCES person, community_id int REFERENCES community,
+    removed bool DEFAULT false, locked bool DEFAULT false, published timestamptz DEFAULT now(), updated timestamptz, deleted bool DEFAULT false,
+    nsfw bool DEFAULT false, embed_title text, embed_description text, thumbnail_url text, ap_id text, local bool DEFAULT true, embed_video_url text,
+    language_id int DEFAULT 0, featured_community bool DEFAULT false, featured_local bool DEFAULT false
+);
+CREATE TABLE comment (
+    id serial PRIMARY KEY, creator_id int REFERENCES person, post_id int REFERENCES post, content text NOT NULL, removed bool DEFAULT false,
+    published timestamptz DEFAULT now(), updated timestamptz, deleted bool DEFAULT false, ap_id text, local bool DEFAULT true, path text DEFAULT '0',
+    distinguished bool DEFAULT false, language_id int DEFAULT 0
+);
+-- PCM doesn't get id 2 here, the source has to look it up
+INSERT INTO community (id, name, title, actor_id) VALUES (2, 'other', 'Other', 'https://lemmy.basedcount.com/c/other'), (7, 'pcm', 'PCM', '{pcm_actor_id}');
+INSERT INTO person (id, name, actor_id) VALUES (1, 'user1', 'https://lemmy.basedcount.com/u/user1');
+INSERT INTO post (id, name, creator_id, community_id) VALUES (1, 'Other post', 1, 2), (2, 'PCM post', 1, 7);
+"""
+
+
+@asynccontextmanager
+async def lemmy_schema() -> AsyncIterator[str]:
+    """Creates a schema with the Lemmy tables and the trigger.
+
+    :yields: URL of the test database with the schema as search_path, the source connects with it
+
+    """
+    import asyncpg
+
+    assert TEST_DATABASE_URL is not None
+    schema = f"basedcount_test_{getpid()}"
+    connection = await asyncpg.connect(TEST_DATABASE_URL)
+    try:
+        await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema}")
+        await connection.execute(LEMMY_TABLES.format(pcm_actor_id=PCM_ACTOR_ID))
+        await connection.execute(NOTIFY_SQL.read_text())
+        # Other query parameters are sent to the server as settings
+        url = urlsplit(TEST_DATABASE_URL)
+        yield urlunsplit(url._replace(query=urlencode([*parse_qsl(url.query), ("search_path", schema)])))
+    finally:
+        await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await connection.close()
+
+
+async def _wait_for_postgres(source: PgCommentSource) -> None:
+    while source.source != "postgres":
+        await asyncio.sleep(0.05)
+
+
+async def _stream_new_comment() -> None:
+    import asyncpg
+
+    async with lemmy_schema() as dsn, AsyncLemmyPy("http://127.0.0.1:9", "test", "test") as lemmy:
+        source = PgCommentSource()
+        source.configure(dsn=dsn, community_actor_id=PCM_ACTOR_ID)
+        stream = source.stream(lemmy)
+        next_comment = asyncio.ensure_future(anext(stream))
+        try:
+            await asyncio.wait_for(_wait_for_postgres(source), 10)
+            assert source.community_id == 7
+
+            writer = await asyncpg.connect(dsn)
+            try:
+                await writer.execute("INSERT INTO comment (creator_id, post_id, content) VALUES (1, 1, 'not in pcm'), (1, 2, 'based')")
+            finally:
+                await writer.close()
+
+            comment = await asyncio.wait_for(next_comment, 10)
+            assert comment.content == "based"
+            assert comment.community.actor_id == PCM_ACTOR_ID
+            assert comment.user.actor_id == "https://lemmy.basedcount.com/u/user1"
+        finally:
+            next_comment.cancel()
+            await asyncio.gather(next_comment, return_exceptions=True)
+            await stream.aclose()
+
+
+async def _listen_without_community() -> None:
+    async with lemmy_schema() as dsn, AsyncLemmyPy("http://127.0.0.1:9", "test", "test") as lemmy:
+        source = PgCommentSource()
+        source.configure(dsn=dsn, community_actor_id="https://lemmy.basedcount.com/c/missing")
+        with pytest.raises(LookupError):
+            await source._listen(lemmy)
+
+
+def test_trigger_notifies_source() -> None:
+    asyncio.run(_stream_new_comment())
+
+
+def test_unknown_community_fails() -> None:
+    asyncio.run(_listen_without_community())
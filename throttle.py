@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+from collections import deque
+from enum import Enum
+from time import monotonic
+from typing import Optional
+
+from attrs import define, field
+from cachetools import TTLCache
+
+from metrics import THROTTLED_COMMANDS
+
+
+class Verdict(Enum):
+    ALLOW = "allow"
+    # First command over the limit in the window, the user gets one reply telling them to slow down
+    NOTIFY = "notify"
+    DROP = "drop"
+
+
+@define(kw_only=True)
+class SlidingWindow:
+    """At most limit events per key in any window seconds. Keys idle for a whole window are forgotten, at most max_keys are kept."""
+
+    limit: int
+    window: float
+    max_keys: int = 10_000
+    _events: TTLCache[str, deque[float]] = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._events = TTLCache(maxsize=self.max_keys, ttl=self.window, timer=monotonic)
+
+    def allows(self, key: str, now: float) -> bool:
+        events = self._events.get(key)
+        return events is None or len(events) < self.limit or now - events[0] >= self.window
+
+    def record(self, key: str, now: float) -> None:
+        # The deque only ever needs the last limit events, assigning again restarts the key's ttl
+        self._events[key] = events = self._events.get(key) or deque(maxlen=self.limit)
+        events.append(now)
+
+
+@define(kw_only=True)
+class CommandThrottle:
+    """Limits the commands each user, and each post, can make the bot run.
+
+    A command over either limit isn't run. The first one of a user within a window gets a single reply asking them to slow down, every other one
+    is dropped silently, so spamming the bot costs it one reply instead of fifty. Commands that were refused don't count towards the limits.
+
+    """
+
+    per_actor_limit: int = 5
+    per_post_limit: int = 20
+    window: float = 60
+    _actors: SlidingWindow = field(init=False)
+    _posts: SlidingWindow = field(init=False)
+    # Users already told to slow down in the current window
+    _notified: TTLCache[str, None] = field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self.configure(self.per_actor_limit, self.per_post_limit, self.window)
+
+    def configure(self, per_actor_limit: int, per_post_limit: int, window: float) -> None:
+        """Sets the limits and forgets every recorded command.
+
+        :param per_actor_limit: commands per user and window, 0 turns the limit off
+        :param per_post_limit: commands per post and window, 0 turns the limit off
+        :param window: length of the sliding window in seconds
+
+        """
+        self.per_actor_limit, self.per_post_limit, self.window = per_actor_limit, per_post_limit, window
+        self._actors = SlidingWindow(limit=max(per_actor_limit, 1), window=window)
+        self._posts = SlidingWindow(limit=max(per_post_limit, 1), window=window)
+        self._notified = TTLCache(maxsize=10_000, ttl=window, timer=monotonic)
+
+    def check(self, actor_id: str, post_id: Optional[int] = None) -> Verdict:
+        """Decides what happens to a command and records it when it may run.
+
+        :param actor_id: author of the command
+        :param post_id: post the command was made in, None for private messages
+
+        :returns: the verdict
+
+        """
+        now = monotonic()
+        actor = actor_id.lower()
+        over_actor = self.per_actor_limit > 0 and not self._actors.allows(actor, now)
+        over_post = post_id is not None and self.per_post_limit > 0 and not self._posts.allows(str(post_id), now)
+        if not over_actor and not over_post:
+            self._actors.record(actor, now)
+            if post_id is not None:
+                self._posts.record(str(post_id), now)
+            return Verdict.ALLOW
+
+        scope = "actor" if over_actor else "post"
+        # Only telling users off for their own spam, a busy thread doesn't get more replies
+        if over_actor and actor not in self._notified:
+            self._notified[actor] = None
+            THROTTLED_COMMANDS.inc(scope=scope, outcome="notified")
+            return Verdict.NOTIFY
+        THROTTLED_COMMANDS.inc(scope=scope, outcome="dropped")
+        return Verdict.DROP
+
+
+command_throttle = CommandThrottle()
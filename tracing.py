@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import secrets
+import threading
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from pathlib import Path
+from queue import SimpleQueue
+from statistics import quantiles
+from time import perf_counter, time_ns
+from typing import Any, Iterator, Optional
+
+from attrs import define, field
+
+tracing_logger = getLogger("basedcount_bot.tracing")
+
+TRACES_FILE = Path("logs/traces.jsonl")
+
+
+@define(kw_only=True)
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start_ns: int
+    attributes: dict[str, Any] = field(factory=dict)
+    duration_ns: int = 0
+    error: Optional[str] = None
+    _started: float = field(factory=perf_counter)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": self.duration_ns / 1_000_000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+@define(kw_only=True)
+class Trace:
+    root: Span
+    spans: list[Span] = field(factory=list)
+    # Background tasks started inside a trace can outlive it, their spans are dropped once the trace is exported
+    closed: bool = False
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.root.trace_id,
+            "span_id": self.root.span_id,
+            "name": self.root.name,
+            "start_ns": self.root.start_ns,
+            "duration_ms": self.root.duration_ns / 1_000_000,
+            "attributes": self.root.attributes,
+            "error": self.root.error,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class TraceExporter:
+    """Writes finished traces from a background thread, so the event loop never waits on the disk or the collector.
+
+    Every trace is written as one JSON line to the traces file, and also sent to an OTLP/HTTP collector when an endpoint is set.
+
+    """
+
+    def __init__(self, path: Path = TRACES_FILE, otlp_endpoint: Optional[str] = None) -> None:
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self._queue: SimpleQueue[Optional[Trace]] = SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, trace: Trace) -> None:
+        self._queue.put(trace)
+
+    def close(self, timeout: float = 5) -> None:
+        """Writes the queued traces and stops the thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        self.path.parent.mkdir(exist_ok=True)
+        stopping = False
+        while not stopping:
+            # Block for the first trace, then take whatever else is already queued so the file is opened once per batch
+            batch: list[Trace] = []
+            queued = self._queue.get()
+            while queued is not None:
+                batch.append(queued)
+                if self._queue.empty():
+                    break
+                queued = self._queue.get()
+            stopping = queued is None
+
+            if not batch:
+                continue
+            try:
+                with self.path.open("a", encoding="utf-8") as fp:
+                    fp.writelines(json.dumps(trace.to_dict(), default=str) + "\n" for trace in batch)
+                if self.otlp_endpoint is not None:
+                    self._send_otlp(batch)
+            except Exception:
+                tracing_logger.warning("Could not export traces", exc_info=True)
+
+    def _send_otlp(self, batch: list[Trace]) -> None:
+        """Posts the traces to the collector using the OTLP/HTTP JSON encoding."""
+        spans = []
+        for trace in batch:
+            for trace_span in [trace.root, *trace.spans]:
+                otlp_span: dict[str, Any] = {
+                    "traceId": trace_span.trace_id,
+                    "spanId": trace_span.span_id,
+                    "name": trace_span.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(trace_span.start_ns),
+                    "endTimeUnixNano": str(trace_span.start_ns + trace_span.duration_ns),
+                    "attributes": [{"key": key, "value": {"stringValue": str(value)}} for key, value in trace_span.attributes.items()],
+                    "status": {"code": 2, "message": trace_span.error} if trace_span.error else {"code": 1},
+                }
+                if trace_span.parent_id is not None:
+                    otlp_span["parentSpanId"] = trace_span.parent_id
+                spans.append(otlp_span)
+
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "basedcount_bot_lemmy"}}]},
+                    "scopeSpans": [{"scope": {"name": "basedcount_bot"}, "spans": spans}],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            str(self.otlp_endpoint), data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=5):
+            pass
+
+
+@define(kw_only=True)
+class Tracer:
+    sample_rate: float = 0.0
+    exporter: Optional[TraceExporter] = None
+
+    def configure(self, sample_rate: float, otlp_endpoint: Optional[str] = None, path: Path = TRACES_FILE) -> None:
+        """Sets the sampling rate and starts the exporter.
+
+        :param sample_rate: fraction of traces that are recorded, 0 turns tracing off
+        :param otlp_endpoint: OTLP/HTTP traces url of a local collector, e.g. http://127.0.0.1:4318/v1/traces
+        :param path: JSONL file the traces are appended to
+
+        """
+        self.sample_rate = sample_rate
+        if sample_rate > 0 and self.exporter is None:
+            self.exporter = TraceExporter(path=path, otlp_endpoint=otlp_endpoint)
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def start_trace(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Starts a new trace, recorded only if it is picked by the sampler. Spans opened inside it, across awaits, become its children.
+
+    :param name: name of the root span
+    :param attributes: attributes of the root span
+
+    :yields: the root span, or None when the trace isn't sampled
+
+    """
+    if tracer.exporter is None or random.random() >= tracer.sample_rate:
+        trace_token = _current_trace.set(None)
+        try:
+            yield None
+        finally:
+            _current_trace.reset(trace_token)
+        return
+
+    root = Span(trace_id=secrets.token_hex(16), span_id=secrets.token_hex(8), parent_id=None, name=name, start_ns=time_ns(), attributes=attributes)
+    trace = Trace(root=root)
+    trace_token, span_token = _current_trace.set(trace), _current_span.set(root)
+    try:
+        yield root
+    except BaseException as exc:
+        root.error = type(exc).__name__
+        raise
+    finally:
+        root.duration_ns = int((perf_counter() - root._started) * 1_000_000_000)
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace.closed = True
+        tracer.exporter.export(trace)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Records a child span of the current trace. Does nothing outside a sampled trace.
+
+    :param name: name of the span
+    :param attributes: attributes of the span
+
+    :yields: the span, or None when there is no sampled trace
+
+    """
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    if trace is None or parent is None or trace.closed:
+        yield None
+        return
+
+    child = Span(trace_id=trace.root.trace_id, span_id=secrets.token_hex(8), parent_id=parent.span_id, name=name, start_ns=time_ns(), attributes=attributes)
+    span_token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = type(exc).__name__
+        raise
+    finally:
+        child.duration_ns = int((perf_counter() - child._started) * 1_000_000_000)
+        _current_span.reset(span_token)
+        if not trace.closed:
+            trace.spans.append(child)
+
+
+def summarize(path: Path, top: int, name: Optional[str] = None) -> None:
+    """Prints the slowest traces with their span breakdown and latency percentiles per span name.
+
+    :param path: JSONL trace file
+    :param top: number of slowest traces to print
+    :param name: only consider traces with this root span name
+
+    """
+    with path.open("r", encoding="utf-8") as fp:
+        traces = [trace for trace in map(json.loads, fp) if name is None or trace["name"] == name]
+    if not traces:
+        print(f"No traces in {path}")
+        return
+
+    span_durations: dict[str, list[float]] = {}
+    for trace in traces:
+        span_durations.setdefault(trace["name"], []).append(trace["duration_ms"])
+        for trace_span in trace["spans"]:
+            span_durations.setdefault(trace_span["name"], []).append(trace_span["duration_ms"])
+
+    print(f"{len(traces)} traces\n")
+    print(f"{'span':<32}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+    for span_name, durations in sorted(span_durations.items(), key=lambda item: -max(item[1])):
+        percentiles = quantiles(durations, n=100, method="inclusive") if len(durations) > 1 else durations * 99
+        print(f"{span_name:<32}{len(durations):>8}{percentiles[49]:>12.1f}{percentiles[94]:>12.1f}{percentiles[98]:>12.1f}{max(durations):>12.1f}")
+
+    print(f"\nSlowest {top} traces")
+    for trace in sorted(traces, key=lambda trace: -trace["duration_ms"])[:top]:
+        attributes = " ".join(f"{key}={value}" for key, value in trace["attributes"].items())
+        print(f"\n{trace['duration_ms']:>10.1f} ms {trace['name']} {trace['trace_id']} {attributes}{' ERROR ' + trace['error'] if trace['error'] else ''}")
+        depth = {trace["span_id"]: 0}
+        for trace_span in sorted(trace["spans"], key=lambda trace_span: trace_span["start_ns"]):
+            indent = depth[trace_span["span_id"]] = depth.get(trace_span["parent_id"], 0) + 1
+            offset = (trace_span["start_ns"] - trace["start_ns"]) / 1_000_000
+            error = f" ERROR {trace_span['error']}" if trace_span["error"] else ""
+            print(f"{'':>14}{'  ' * indent}{trace_span['name']:<{34 - 2 * indent}} +{offset:>8.1f} ms {trace_span['duration_ms']:>10.1f} ms{error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarizes the traces recorded by the bot.")
+    parser.add_argument("--file", type=Path, default=TRACES_FILE, help=f"trace file (default: {TRACES_FILE})")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest traces to show")
+    parser.add_argument("--name", help="only traces with this root span name, e.g. comment")
+    args = parser.parse_args()
+    summarize(args.file, args.top, args.name)
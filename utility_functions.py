@@ -1,35 +1,125 @@
 from __future__ import annotations
 
+import atexit
 import json
 from contextlib import asynccontextmanager
-from logging import getLogger, Logger, config
+from logging import FileHandler, LogRecord, getLogger, Logger, config
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Queue
 from os import getenv
 from pathlib import Path
+from queue import SimpleQueue
 from traceback import print_exc
 from typing import AsyncGenerator, Optional
 
 import aiohttp
 from aiohttp import ClientSession
-from colorlog import ColoredFormatter
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
 
-Path("logs").mkdir(exist_ok=True)
-conf_file = Path("logging.conf")
-if conf_file.is_file():
-    config.fileConfig(str(conf_file))
-else:
-    config.fileConfig(str(Path(__file__).parent / "logging.conf"))
+from metrics import ERRORS, MongoCommandListener, MongoPoolListener
+from mongo_profile import mongo_profile
+from structured_logging import DeferredQueueHandler, JsonFormatter, RateLimitFilter, SamplingFilter
 
+# (requests per second, burst) per logger for the lines logged on every comment
+LOG_RATE_LIMITS = {"basedcount_bot": (5.0, 50), "async_lemmy": (1.0, 10)}
+# Fraction of the debug records kept per logger, async_lemmy logs every poll
+LOG_SAMPLE_RATES = {"async_lemmy": 0.01}
 
-async def post_to_pastebin(title: str, body: str) -> Optional[str]:
+log_listener: Optional[QueueListener] = None
+# Set when a logger asked for the colored console format before setup_logging ran
+_colored_console = False
+
+
+def setup_logging() -> None:
+    """Configures logging from logging.conf and moves the configured handlers behind a queue.
+
+    Loggers only put records on the queue, the console and file handlers format and write them on a listener thread so a slow disk or a log rotation
+    never blocks the event loop. The file handler writes one JSON object per line.
+
+    Called by the entry points rather than on import, so importing a module doesn't read logging.conf or create the logs directory, and worker
+    processes only set up the queue to their parent.
+
+    :returns: None
+
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+
+    Path("logs").mkdir(exist_ok=True)
+    conf_file = Path("logging.conf")
+    if conf_file.is_file():
+        config.fileConfig(str(conf_file), disable_existing_loggers=False)
+    else:
+        config.fileConfig(str(Path(__file__).parent / "logging.conf"), disable_existing_loggers=False)
+
+    root_logger = getLogger()
+    handlers = list(root_logger.handlers)
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+        if isinstance(handler, FileHandler):
+            handler.setFormatter(JsonFormatter())
+
+    log_queue: SimpleQueue[LogRecord] = SimpleQueue()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    for logger_name, (rate, burst) in LOG_RATE_LIMITS.items():
+        getLogger(logger_name).addFilter(RateLimitFilter(rate, burst))
+    for logger_name, sample_rate in LOG_SAMPLE_RATES.items():
+        getLogger(logger_name).addFilter(SamplingFilter(sample_rate))
+
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    if _colored_console:
+        _color_console_handlers(log_listener)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+def _color_console_handlers(listener: QueueListener) -> None:
+    from colorlog import ColoredFormatter
+
+    log_format = "%(log_color)s[%(asctime)s] %(levelname)s [%(filename)s.%(funcName)s:%(lineno)d] %(message)s"
+    for handler in listener.handlers:
+        # The log file gets JSON, only the console is colored
+        if not isinstance(handler, FileHandler):
+            handler.setFormatter(ColoredFormatter(log_format, datefmt="%Y-%m-%dT%H:%M:%S%z"))
+
+
+def setup_worker_logging(log_queue: Queue[LogRecord]) -> None:
+    """Sends every record of a worker process to the parent process, which owns the console and the log file.
+
+    :param log_queue: multiprocessing queue read by the parent
+
+    :returns: None
+
+    """
+    global log_listener
+    if log_listener is not None:
+        atexit.unregister(log_listener.stop)
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+    root_logger = getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+
+
+async def post_to_pastebin(title: str, body: str, session: Optional[ClientSession] = None) -> Optional[str]:
     """Uploads the text to PasteBin and returns the url of the Paste
 
     :param title: Title of the Paste
     :param body: Body of Paste
+    :param session: Session to send the requests with, a new one is opened when None
 
     :returns: url of Paste
 
     """
+    if session is None:
+        async with ClientSession() as new_session:
+            return await post_to_pastebin(title, body, new_session)
+
     login_data = {"api_dev_key": getenv("PASTEBIN_DEV_KEY"), "api_user_name": getenv("PASTEBIN_USERNAME"), "api_user_password": getenv("PASTEBIN_PASSWORD")}
 
     data = {
@@ -43,74 +133,88 @@ async def post_to_pastebin(title: str, body: str) -> Optional[str]:
     }
 
     try:
-        async with ClientSession() as session:
-            login_resp = await session.post("https://pastebin.com/api/api_login.php", data=login_data)
-            if login_resp.status == 200:
-                data["api_user_key"] = await login_resp.text()
-                post_resp = await session.post("https://pastebin.com/api/api_post.php", data=data)
-                if post_resp.status == 200:
-                    return await post_resp.text()
+        # Responses are released when the block exits, whatever their status, so the shared session doesn't leak connections
+        async with session.post("https://pastebin.com/api/api_login.php", data=login_data) as login_resp:
+            if login_resp.status != 200:
+                return None
+            data["api_user_key"] = await login_resp.text()
+        async with session.post("https://pastebin.com/api/api_post.php", data=data) as post_resp:
+            if post_resp.status == 200:
+                return await post_resp.text()
     except aiohttp.ClientError:
+        ERRORS.inc(dependency="pastebin")
         print_exc()
     return None
 
 
-async def send_traceback_to_discord(exception_name: str, exception_message: str, exception_body: str) -> None:
+async def send_traceback_to_discord(exception_name: str, exception_message: str, exception_body: str, session: Optional[ClientSession] = None) -> bool:
     """Send the traceback of an exception to a Discord webhook.
 
     :param exception_name: The name of the exception.
     :param exception_message: A brief summary of the exception.
     :param exception_body: The full traceback of the exception.
+    :param session: Session to send the requests with, a new one is opened when None
+
+    :returns: True if the traceback was posted, False when the paste or the webhook failed
 
     """
-    paste_bin_url = await post_to_pastebin(f"{exception_name}: {exception_message}", exception_body)
+    if session is None:
+        async with ClientSession() as new_session:
+            return await send_traceback_to_discord(exception_name, exception_message, exception_body, new_session)
+
+    paste_bin_url = await post_to_pastebin(f"{exception_name}: {exception_message}", exception_body, session)
 
     if paste_bin_url is None:
-        return
+        return False
 
     webhook = getenv("DISCORD_WEBHOOK", "deadass")
     data = {"content": f"[{exception_name}: {exception_message}]({paste_bin_url})", "username": "Lemmy_BasedCountBot"}
-    async with ClientSession(headers={"Content-Type": "application/json"}) as session:
-        async with session.post(url=webhook, data=json.dumps(data)):
-            pass
+    async with session.post(url=webhook, data=json.dumps(data), headers={"Content-Type": "application/json"}) as webhook_resp:
+        return webhook_resp.ok
 
 
 @asynccontextmanager
 async def get_databased() -> AsyncGenerator[AsyncIOMotorDatabase, None]:
-    """Returns the MongoDB AsyncIOMotorClient
+    """Returns the MongoDB AsyncIOMotorClient, with the pool and compression settings of the mongo profile
 
     :returns: AsyncIOMotorClient object
     :rtype: AsyncIOMotorClient
 
     """
-    cluster = AsyncIOMotorClient(getenv("MONGO_PASS"))
+    mongo_profile.configure_from_env()
+    cluster = AsyncIOMotorClient(getenv("MONGO_PASS"), event_listeners=[MongoCommandListener(), MongoPoolListener()], **mongo_profile.client_options())
     try:
         yield cluster["dataBased"]
     finally:
         cluster.close()
 
 
-async def get_mongo_collection(collection_name: str, databased: AsyncIOMotorDatabase) -> AsyncIOMotorCollection:
+async def get_mongo_collection(collection_name: str, databased: AsyncIOMotorDatabase, read_only: bool = False) -> AsyncIOMotorCollection:
     """Returns the user databased from dataBased Cluster from MongoDB
 
+    :param read_only: The collection is only read and may be read from a secondary, see MongoProfile
+
     :returns: Returns a Collection from Mongo DB
 
     """
+    if read_only:
+        return databased.get_collection(collection_name, read_preference=mongo_profile.read_only_preference)
     return databased[collection_name]
 
 
 def create_logger(logger_name: str, set_format: bool = False) -> Logger:
     """Creates logger and returns an instance of logging object.
 
+    :param set_format: color the console output, applied by setup_logging when logging isn't set up yet
+
     :returns: Logging Object.
 
     """
-
+    global _colored_console
     if set_format:
-        log_format = "%(log_color)s[%(asctime)s] %(levelname)s [%(filename)s.%(funcName)s:%(lineno)d] %(message)s"
-        root_logger = getLogger("root")
-        for handler in root_logger.handlers:
-            handler.setFormatter(ColoredFormatter(log_format, datefmt="%Y-%m-%dT%H:%M:%S%z"))
+        _colored_console = True
+        if log_listener is not None:
+            _color_console_handlers(log_listener)
 
     return getLogger(logger_name)
 
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import queue
+import signal
+from logging import LogRecord
+from logging.handlers import QueueListener
+from multiprocessing.context import SpawnProcess
+from typing import Any, Optional
+from zlib import crc32
+
+from attrs import define, field
+
+from metrics import WORKER_QUEUE_DEPTH, WORKER_RESTARTS
+from structured_logging import ForwardingHandler
+from utility_functions import create_logger
+
+workers_logger = create_logger(logger_name="basedcount_bot")
+
+# Comments waiting for a worker before the ingest process waits for it to catch up
+MAX_QUEUED_PER_WORKER = 1000
+
+
+def route(actor_id: str, workers: int) -> int:
+    """Picks the worker of a user. Stable across restarts and processes, unlike hash().
+
+    :param actor_id: actor id the comment is routed by
+    :param workers: number of workers
+
+    :returns: worker index
+
+    """
+    return crc32(actor_id.lower().encode()) % workers
+
+
+@define(frozen=True, kw_only=True)
+class WorkItem:
+    # Comment.to_dict(), the comment is rebuilt in the worker with the worker's own session
+    comment_view: dict[str, Any]
+    # ParentInfo resolved by the ingest process for based comments, None for commands
+    parent_info: Optional[Any] = None
+
+
+def _run_worker(index: int, comment_queue: multiprocessing.Queue[Optional[WorkItem]], log_queue: multiprocessing.Queue[LogRecord]) -> None:
+    """Entry point of a worker process."""
+    # Stops come from the ingest process through the queue, after it finished reading, not from the terminal's or systemd's signals
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from utility_functions import setup_worker_logging
+
+    setup_worker_logging(log_queue)
+
+    # Imported here so the bot module is only loaded in the worker, after logging points at the parent
+    from basedcount_bot import worker_main
+
+    asyncio.run(worker_main(index, comment_queue))
+
+
+@define(kw_only=True)
+class WorkerPool:
+    """K worker processes fed by the ingest process, every user always lands on the same worker.
+
+    Routing by user keeps the commands of one user in order and their profile in the same process's caches. Each worker opens its own Mongo
+    client and Lemmy session. Workers are started with spawn, so they don't inherit the ingest process's event loop, threads or sockets.
+
+    State that needs every comment stays in the ingest process: it resolves the parents, feeds the cheating detector and throttles the commands.
+    What is left per worker: the leaderboard only records the bases of the worker's users and is reseeded from Mongo every minute, and a cached
+    /basedcount reply of a user routed elsewhere is only refreshed once its ttl expired.
+
+    """
+
+    size: int
+    _context: Any = field(factory=lambda: multiprocessing.get_context("spawn"))
+    _queues: list[multiprocessing.Queue[Optional[WorkItem]]] = field(factory=list)
+    _processes: list[SpawnProcess] = field(factory=list)
+    _log_queue: Optional[multiprocessing.Queue[LogRecord]] = None
+    _log_listener: Optional[QueueListener] = None
+
+    def _start_worker(self, index: int) -> SpawnProcess:
+        process: SpawnProcess = self._context.Process(
+            target=_run_worker, args=(index, self._queues[index], self._log_queue), name=f"basedcount-worker-{index}", daemon=True
+        )
+        process.start()
+        return process
+
+    def start(self) -> None:
+        """Starts the workers and the thread that writes their log records.
+
+        :returns: None
+
+        """
+        self._log_queue = self._context.Queue()
+        self._log_listener = QueueListener(self._log_queue, ForwardingHandler())
+        self._log_listener.start()
+        self._queues = [self._context.Queue(maxsize=MAX_QUEUED_PER_WORKER) for _ in range(self.size)]
+        self._processes = [self._start_worker(index) for index in range(self.size)]
+        for index, comment_queue in enumerate(self._queues):
+            WORKER_QUEUE_DEPTH.set_function(comment_queue.qsize, worker=str(index))
+        workers_logger.info("Started %d worker processes", self.size)
+
+    async def submit(self, actor_id: str, item: WorkItem) -> None:
+        """Sends a comment to the worker of the given user, restarting the worker if it died.
+
+        Waits, off the event loop, when the worker is MAX_QUEUED_PER_WORKER comments behind.
+
+        :param actor_id: user the comment is routed by
+        :param item: comment and its resolved parent
+
+        :returns: None
+
+        """
+        index = route(actor_id, self.size)
+        if not self._processes[index].is_alive():
+            workers_logger.error("Worker %d exited with %s, restarting it", index, self._processes[index].exitcode)
+            WORKER_RESTARTS.inc(worker=str(index))
+            self._processes[index] = self._start_worker(index)
+        try:
+            self._queues[index].put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(self._queues[index].put, item)
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Lets the workers finish their queued comments and waits for them to exit.
+
+        :param timeout: seconds to wait for every worker before terminating it
+
+        :returns: None
+
+        """
+        for comment_queue in self._queues:
+            await asyncio.to_thread(comment_queue.put, None)
+        for process in self._processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                workers_logger.warning("Worker %s did not stop in %s seconds, terminating it", process.name, timeout)
+                process.terminate()
+        if self._log_listener is not None:
+            self._log_listener.stop()